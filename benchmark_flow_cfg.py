@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Benchmark classifier free guidance modes of flow matching inference, full guidance (the reference) vs
+guidance reused for cfg_interval estimator calls vs conditional branch only (cfg_rate=0),
+reports RTF of the flow decoder, mel L1 against the reference and estimator batch per call.
+
+By default a tiny randomly initialized DiT estimator is used, so it runs on cpu without any checkpoint:
+    python benchmark_flow_cfg.py --cfg_interval 2 3
+Use a real CosyVoice2/CosyVoice3 flow, the speech tokens of the prompt wav are resynthesized:
+    python benchmark_flow_cfg.py --model_dir pretrained_models/CosyVoice2-0.5B
+"""
+
+import argparse
+import time
+import torch
+from omegaconf import DictConfig
+from cosyvoice.flow.flow_matching import CausalConditionalCFM
+from cosyvoice.flow.DiT.dit import DiT
+
+
+def build_tiny(args, device):
+    cfm_params = DictConfig({'sigma_min': 1e-06, 'solver': 'euler', 't_scheduler': 'cosine',
+                             'training_cfg_rate': 0.2, 'inference_cfg_rate': 0.7, 'reg_loss_type': 'l1'})
+    estimator = DiT(dim=args.hidden_size, depth=args.num_layers, heads=4, dim_head=args.hidden_size // 4, ff_mult=2,
+                    mel_dim=80, mu_dim=80, spk_dim=80, out_channels=80)
+    decoder = CausalConditionalCFM(240, cfm_params, n_spks=1, spk_emb_dim=80, estimator=estimator).to(device).eval()
+    mu = torch.randn(1, 80, args.mel_len, device=device)
+    mask = torch.ones(1, 1, args.mel_len, device=device)
+    spks = torch.randn(1, 80, device=device)
+    cond = torch.zeros(1, 80, args.mel_len, device=device)
+
+    def job(cfg_rate, cfg_interval):
+        return decoder(mu=mu, mask=mask, n_timesteps=args.n_timesteps, spks=spks, cond=cond, cfg_rate=cfg_rate, cfg_interval=cfg_interval)[0]
+    # mel frames per second of CosyVoice2/CosyVoice3
+    return decoder, job, 50
+
+
+def build_model(args, device):
+    from cosyvoice.cli.cosyvoice import AutoModel
+    cosyvoice = AutoModel(model_dir=args.model_dir)
+    model_input = cosyvoice.frontend.frontend_zero_shot(args.prompt_text, args.prompt_text, args.prompt_wav, cosyvoice.sample_rate, '')
+    flow = cosyvoice.model.flow
+    token = model_input['flow_prompt_speech_token'].to(device)
+
+    def job(cfg_rate, cfg_interval):
+        return flow.inference(token=token,
+                              token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(device),
+                              prompt_token=torch.zeros(1, 0, dtype=torch.int32, device=device),
+                              prompt_token_len=torch.tensor([0], dtype=torch.int32).to(device),
+                              prompt_feat=torch.zeros(1, 0, 80, device=device),
+                              prompt_feat_len=torch.tensor([0], dtype=torch.int32).to(device),
+                              embedding=model_input['flow_embedding'].to(device),
+                              streaming=False,
+                              finalize=True,
+                              n_timesteps=args.n_timesteps,
+                              cfg_rate=cfg_rate,
+                              cfg_interval=cfg_interval)[0]
+    return flow.decoder, job, flow.input_frame_rate * flow.token_mel_ratio
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav', type=str, default='./asset/zero_shot_prompt.wav')
+    parser.add_argument('--cfg_interval', type=int, nargs='+', default=[2, 3, 5])
+    parser.add_argument('--n_timesteps', type=int, default=10)
+    parser.add_argument('--hidden_size', type=int, default=256)
+    parser.add_argument('--num_layers', type=int, default=4)
+    parser.add_argument('--mel_len', type=int, default=500)
+    parser.add_argument('--num_runs', type=int, default=3)
+    args = parser.parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    decoder, job, mel_frame_rate = build_model(args, device) if args.model_dir else build_tiny(args, device)
+    batch_sizes = []
+    if isinstance(decoder.estimator, torch.nn.Module):
+        decoder.estimator.register_forward_hook(lambda module, inputs, output: batch_sizes.append(inputs[0].size(0)))
+
+    reference = job(None, 1)
+    print('{:>24} {:>8} {:>10} {:>16}'.format('mode', 'rtf', 'mel L1', 'mean batch/call'))
+    modes = [('full cfg', None, 1)] + [('cfg every {} calls'.format(i), None, i) for i in args.cfg_interval] + [('no cfg', 0, 1)]
+    for name, cfg_rate, cfg_interval in modes:
+        batch_sizes.clear()
+        synchronize(device)
+        start = time.time()
+        for _ in range(args.num_runs):
+            feat = job(cfg_rate, cfg_interval)
+        synchronize(device)
+        rtf = (time.time() - start) / args.num_runs / (feat.shape[2] / mel_frame_rate)
+        l1 = (feat - reference).abs().mean().item()
+        mean_batch = sum(batch_sizes) / len(batch_sizes) if len(batch_sizes) != 0 else float('nan')
+        print('{:>24} {:>8.4f} {:>10.4f} {:>16.2f}'.format(name, rtf, l1, mean_batch))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Benchmark flow matching ODE solvers versus number of steps, reports mel L1 against the 10 step euler
+reference, the number of estimator calls and ms per solve.
+
+By default a tiny randomly initialized DiT estimator is used, so it runs on cpu without any checkpoint:
+    python benchmark_flow_solver.py --solver euler midpoint heun dpm_solver_2m --n_timesteps 2 4 6 10
+Use a real CosyVoice2/CosyVoice3 flow, the speech tokens of the prompt wav are resynthesized:
+    python benchmark_flow_solver.py --model_dir pretrained_models/CosyVoice2-0.5B
+"""
+
+import argparse
+import time
+import torch
+from omegaconf import DictConfig
+from cosyvoice.flow.flow_matching import CausalConditionalCFM
+from cosyvoice.flow.DiT.dit import DiT
+
+
+def build_tiny(args, device):
+    cfm_params = DictConfig({'sigma_min': 1e-06, 'solver': 'euler', 't_scheduler': 'cosine',
+                             'training_cfg_rate': 0.2, 'inference_cfg_rate': 0.7, 'reg_loss_type': 'l1'})
+    estimator = DiT(dim=args.hidden_size, depth=args.num_layers, heads=4, dim_head=args.hidden_size // 4, ff_mult=2,
+                    mel_dim=80, mu_dim=80, spk_dim=80, out_channels=80)
+    decoder = CausalConditionalCFM(240, cfm_params, n_spks=1, spk_emb_dim=80, estimator=estimator).to(device).eval()
+    mu = torch.randn(1, 80, args.mel_len, device=device)
+    mask = torch.ones(1, 1, args.mel_len, device=device)
+    spks = torch.randn(1, 80, device=device)
+    cond = torch.zeros(1, 80, args.mel_len, device=device)
+
+    def job(n_timesteps):
+        return decoder(mu=mu, mask=mask, n_timesteps=n_timesteps, spks=spks, cond=cond)[0]
+    return decoder, job
+
+
+def build_model(args, device):
+    from cosyvoice.cli.cosyvoice import AutoModel
+    cosyvoice = AutoModel(model_dir=args.model_dir)
+    model_input = cosyvoice.frontend.frontend_zero_shot(args.prompt_text, args.prompt_text, args.prompt_wav, cosyvoice.sample_rate, '')
+    flow = cosyvoice.model.flow
+    assert isinstance(flow.decoder.estimator, torch.nn.Module), 'tensorrt estimator is not supported'
+    token = model_input['flow_prompt_speech_token'].to(device)
+    prompt_token = torch.zeros(1, 0, dtype=torch.int32, device=device)
+    prompt_feat = torch.zeros(1, 0, 80, device=device)
+
+    def job(n_timesteps):
+        return flow.inference(token=token,
+                              token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(device),
+                              prompt_token=prompt_token,
+                              prompt_token_len=torch.tensor([0], dtype=torch.int32).to(device),
+                              prompt_feat=prompt_feat,
+                              prompt_feat_len=torch.tensor([0], dtype=torch.int32).to(device),
+                              embedding=model_input['flow_embedding'].to(device),
+                              streaming=False,
+                              finalize=True,
+                              n_timesteps=n_timesteps)[0]
+    return flow.decoder, job
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav', type=str, default='./asset/zero_shot_prompt.wav')
+    parser.add_argument('--solver', type=str, nargs='+', default=['euler', 'midpoint', 'heun', 'dpm_solver_2m'])
+    parser.add_argument('--t_scheduler', type=str, nargs='+', default=['cosine'])
+    parser.add_argument('--n_timesteps', type=int, nargs='+', default=[2, 4, 6, 10])
+    parser.add_argument('--hidden_size', type=int, default=256)
+    parser.add_argument('--num_layers', type=int, default=4)
+    parser.add_argument('--mel_len', type=int, default=500)
+    parser.add_argument('--num_runs', type=int, default=3)
+    args = parser.parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    decoder, job = build_model(args, device) if args.model_dir else build_tiny(args, device)
+    num_calls = [0]
+    decoder.estimator.register_forward_hook(lambda *_: num_calls.__setitem__(0, num_calls[0] + 1))
+
+    decoder.solver, decoder.t_scheduler = 'euler', 'cosine'
+    reference = job(10)
+    print('{:>16} {:>10} {:>12} {:>12} {:>12} {:>10}'.format('solver', 't_sched', 'n_timesteps', 'mel L1', 'est. calls', 'ms'))
+    for solver in args.solver:
+        for t_scheduler in args.t_scheduler:
+            decoder.solver, decoder.t_scheduler = solver, t_scheduler
+            for n_timesteps in args.n_timesteps:
+                num_calls[0] = 0
+                synchronize(device)
+                start = time.time()
+                for _ in range(args.num_runs):
+                    feat = job(n_timesteps)
+                synchronize(device)
+                ms = (time.time() - start) / args.num_runs * 1000
+                l1 = (feat - reference).abs().mean().item()
+                print('{:>16} {:>10} {:>12} {:>12.4f} {:>12} {:>10.1f}'.format(solver, t_scheduler, n_timesteps, l1, num_calls[0] // args.num_runs, ms))
+
+
+if __name__ == '__main__':
+    main()
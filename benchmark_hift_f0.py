@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Benchmark per chunk latency of CosyVoice3 streaming vocoder (CausalHiFTGenerator.inference_chunk) with
+different f0 predictor backends, and the max abs difference of the speech to the default cpu backend.
+
+By default a randomly initialized CosyVoice3 hift is used, pass --hift_ckpt to load real weights:
+    python benchmark_hift_f0.py --hift_ckpt pretrained_models/Fun-CosyVoice3-0.5B-2512/hift.pt
+"""
+
+import argparse
+import time
+import torch
+from cosyvoice.hifigan.generator import CausalHiFTGenerator
+from cosyvoice.hifigan.f0_predictor import CausalConvRNNF0Predictor
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def run(model, mel, args, device):
+    speech, cache, latency = [], None, []
+    for i in range(0, mel.shape[2], args.chunk_size):
+        synchronize(device)
+        start = time.time()
+        this_speech, cache = model.inference_chunk(mel[:, :, i:i + args.chunk_size], cache=cache, finalize=i + args.chunk_size >= mel.shape[2])
+        synchronize(device)
+        latency.append(time.time() - start)
+        speech.append(this_speech)
+    return torch.concat(speech, dim=1), sum(latency) / len(latency) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hift_ckpt', type=str, default='')
+    parser.add_argument('--num_frames', type=int, default=1500)
+    parser.add_argument('--chunk_size', type=int, default=50)
+    parser.add_argument('--backends', type=str, nargs='+', default=['cpu', 'fp64', 'native'])
+    args = parser.parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    model = CausalHiFTGenerator(sampling_rate=24000, upsample_rates=[8, 5, 3], upsample_kernel_sizes=[16, 11, 7],
+                                source_resblock_kernel_sizes=[7, 7, 11], source_resblock_dilation_sizes=[[1, 3, 5], [1, 3, 5], [1, 3, 5]],
+                                f0_predictor=CausalConvRNNF0Predictor(num_class=1, in_channels=80, cond_channels=512))
+    if args.hift_ckpt:
+        # in case hift_model is saved with generator prefix
+        model.load_state_dict({k.replace('generator.', ''): v for k, v in torch.load(args.hift_ckpt, map_location='cpu').items()}, strict=True)
+    model.to(device).eval()
+    mel = torch.rand(1, 80, args.num_frames).to(device)
+
+    print('{:>10} {:>14} {:>14}'.format('f0 backend', 'ms/chunk', 'max abs diff'))
+    speech_ref = None
+    for f0_backend in args.backends:
+        model.set_f0_backend(f0_backend)
+        # warmup
+        run(model, mel[:, :, :args.chunk_size * 2], args, device)
+        speech, latency = run(model, mel, args, device)
+        speech_ref = speech if speech_ref is None else speech_ref
+        print('{:>10} {:>14.2f} {:>14.6f}'.format(f0_backend, latency, (speech - speech_ref).abs().max().item()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Benchmark Qwen2LM decoding throughput (tokens/s) versus concurrency,
+per-session decoding (one thread and one kv cache per request) vs continuous batching scheduler.
+
+By default a tiny randomly initialized Qwen2 is used, so it runs on cpu without any checkpoint:
+    python benchmark_llm_scheduler.py --concurrency 1 2 4 8
+It first checks that with greedy sampling the scheduler returns the same tokens as per-session decoding.
+"""
+
+import argparse
+import threading
+import time
+from functools import partial
+import torch
+from transformers import Qwen2Config, Qwen2ForCausalLM
+from cosyvoice.llm.llm import Qwen2Encoder, Qwen2LM
+from cosyvoice.llm.batch_scheduler import Qwen2LMBatchScheduler
+from cosyvoice.utils.common import ras_sampling
+
+
+class TinyQwen2Encoder(Qwen2Encoder):
+    def __init__(self, config):
+        torch.nn.Module.__init__(self)
+        self.model = Qwen2ForCausalLM(config)
+        self.decode_step = self.forward_one_step_static
+        self.static_cache_pool = []
+        self.static_cache_lock = threading.Lock()
+
+
+def build_lm(args, device):
+    config = Qwen2Config(vocab_size=1000, hidden_size=args.hidden_size, intermediate_size=args.hidden_size * 4,
+                         num_hidden_layers=args.num_layers, num_attention_heads=8, num_key_value_heads=2)
+    lm = Qwen2LM(args.hidden_size, args.hidden_size, 6561, TinyQwen2Encoder(config), ras_sampling)
+    return lm.to(device).eval()
+
+
+def run(lm, concurrency, args, device):
+    def job(i):
+        lm_input = torch.randn(1, args.prompt_len, args.hidden_size, device=device)
+        # min_len == max_len so that every session decodes exactly max_len tokens
+        num_tokens[i] = len(list(lm.inference_wrapper(lm_input, 25, args.max_len, args.max_len, str(i))))
+
+    num_tokens = [0] * concurrency
+    threads = [threading.Thread(target=job, args=(i,)) for i in range(concurrency)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(num_tokens) / (time.time() - start)
+
+
+def check(lm, args, device):
+    """Scheduled decoding of sessions with different prompt lengths (so left padded in the batch) equals per-session decoding."""
+    # NOTE top_k 1 and tau_r > 1 never falls back to random sampling, so sampling is greedy and both paths are deterministic
+    sampling = lm.sampling
+    lm.sampling = partial(ras_sampling, top_k=1, win_size=10, tau_r=1.1)
+    lm_inputs = [torch.randn(1, args.prompt_len + 7 * i, args.hidden_size, device=device) for i in range(4)]
+    expected = [list(lm.inference_wrapper(lm_input, 25, 0, args.max_len, 'single{}'.format(i))) for i, lm_input in enumerate(lm_inputs)]
+    lm.batch_scheduler = Qwen2LMBatchScheduler(lm, max_batch_size=args.max_batch_size)
+    results = [None] * len(lm_inputs)
+
+    def job(i):
+        results[i] = list(lm.inference_wrapper(lm_inputs[i], 25, 0, args.max_len, 'batched{}'.format(i)))
+    threads = [threading.Thread(target=job, args=(i,)) for i in range(len(lm_inputs))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    lm.batch_scheduler.stop()
+    del lm.batch_scheduler
+    lm.sampling = sampling
+    for i, (a, b) in enumerate(zip(expected, results)):
+        assert a == b, 'session {} scheduled tokens {} differ from single session tokens {}'.format(i, b, a)
+    print('scheduled decoding matches single session decoding, {} tokens'.format(sum(len(i) for i in expected)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--hidden_size', type=int, default=256)
+    parser.add_argument('--num_layers', type=int, default=4)
+    parser.add_argument('--prompt_len', type=int, default=100)
+    parser.add_argument('--max_len', type=int, default=100)
+    parser.add_argument('--max_batch_size', type=int, default=16)
+    args = parser.parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    lm = build_lm(args, device)
+    check(lm, args, device)
+
+    print('{:>12} {:>16} {:>16}'.format('concurrency', 'per-session tok/s', 'batched tok/s'))
+    for concurrency in args.concurrency:
+        baseline = run(lm, concurrency, args, device)
+        lm.batch_scheduler = Qwen2LMBatchScheduler(lm, max_batch_size=args.max_batch_size)
+        batched = run(lm, concurrency, args, device)
+        lm.batch_scheduler.stop()
+        del lm.batch_scheduler
+        print('{:>12} {:>16.1f} {:>16.1f}'.format(concurrency, baseline, batched))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Benchmark shared weight serving against one model replica per worker process, reports resident memory of all
+processes, gpu memory, requests per second and latency of zero shot streaming requests.
+
+replicated: each of the num_workers processes loads its own model (like gunicorn workers of stream_service.py)
+shared: one cosyvoice.cli.model_server owner process loads the model, num_workers processes send requests to it
+    python benchmark_model_server.py --model_dir pretrained_models/CosyVoice2-0.5B --num_workers 4 --concurrency 2
+Load time is excluded, all workers start sending requests once every model is loaded.
+"""
+
+import argparse
+import asyncio
+import multiprocessing as mp
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import time
+
+
+def rss_mb(pid):
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def gpu_mb():
+    try:
+        output = subprocess.check_output(['nvidia-smi', '--query-gpu=memory.used', '--format=csv,noheader,nounits'], text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return float('nan')
+    return float(sum(int(i) for i in output.split()))
+
+
+async def load(engine, args):
+    semaphore, latencies, audio_sec = asyncio.Semaphore(args.concurrency), [], [0.0]
+
+    async def request():
+        async with semaphore:
+            start, first = time.time(), None
+            async for model_output in engine.inference_zero_shot(args.tts_text, args.prompt_text, args.prompt_wav, stream=True):
+                first = time.time() - start if first is None else first
+                audio_sec[0] += model_output['tts_speech'].shape[1] / engine.sample_rate
+            latencies.append((first, time.time() - start))
+    start = time.time()
+    await asyncio.gather(*[request() for _ in range(args.num_requests)])
+    return time.time() - start, latencies, audio_sec[0]
+
+
+def worker(mode, args, barrier, result_queue):
+    if mode == 'replicated':
+        from cosyvoice.cli.cosyvoice import AutoModel
+        from cosyvoice.cli.async_cosyvoice import AsyncCosyVoice
+        engine = AsyncCosyVoice(AutoModel(model_dir=args.model_dir, fp16=args.fp16), max_workers=args.concurrency)
+    else:
+        from cosyvoice.cli.model_server import ModelClient
+        engine = ModelClient('127.0.0.1:{}'.format(args.port))
+    barrier.wait()
+    result_queue.put(asyncio.run(load(engine, args)))
+    # keep the process alive until the parent has sampled memory
+    barrier.wait()
+
+
+def start_owner(args):
+    cmd = [sys.executable, '-m', 'cosyvoice.cli.model_server', '--model_dir', args.model_dir, '--port', str(args.port),
+           '--max_streams', str(args.num_workers * args.concurrency), '--flow_batch_size', str(args.flow_batch_size),
+           '--hift_batch_size', str(args.hift_batch_size)] + (['--fp16'] if args.fp16 else [])
+    owner = subprocess.Popen(cmd)
+    while True:
+        assert owner.poll() is None, 'model server exited with {}'.format(owner.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', args.port), 1).close()
+            return owner
+        except OSError:
+            time.sleep(1)
+
+
+def run(mode, args):
+    gpu_base = gpu_mb()
+    owner = start_owner(args) if mode == 'shared' else None
+    ctx = mp.get_context('spawn')
+    barrier, result_queue = ctx.Barrier(args.num_workers + 1), ctx.Queue()
+    workers = [ctx.Process(target=worker, args=(mode, args, barrier, result_queue)) for _ in range(args.num_workers)]
+    for p in workers:
+        p.start()
+    try:
+        barrier.wait()
+        pids = [p.pid for p in workers] + ([owner.pid] if owner is not None else [])
+        rss_loaded, gpu_loaded = sum(rss_mb(pid) for pid in pids), gpu_mb() - gpu_base
+        results = [result_queue.get() for _ in workers]
+        rss_peak = sum(rss_mb(pid) for pid in pids)
+        barrier.wait()
+        for p in workers:
+            p.join()
+    finally:
+        if owner is not None:
+            owner.terminate()
+            owner.wait()
+    wall = max(r[0] for r in results)
+    latencies = [latency for r in results for latency in r[1]]
+    ttft = sorted(latency[0] for latency in latencies)
+    num_requests = len(latencies)
+    audio_sec = sum(r[2] for r in results)
+    print('{:>12} {:>10.0f} {:>10.0f} {:>10.0f} {:>8.2f} {:>10.3f} {:>10.3f} {:>8.3f}'.format(
+        mode, rss_loaded, rss_peak, gpu_loaded, num_requests / wall, ttft[num_requests // 2],
+        sorted(latency[1] for latency in latencies)[num_requests // 2], wall / audio_sec))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, required=True)
+    parser.add_argument('--mode', type=str, nargs='+', default=['replicated', 'shared'])
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=2, help='concurrent requests per worker')
+    parser.add_argument('--num_requests', type=int, default=8, help='requests per worker')
+    parser.add_argument('--flow_batch_size', type=int, default=8)
+    parser.add_argument('--hift_batch_size', type=int, default=8)
+    parser.add_argument('--fp16', action='store_true')
+    parser.add_argument('--port', type=int, default=50100)
+    parser.add_argument('--tts_text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav', type=str, default='./asset/zero_shot_prompt.wav')
+    args = parser.parse_args()
+    args.prompt_wav = os.path.abspath(args.prompt_wav)
+    # NOTE the owner subprocess and the spawned workers inherit it
+    os.environ.setdefault('COSYVOICE_MODEL_SERVER_AUTHKEY', secrets.token_hex(16))
+    print('{:>12} {:>10} {:>10} {:>10} {:>8} {:>10} {:>10} {:>8}'.format('mode', 'rss MB', 'peak MB', 'gpu MB', 'rps', 'p50 ttft', 'p50 lat', 'rtf'))
+    for mode in args.mode:
+        run(mode, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Benchmark the prompt prefix kv cache of Qwen2LM, reports time to first speech token without the cache,
+with a cold cache (prefix is prefilled and snapshotted) and with a warm cache (prefix is forked from the snapshot).
+
+By default a tiny randomly initialized Qwen2 is used, so it runs on cpu without any checkpoint:
+    python benchmark_prefix_cache.py --prompt_text_len 30 60
+Use a real CosyVoice2/CosyVoice3 model with zero shot prompt, optionally through the continuous batching scheduler:
+    python benchmark_prefix_cache.py --model_dir pretrained_models/CosyVoice2-0.5B --llm_batch_size 4
+"""
+
+import argparse
+import threading
+import time
+import torch
+from transformers import Qwen2Config, Qwen2ForCausalLM
+from cosyvoice.llm.llm import Qwen2Encoder, Qwen2LM
+from cosyvoice.llm.prefix_cache import PrefixKVCache
+from cosyvoice.utils.common import ras_sampling
+
+
+class TinyQwen2Encoder(Qwen2Encoder):
+    def __init__(self, config):
+        torch.nn.Module.__init__(self)
+        self.model = Qwen2ForCausalLM(config)
+        self.decode_step = self.forward_one_step_static
+        self.static_cache_pool = []
+        self.static_cache_lock = threading.Lock()
+
+
+def build_tiny(args, device):
+    config = Qwen2Config(vocab_size=1000, hidden_size=args.hidden_size, intermediate_size=args.hidden_size * 4,
+                         num_hidden_layers=args.num_layers, num_attention_heads=8, num_key_value_heads=2)
+    lm = Qwen2LM(args.hidden_size, args.hidden_size, 6561, TinyQwen2Encoder(config), ras_sampling).to(device).eval()
+    text = torch.randint(0, 1000, (1, args.text_len), device=device)
+    prompt_speech_token = torch.randint(0, 6561, (1, args.prompt_speech_token_len), device=device)
+
+    def make_inputs(prompt_text_len):
+        return {'text': text, 'prompt_text': torch.randint(0, 1000, (1, prompt_text_len), device=device),
+                'llm_prompt_speech_token': prompt_speech_token, 'llm_embedding': torch.zeros(1, 0, device=device)}
+    return lm, make_inputs
+
+
+def build_model(args, device):
+    from cosyvoice.cli.cosyvoice import AutoModel
+    cosyvoice = AutoModel(model_dir=args.model_dir)
+    model_input = cosyvoice.frontend.frontend_zero_shot(args.text, args.prompt_text, args.prompt_wav, cosyvoice.sample_rate, '')
+
+    def make_inputs(prompt_text_len):
+        # NOTE the real prompt text is used as is, prompt_text_len is ignored
+        return {k: model_input[k].to(device) for k in ['text', 'prompt_text', 'llm_prompt_speech_token', 'llm_embedding']}
+    return cosyvoice.model.llm, make_inputs
+
+
+def time_to_first_token(lm, model_input):
+    torch.manual_seed(0)
+    start = time.time()
+    token_generator = lm.inference(text=model_input['text'],
+                                   text_len=torch.tensor([model_input['text'].shape[1]], dtype=torch.int32).to(model_input['text'].device),
+                                   prompt_text=model_input['prompt_text'],
+                                   prompt_text_len=torch.tensor([model_input['prompt_text'].shape[1]], dtype=torch.int32).to(model_input['text'].device),
+                                   prompt_speech_token=model_input['llm_prompt_speech_token'],
+                                   prompt_speech_token_len=torch.tensor([model_input['llm_prompt_speech_token'].shape[1]], dtype=torch.int32).to(model_input['text'].device),
+                                   embedding=model_input['llm_embedding'])
+    next(token_generator)
+    ttft = time.time() - start
+    token_generator.close()
+    return ttft
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='')
+    parser.add_argument('--text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav', type=str, default='./asset/zero_shot_prompt.wav')
+    parser.add_argument('--llm_batch_size', type=int, default=0)
+    parser.add_argument('--hidden_size', type=int, default=512)
+    parser.add_argument('--num_layers', type=int, default=8)
+    parser.add_argument('--prompt_text_len', type=int, nargs='+', default=[30, 100])
+    parser.add_argument('--text_len', type=int, default=20)
+    parser.add_argument('--prompt_speech_token_len', type=int, default=150)
+    parser.add_argument('--num_runs', type=int, default=10)
+    args = parser.parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    lm, make_inputs = build_model(args, device) if args.model_dir else build_tiny(args, device)
+    if args.llm_batch_size > 0:
+        from cosyvoice.llm.batch_scheduler import Qwen2LMBatchScheduler
+        lm.batch_scheduler = Qwen2LMBatchScheduler(lm, max_batch_size=args.llm_batch_size)
+
+    print('{:>16} {:>12} {:>12} {:>12} {:>10}'.format('prompt_text_len', 'no cache ms', 'cold ms', 'warm ms', 'speedup'))
+    for prompt_text_len in (args.prompt_text_len if not args.model_dir else [0]):
+        model_input = make_inputs(prompt_text_len)
+        # warmup, e.g. cuda kernels and static cache allocation
+        time_to_first_token(lm, model_input)
+        ttft = {}
+        for mode in ['no cache', 'cold', 'warm']:
+            ttft[mode] = 0
+            for _ in range(args.num_runs):
+                if mode == 'no cache' and hasattr(lm, 'prefix_cache'):
+                    del lm.prefix_cache
+                if mode == 'cold':
+                    lm.prefix_cache = PrefixKVCache(min_len=1)
+                ttft[mode] += time_to_first_token(lm, model_input) / args.num_runs
+        print('{:>16} {:>12.2f} {:>12.2f} {:>12.2f} {:>10.2f}'.format(model_input['prompt_text'].shape[1], ttft['no cache'] * 1000, ttft['cold'] * 1000,
+                                                                      ttft['warm'] * 1000, ttft['no cache'] / ttft['warm']))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,200 +1,206 @@
 #!/usr/bin/env python3
 """
-性能测试工具：对比原始模型和量化模型的性能
+Accuracy/latency report of int8/int4 weight-only quantization against the original model.
+
+LLM accuracy is teacher forced on the speech tokens sampled by the original model: top1 agreement and KL divergence
+of the next token distribution, and the nll of those tokens. Flow accuracy is the SNR of the mel (and of the speech
+vocoded by the same hift) decoded from the same tokens. Latency is llm ms per token, flow ms per call and the rtf.
+
+By default a tiny randomly initialized Qwen2LM is quantized in memory, so it runs on cpu without any checkpoint:
+    python benchmark_quantized.py --bits 8 4
+Compare a real model with a model dir written by quantize_model.py/simple_quantize.py, or quantize it in memory:
+    python benchmark_quantized.py --model_dir pretrained_models/CosyVoice2-0.5B --quantized_dir pretrained_models/CosyVoice2-0.5B-quantized
+    python benchmark_quantized.py --model_dir pretrained_models/CosyVoice2-0.5B --bits 4 --group_size 64
 """
 
-import torch
-import time
-import sys
+import argparse
 import os
-from cosyvoice.cli.cosyvoice import AutoModel
-
-def benchmark_model(model_dir, test_text, iterations=5, use_fp16=False):
-    """
-    测试模型性能
-    
-    Args:
-        model_dir: 模型目录
-        test_text: 测试文本
-        iterations: 测试次数
-        use_fp16: 是否使用 FP16
-    """
-    print(f"\n{'='*60}")
-    print(f"Testing: {os.path.basename(model_dir)}")
-    print(f"FP16: {use_fp16}")
-    print(f"{'='*60}")
-    
-    # 加载模型
-    print("Loading model...")
-    start_load = time.time()
-    cosyvoice = AutoModel(model_dir=model_dir, fp16=use_fp16)
-    load_time = time.time() - start_load
-    print(f"✓ Model loaded in {load_time:.2f}s")
-    
-    # 准备测试数据
-    prompt_wav = "/home/ec2-user/CosyVoice/asset/zero_shot_prompt.wav"
-    if not os.path.exists(prompt_wav):
-        # 尝试其他可能的路径
-        prompt_wav = os.path.join(os.path.dirname(model_dir), "asset/zero_shot_prompt.wav")
-        if not os.path.exists(prompt_wav):
-            print(f"⚠️  Warning: prompt_wav not found, using model's default")
-            prompt_wav = None
-    
-    prompt_text = "希望你以后能够做的比我还好呦。"
-    
-    # 预热（避免首次推理的初始化开销）
-    print("Warming up...")
-    if prompt_wav:
-        for _ in cosyvoice.inference_zero_shot(test_text[:20], prompt_text, prompt_wav, stream=False):
-            pass
-    
-    # 正式测试
-    print(f"Running {iterations} iterations...")
-    times = []
-    audio_lengths = []
-    
-    for i in range(iterations):
+import threading
+import time
+import torch
+from transformers import Qwen2Config, Qwen2ForCausalLM
+from cosyvoice.llm.llm import Qwen2Encoder, Qwen2LM, CosyVoice3LM
+from cosyvoice.utils.common import ras_sampling
+from cosyvoice.utils.quantize import QUANT_TARGETS, quantize_module, init_quantized_kernels, load_quant_config
+
+
+class TinyQwen2Encoder(Qwen2Encoder):
+    def __init__(self, config):
+        torch.nn.Module.__init__(self)
+        self.model = Qwen2ForCausalLM(config)
+        self.decode_step = self.forward_one_step_static
+        self.static_cache_pool = []
+        self.static_cache_lock = threading.Lock()
+
+
+def build_tiny(args, device):
+    # NOTE same seed, so every variant starts from the same random weights
+    torch.manual_seed(0)
+    config = Qwen2Config(vocab_size=1000, hidden_size=args.hidden_size, intermediate_size=args.hidden_size * 4,
+                         num_hidden_layers=args.num_layers, num_attention_heads=8, num_key_value_heads=2)
+    return Qwen2LM(args.hidden_size, args.hidden_size, 6561, TinyQwen2Encoder(config), ras_sampling).to(device).eval()
+
+
+def quantize_in_memory(module, name, bits, group_size):
+    quantize_module(module, QUANT_TARGETS[name], bits, group_size)
+    init_quantized_kernels(module)
+
+
+def weight_mb(module):
+    # NOTE tied weights, e.g. qwen2 embed_tokens and lm_head, are counted once
+    tensors = {t.data_ptr(): t for t in module.state_dict().values()}
+    return sum(t.numel() * t.element_size() for t in tensors.values()) / 1024 ** 2
+
+
+def generate(lm, model_input):
+    torch.manual_seed(0)
+    device = model_input['text'].device
+    start, tokens = time.time(), []
+    for token in lm.inference(text=model_input['text'],
+                              text_len=torch.tensor([model_input['text'].shape[1]], dtype=torch.int32).to(device),
+                              prompt_text=model_input['prompt_text'],
+                              prompt_text_len=torch.tensor([model_input['prompt_text'].shape[1]], dtype=torch.int32).to(device),
+                              prompt_speech_token=model_input['llm_prompt_speech_token'],
+                              prompt_speech_token_len=torch.tensor([model_input['llm_prompt_speech_token'].shape[1]], dtype=torch.int32).to(device),
+                              embedding=model_input['llm_embedding']):
+        tokens.append(token)
+    return torch.tensor([tokens], dtype=torch.int32, device=device), (time.time() - start) / max(len(tokens), 1)
+
+
+@torch.inference_mode()
+def teacher_forced_logp(lm, model_input, tokens):
+    """Next token log probs at the positions of tokens, lm_input is built the same way as Qwen2LM/CosyVoice3LM inference."""
+    special = lm.speech_embedding if isinstance(lm, CosyVoice3LM) else lm.llm_embedding
+    text = lm.llm.model.model.embed_tokens(torch.concat([model_input['prompt_text'], model_input['text']], dim=1))
+    speech = lm.speech_embedding(torch.concat([model_input['llm_prompt_speech_token'], tokens], dim=1))
+    lm_input = torch.concat([special.weight[lm.sos].reshape(1, 1, -1), text, special.weight[lm.task_id].reshape(1, 1, -1), speech], dim=1)
+    hidden, _ = lm.llm(lm_input, torch.tensor([lm_input.shape[1]], dtype=torch.int32, device=lm_input.device))
+    return lm.llm_decoder(hidden[:, -tokens.shape[1] - 1:-1]).float().log_softmax(dim=-1)
+
+
+def llm_accuracy(ref_logp, logp, tokens):
+    kl = (ref_logp.exp() * (ref_logp - logp)).sum(dim=-1).mean().item()
+    top1 = (ref_logp.argmax(dim=-1) == logp.argmax(dim=-1)).float().mean().item()
+    nll = -logp.gather(-1, tokens.long().unsqueeze(-1)).mean().item()
+    return top1, kl, nll
+
+
+@torch.inference_mode()
+def flow_mel(model, model_input, tokens):
+    device = model.device
+    torch.manual_seed(0)
+    start = time.time()
+    mel, _ = model.flow.inference(token=tokens.to(device),
+                                  token_len=torch.tensor([tokens.shape[1]], dtype=torch.int32).to(device),
+                                  prompt_token=model_input['flow_prompt_speech_token'].to(device),
+                                  prompt_token_len=torch.tensor([model_input['flow_prompt_speech_token'].shape[1]], dtype=torch.int32).to(device),
+                                  prompt_feat=model_input['prompt_speech_feat'].to(device),
+                                  prompt_feat_len=torch.tensor([model_input['prompt_speech_feat'].shape[1]], dtype=torch.int32).to(device),
+                                  embedding=model_input['flow_embedding'].to(device),
+                                  streaming=False,
+                                  finalize=True)
+    return mel.float(), time.time() - start
+
+
+def snr_db(ref, x):
+    return 10 * torch.log10(ref.pow(2).sum() / (ref - x).pow(2).sum().clamp(min=1e-12)).item()
+
+
+def rtf(cosyvoice, args):
+    elapsed, duration = 0, 0
+    for _ in range(args.iterations):
         start = time.time()
-        
-        audio_chunks = []
-        if prompt_wav:
-            for result in cosyvoice.inference_zero_shot(test_text, prompt_text, prompt_wav, stream=False):
-                audio_chunks.append(result['tts_speech'])
-        
-        elapsed = time.time() - start
-        times.append(elapsed)
-        
-        # 计算生成的音频长度
-        if audio_chunks:
-            total_samples = sum(chunk.shape[-1] for chunk in audio_chunks)
-            audio_length = total_samples / cosyvoice.sample_rate
-            audio_lengths.append(audio_length)
-        
-        print(f"  Iteration {i+1}/{iterations}: {elapsed:.3f}s", end='')
-        if audio_lengths:
-            rtf = elapsed / audio_lengths[-1]
-            print(f" (RTF: {rtf:.3f})", end='')
-        print()
-    
-    # 统计结果
-    avg_time = sum(times) / len(times)
-    min_time = min(times)
-    max_time = max(times)
-    
-    if audio_lengths:
-        avg_audio_len = sum(audio_lengths) / len(audio_lengths)
-        avg_rtf = avg_time / avg_audio_len
-    else:
-        avg_audio_len = 0
-        avg_rtf = 0
-    
-    print(f"\n{'='*60}")
-    print(f"Results:")
-    print(f"{'='*60}")
-    print(f"Average time:     {avg_time:.3f}s")
-    print(f"Min time:         {min_time:.3f}s")
-    print(f"Max time:         {max_time:.3f}s")
-    if avg_audio_len > 0:
-        print(f"Audio length:     {avg_audio_len:.2f}s")
-        print(f"RTF (Real-Time Factor): {avg_rtf:.3f}")
-        print(f"  → {'✓ Faster than real-time' if avg_rtf < 1 else '✗ Slower than real-time'}")
-    print(f"{'='*60}")
-    
-    return {
-        'load_time': load_time,
-        'avg_time': avg_time,
-        'min_time': min_time,
-        'max_time': max_time,
-        'avg_rtf': avg_rtf,
-        'audio_length': avg_audio_len
-    }
-
-def compare_models(original_dir, quantized_dir, test_text, iterations=5):
-    """对比原始模型和量化模型"""
-    
-    print("\n" + "🔥"*30)
-    print("CosyVoice Performance Benchmark")
-    print("🔥"*30)
-    print(f"\nTest text: {test_text}")
-    print(f"Iterations: {iterations}")
-    
-    # 测试原始模型
-    try:
-        results_original = benchmark_model(original_dir, test_text, iterations, use_fp16=False)
-    except Exception as e:
-        print(f"❌ Error testing original model: {e}")
-        results_original = None
-    
-    # 测试量化模型
-    try:
-        results_quantized = benchmark_model(quantized_dir, test_text, iterations, use_fp16=True)
-    except Exception as e:
-        print(f"❌ Error testing quantized model: {e}")
-        results_quantized = None
-    
-    # 对比结果
-    if results_original and results_quantized:
-        print("\n" + "="*60)
-        print("📊 COMPARISON SUMMARY")
-        print("="*60)
-        
-        speedup = results_original['avg_time'] / results_quantized['avg_time']
-        load_speedup = results_original['load_time'] / results_quantized['load_time']
-        
-        print(f"\n{'Metric':<25} {'Original':<15} {'Quantized':<15} {'Improvement':<15}")
-        print("-"*70)
-        print(f"{'Load time':<25} {results_original['load_time']:>10.2f}s    {results_quantized['load_time']:>10.2f}s    {load_speedup:>10.2f}x")
-        print(f"{'Inference time':<25} {results_original['avg_time']:>10.3f}s    {results_quantized['avg_time']:>10.3f}s    {speedup:>10.2f}x")
-        print(f"{'RTF':<25} {results_original['avg_rtf']:>10.3f}     {results_quantized['avg_rtf']:>10.3f}     {results_original['avg_rtf']/results_quantized['avg_rtf']:>10.2f}x")
-        print("-"*70)
-        
-        if speedup >= 1.5:
-            emoji = "🚀🚀🚀"
-        elif speedup >= 1.2:
-            emoji = "🚀🚀"
-        elif speedup >= 1.0:
-            emoji = "🚀"
-        else:
-            emoji = "⚠️"
-        
-        print(f"\n{emoji} Overall speedup: {speedup:.2f}x {emoji}")
-        
-        if speedup >= 1.5:
-            print("✅ Excellent! Quantization provides significant speedup.")
-        elif speedup >= 1.2:
-            print("👍 Good speedup from quantization.")
-        elif speedup >= 1.0:
-            print("📊 Modest improvement. Consider other optimizations.")
+        for output in cosyvoice.inference_zero_shot(args.text, args.prompt_text, args.prompt_wav, stream=False):
+            duration += output['tts_speech'].shape[1] / cosyvoice.sample_rate
+        elapsed += time.time() - start
+    return elapsed / duration
+
+
+def report(rows, names):
+    print('{:>22} '.format('metric') + ' '.join('{:>12}'.format(name) for name in names))
+    for metric, values in rows.items():
+        print('{:>22} '.format(metric) + ' '.join('{:>12}'.format('-' if v is None else '{:.3f}'.format(v)) for v in values))
+
+
+def run_tiny(args, device):
+    ref = build_tiny(args, device)
+    model_input = {'text': torch.randint(0, 1000, (1, args.text_len), device=device),
+                   'prompt_text': torch.randint(0, 1000, (1, 10), device=device),
+                   'llm_prompt_speech_token': torch.randint(0, 6561, (1, 50), device=device),
+                   'llm_embedding': torch.zeros(1, 0, device=device)}
+    tokens, ms_per_token = generate(ref, model_input)
+    ref_logp = teacher_forced_logp(ref, model_input, tokens)
+    names, rows = ['original'], {'llm MB': [weight_mb(ref)], 'llm ms/token': [ms_per_token * 1000], 'top1 agreement': [None], 'KL': [None],
+                                 'nll': [llm_accuracy(ref_logp, ref_logp, tokens)[2]]}
+    for bits in args.bits:
+        lm = build_tiny(args, device)
+        quantize_in_memory(lm, 'llm', bits, args.group_size)
+        _, ms_per_token = generate(lm, model_input)
+        top1, kl, nll = llm_accuracy(ref_logp, teacher_forced_logp(lm, model_input, tokens), tokens)
+        names.append('int{}'.format(bits))
+        for metric, value in zip(rows, [weight_mb(lm), ms_per_token * 1000, top1, kl, nll]):
+            rows[metric].append(value)
+    report(rows, names)
+
+
+def run_model(args):
+    from cosyvoice.cli.cosyvoice import AutoModel
+    ref = AutoModel(model_dir=args.model_dir)
+    model_input = ref.frontend.frontend_zero_shot(args.text, args.prompt_text, args.prompt_wav, ref.sample_rate, '')
+    model_input = {k: v.to(ref.model.device) if isinstance(v, torch.Tensor) else v for k, v in model_input.items()}
+    tokens, ms_per_token = generate(ref.model.llm, model_input)
+    ref_logp = teacher_forced_logp(ref.model.llm, model_input, tokens)
+    ref_mel, flow_seconds = flow_mel(ref.model, model_input, tokens)
+    names = ['original']
+    rows = {'llm+flow MB': [weight_mb(ref.model.llm) + weight_mb(ref.model.flow)], 'llm ms/token': [ms_per_token * 1000],
+            'flow ms': [flow_seconds * 1000], 'rtf': [rtf(ref, args)], 'top1 agreement': [None], 'KL': [None],
+            'nll': [llm_accuracy(ref_logp, ref_logp, tokens)[2]], 'mel snr dB': [None], 'speech snr dB': [None]}
+    variants = [(args.quantized_dir, None)] if args.quantized_dir else [(args.model_dir, bits) for bits in args.bits]
+    for model_dir, bits in variants:
+        cosyvoice = AutoModel(model_dir=model_dir)
+        if bits is not None:
+            for name in ['llm', 'flow']:
+                quantize_in_memory(getattr(cosyvoice.model, name), name, bits, args.group_size)
         else:
-            print("⚠️  Quantized model is slower. Check configuration.")
-        
-        print("="*60)
+            bits = load_quant_config(model_dir).get('bits', '?')
+        _, ms_per_token = generate(cosyvoice.model.llm, model_input)
+        top1, kl, nll = llm_accuracy(ref_logp, teacher_forced_logp(cosyvoice.model.llm, model_input, tokens), tokens)
+        mel, flow_seconds = flow_mel(cosyvoice.model, model_input, tokens)
+        # NOTE both mels are vocoded by the original hift with the same source noise
+        torch.manual_seed(0)
+        speech, _ = ref.model.hift.inference(speech_feat=mel)
+        torch.manual_seed(0)
+        ref_speech, _ = ref.model.hift.inference(speech_feat=ref_mel)
+        names.append('int{}'.format(bits))
+        values = [weight_mb(cosyvoice.model.llm) + weight_mb(cosyvoice.model.flow), ms_per_token * 1000, flow_seconds * 1000, rtf(cosyvoice, args),
+                  top1, kl, nll, snr_db(ref_mel, mel), snr_db(ref_speech, speech)]
+        for metric, value in zip(rows, values):
+            rows[metric].append(value)
+        del cosyvoice
+    report(rows, names)
+
 
 def main():
-    if len(sys.argv) < 3:
-        print("Usage: python benchmark_quantized.py <original_model_dir> <quantized_model_dir> [test_text]")
-        print("\nExample:")
-        print("  python benchmark_quantized.py \\")
-        print("    /home/ec2-user/CosyVoice/pretrained_models/CosyVoice2-0.5B \\")
-        print("    /home/ec2-user/CosyVoice/pretrained_models/CosyVoice2-0.5B-quantized \\")
-        print('    "你好，欢迎来到我们的餐厅。"')
-        sys.exit(1)
-    
-    original_dir = sys.argv[1]
-    quantized_dir = sys.argv[2]
-    test_text = sys.argv[3] if len(sys.argv) > 3 else "你好，欢迎光临我们的餐厅，今天想吃点什么呢？"
-    
-    # 验证路径
-    if not os.path.exists(original_dir):
-        print(f"❌ Error: Original model directory not found: {original_dir}")
-        sys.exit(1)
-    
-    if not os.path.exists(quantized_dir):
-        print(f"❌ Error: Quantized model directory not found: {quantized_dir}")
-        sys.exit(1)
-    
-    # 运行对比
-    compare_models(original_dir, quantized_dir, test_text, iterations=5)
-
-if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='')
+    parser.add_argument('--quantized_dir', type=str, default='', help='model dir written by quantize_model.py, quantized in memory if empty')
+    parser.add_argument('--bits', type=int, nargs='+', default=[8, 4])
+    parser.add_argument('--group_size', type=int, default=128)
+    parser.add_argument('--text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav', type=str, default='./asset/zero_shot_prompt.wav')
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--hidden_size', type=int, default=512)
+    parser.add_argument('--num_layers', type=int, default=8)
+    parser.add_argument('--text_len', type=int, default=20)
+    args = parser.parse_args()
+    if args.quantized_dir:
+        assert os.path.exists(os.path.join(args.quantized_dir, 'quantization.json')), '{} is not written by quantize_model.py'.format(args.quantized_dir)
+    if args.model_dir:
+        run_model(args)
+    else:
+        run_tiny(args, torch.device('cuda' if torch.cuda.is_available() else 'cpu'))
+
+
+if __name__ == '__main__':
     main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of speech token sampling, the previous python loop nucleus/ras sampling vs
+the tensorized ras_sampling_batch, for one session and for a batch of sessions.
+
+    python benchmark_sampling.py --batch_size 1 8 32
+"""
+
+import argparse
+import time
+import torch
+from cosyvoice.utils.common import ras_sampling_batch
+
+
+def legacy_nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
+    prob, indices = [], []
+    cum_prob = 0.0
+    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
+    for i in range(len(sorted_idx)):
+        if cum_prob < top_p and len(prob) < top_k:
+            cum_prob += sorted_value[i]
+            prob.append(sorted_value[i])
+            indices.append(sorted_idx[i])
+        else:
+            break
+    prob = torch.tensor(prob).to(weighted_scores)
+    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
+    return indices[prob.multinomial(1, replacement=True)].item()
+
+
+def legacy_ras_sampling(weighted_scores, decoded_tokens, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
+    top_ids = legacy_nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
+    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
+    if rep_num >= win_size * tau_r:
+        top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True).item()
+    return top_ids
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--vocab_size', type=int, default=6564)
+    parser.add_argument('--steps', type=int, default=200)
+    args = parser.parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+
+    print('{:>10} {:>16} {:>16} {:>8}'.format('batch', 'legacy ms/step', 'batched ms/step', 'speedup'))
+    for batch_size in args.batch_size:
+        logp = torch.randn(batch_size, args.vocab_size, device=device).log_softmax(dim=-1)
+        decoded_tokens = [torch.randint(0, args.vocab_size, (10,)).tolist() for _ in range(batch_size)]
+        window = torch.tensor(decoded_tokens, device=device)
+
+        synchronize(device)
+        start = time.time()
+        for _ in range(args.steps):
+            for i in range(batch_size):
+                decoded_tokens[i].append(legacy_ras_sampling(logp[i], decoded_tokens[i]))
+        synchronize(device)
+        legacy = (time.time() - start) / args.steps * 1000
+
+        synchronize(device)
+        start = time.time()
+        for _ in range(args.steps):
+            top_ids = ras_sampling_batch(logp, window)
+            window = torch.concat([window[:, 1:], top_ids.unsqueeze(dim=1)], dim=1)
+            top_ids.tolist()
+        synchronize(device)
+        batched = (time.time() - start) / args.steps * 1000
+        print('{:>10} {:>16.3f} {:>16.3f} {:>7.1f}x'.format(batch_size, legacy, batched, legacy / batched))
+
+
+if __name__ == '__main__':
+    main()
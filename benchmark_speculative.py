@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Benchmark speculative decoding of Qwen2LM speech tokens, plain decoding vs n-gram draft vs layer skip draft,
+reports tokens/s and accepted draft token rate.
+
+By default a tiny randomly initialized Qwen2 is used, so it runs on cpu without any checkpoint:
+    python benchmark_speculative.py
+Use a real CosyVoice2/CosyVoice3 model with zero shot prompt:
+    python benchmark_speculative.py --model_dir pretrained_models/CosyVoice2-0.5B
+"""
+
+import argparse
+import threading
+import time
+import torch
+from transformers import Qwen2Config, Qwen2ForCausalLM
+from cosyvoice.llm.llm import Qwen2Encoder, Qwen2LM
+from cosyvoice.llm.speculative import NgramDraft, LayerSkipDraft
+from cosyvoice.utils.common import ras_sampling
+
+
+class TinyQwen2Encoder(Qwen2Encoder):
+    def __init__(self, config):
+        torch.nn.Module.__init__(self)
+        self.model = Qwen2ForCausalLM(config)
+        self.decode_step = self.forward_one_step_static
+        self.static_cache_pool = []
+        self.static_cache_lock = threading.Lock()
+
+
+def build_tiny(args, device):
+    config = Qwen2Config(vocab_size=1000, hidden_size=args.hidden_size, intermediate_size=args.hidden_size * 4,
+                         num_hidden_layers=args.num_layers, num_attention_heads=8, num_key_value_heads=2)
+    lm = Qwen2LM(args.hidden_size, args.hidden_size, 6561, TinyQwen2Encoder(config), ras_sampling).to(device).eval()
+
+    def job(speculative):
+        torch.manual_seed(0)
+        lm_input = torch.randn(1, args.prompt_len, args.hidden_size, device=device)
+        # min_len == max_len so that every run decodes exactly max_len tokens
+        return len(list(lm.inference_wrapper(lm_input, 25, args.max_len, args.max_len, '', speculative=speculative)))
+    return lm, job
+
+
+def build_model(args, device):
+    from cosyvoice.cli.cosyvoice import AutoModel
+    cosyvoice = AutoModel(model_dir=args.model_dir)
+    model_input = cosyvoice.frontend.frontend_zero_shot(args.text, args.prompt_text, args.prompt_wav, cosyvoice.sample_rate, '')
+    lm = cosyvoice.model.llm
+
+    def job(speculative):
+        torch.manual_seed(0)
+        return len(list(lm.inference(text=model_input['text'].to(device),
+                                     text_len=torch.tensor([model_input['text'].shape[1]], dtype=torch.int32).to(device),
+                                     prompt_text=model_input['prompt_text'].to(device),
+                                     prompt_text_len=torch.tensor([model_input['prompt_text'].shape[1]], dtype=torch.int32).to(device),
+                                     prompt_speech_token=model_input['llm_prompt_speech_token'].to(device),
+                                     prompt_speech_token_len=torch.tensor([model_input['llm_prompt_speech_token'].shape[1]], dtype=torch.int32).to(device),
+                                     embedding=model_input['llm_embedding'].to(device),
+                                     speculative=speculative)))
+    return lm, job
+
+
+def run(job, speculative, args):
+    num_tokens, start = 0, time.time()
+    for _ in range(args.num_runs):
+        num_tokens += job(speculative)
+    return num_tokens / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='')
+    parser.add_argument('--text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav', type=str, default='./asset/zero_shot_prompt.wav')
+    parser.add_argument('--hidden_size', type=int, default=256)
+    parser.add_argument('--num_layers', type=int, default=8)
+    parser.add_argument('--prompt_len', type=int, default=100)
+    parser.add_argument('--max_len', type=int, default=200)
+    parser.add_argument('--num_runs', type=int, default=3)
+    parser.add_argument('--num_draft_tokens', type=int, default=4)
+    parser.add_argument('--draft_layers', type=int, default=2)
+    args = parser.parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    lm, job = build_model(args, device) if args.model_dir else build_tiny(args, device)
+
+    print('{:>24} {:>10} {:>12}'.format('decoding', 'tok/s', 'accept rate'))
+    print('{:>24} {:>10.1f} {:>12}'.format('plain', run(job, False, args), '-'))
+    for name, draft in [('ngram', NgramDraft(args.num_draft_tokens)),
+                        ('layer skip {}'.format(args.draft_layers), LayerSkipDraft(lm, args.draft_layers, args.num_draft_tokens))]:
+        lm.draft = draft
+        tokens_per_second = run(job, True, args)
+        print('{:>24} {:>10.1f} {:>12.3f}'.format(name, tokens_per_second, draft.stats()['accept_rate']))
+
+
+if __name__ == '__main__':
+    main()
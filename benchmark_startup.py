@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Benchmark model startup, default (pretrained qwen2 built then overwritten by llm.pt) vs lazy_load (weights built on meta
+device and loaded from the mmap/safetensors checkpoint), reports the per phase startup time and peak RSS.
+Each mode starts in a fresh process, run tools/convert_checkpoint.py first to also measure safetensors loading:
+    python benchmark_startup.py --model_dir pretrained_models/CosyVoice2-0.5B
+Phases run in parallel, e.g. frontend is built while llm/flow/hift are loaded, so they do not add up to the total.
+"""
+
+import argparse
+import multiprocessing as mp
+import resource
+import time
+
+
+def worker(model_dir, lazy_load, result_queue):
+    from cosyvoice.cli.cosyvoice import AutoModel
+    cosyvoice = AutoModel(model_dir=model_dir, lazy_load=lazy_load)
+    phases = dict(cosyvoice.startup_timer.phases)
+    phases['total'] = time.time() - cosyvoice.startup_timer.start
+    result_queue.put((phases, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, required=True)
+    parser.add_argument('--num_runs', type=int, default=2)
+    args = parser.parse_args()
+    ctx = mp.get_context('spawn')
+    results = {}
+    for lazy_load in [False, True]:
+        for _ in range(args.num_runs):
+            result_queue = ctx.Queue()
+            p = ctx.Process(target=worker, args=(args.model_dir, lazy_load, result_queue))
+            p.start()
+            # NOTE keep the last run of each mode, earlier ones warm up the page cache
+            results[lazy_load] = result_queue.get()
+            p.join()
+    names = list(dict.fromkeys(k for phases, _ in results.values() for k in phases))
+    print('{:>12} '.format('phase') + ' '.join('{:>10}'.format('lazy' if lazy_load else 'default') for lazy_load in results))
+    for name in names:
+        print('{:>12} '.format(name) + ' '.join('{:>10.2f}'.format(results[lazy_load][0].get(name, 0)) for lazy_load in results))
+    print('{:>12} '.format('peak RSS MB') + ' '.join('{:>10.0f}'.format(results[lazy_load][1]) for lazy_load in results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Benchmark the vllm engine driver thread with concurrent requests, reports engine steps/s, mean requests per step,
+tokens/s and p50/p99 inter token latency seen by the request threads. Some requests are cancelled early
+to check that they are aborted in the engine.
+
+By default a fake engine with a fixed step time is used, so it runs without gpu or vllm:
+    python benchmark_vllm_driver.py --concurrency 1 4 16 --step_ms 10
+Use a real CosyVoice2/CosyVoice3 model with vllm:
+    python benchmark_vllm_driver.py --model_dir pretrained_models/CosyVoice2-0.5B
+"""
+
+import argparse
+import threading
+import time
+from types import SimpleNamespace
+from cosyvoice.llm.vllm_driver import VllmEngineDriver
+
+
+class FakeEngine:
+    """Mimics LLMEngine add_request/abort_request/step, each request decodes max_tokens tokens, one per step."""
+    def __init__(self, step_ms):
+        self.step_ms = step_ms
+        self.requests = {}
+        self.num_aborted = 0
+        self.num_requests_per_step = []
+
+    def add_request(self, request_id, prompt, sampling_params):
+        self.requests[request_id] = (sampling_params.max_tokens, [])
+
+    def abort_request(self, request_id):
+        self.requests.pop(request_id)
+        self.num_aborted += 1
+
+    def step(self):
+        time.sleep(self.step_ms / 1000)
+        self.num_requests_per_step.append(len(self.requests))
+        outputs = []
+        for request_id, (max_tokens, token_ids) in list(self.requests.items()):
+            token_ids.append(len(token_ids))
+            finished = len(token_ids) == max_tokens
+            if finished:
+                self.requests.pop(request_id)
+            outputs.append(SimpleNamespace(request_id=request_id, outputs=[SimpleNamespace(token_ids=list(token_ids))], finished=finished))
+        return outputs
+
+
+def build_fake(args):
+    engine = FakeEngine(args.step_ms)
+    driver = VllmEngineDriver(engine)
+
+    def job(request_id):
+        return driver.submit(request_id, {}, SimpleNamespace(max_tokens=args.max_tokens))
+    return driver, engine, job
+
+
+def build_model(args):
+    import torch
+    from cosyvoice.cli.cosyvoice import AutoModel
+    cosyvoice = AutoModel(model_dir=args.model_dir, load_vllm=True)
+    model_input = cosyvoice.frontend.frontend_zero_shot(args.text, args.prompt_text, args.prompt_wav, cosyvoice.sample_rate, '')
+    lm = cosyvoice.model.llm
+    device = cosyvoice.model.device
+
+    def job(request_id):
+        return lm.inference(text=model_input['text'].to(device),
+                            text_len=torch.tensor([model_input['text'].shape[1]], dtype=torch.int32).to(device),
+                            prompt_text=model_input['prompt_text'].to(device),
+                            prompt_text_len=torch.tensor([model_input['prompt_text'].shape[1]], dtype=torch.int32).to(device),
+                            prompt_speech_token=model_input['llm_prompt_speech_token'].to(device),
+                            prompt_speech_token_len=torch.tensor([model_input['llm_prompt_speech_token'].shape[1]], dtype=torch.int32).to(device),
+                            embedding=model_input['llm_embedding'].to(device),
+                            uuid=request_id)
+    return lm.vllm, None, job
+
+
+def run(driver, job, concurrency, args):
+    gaps, num_tokens, lock = [], [0], threading.Lock()
+
+    def request(i):
+        cancel_after = args.cancel_after if i % args.cancel_every == 0 else 0
+        token_generator, last, this_gaps, n = job('{}-{}'.format(concurrency, i)), time.time(), [], 0
+        for _ in token_generator:
+            now = time.time()
+            this_gaps.append(now - last)
+            last, n = now, n + 1
+            if n == cancel_after:
+                break
+        token_generator.close()
+        with lock:
+            gaps.extend(this_gaps)
+            num_tokens[0] += n
+    num_steps, start = driver.num_steps, time.time()
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.time() - start
+    gaps.sort()
+    return (driver.num_steps - num_steps) / wall, num_tokens[0] / wall, gaps[len(gaps) // 2] * 1000, gaps[int(len(gaps) * 0.99)] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='')
+    parser.add_argument('--text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav', type=str, default='./asset/zero_shot_prompt.wav')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--step_ms', type=float, default=10)
+    parser.add_argument('--max_tokens', type=int, default=200)
+    parser.add_argument('--cancel_every', type=int, default=4, help='every cancel_every-th request is cancelled after cancel_after tokens')
+    parser.add_argument('--cancel_after', type=int, default=20)
+    args = parser.parse_args()
+    driver, engine, job = build_model(args) if args.model_dir else build_fake(args)
+
+    print('{:>12} {:>10} {:>12} {:>10} {:>12} {:>12}'.format('concurrency', 'steps/s', 'req/step', 'tokens/s', 'p50 itl ms', 'p99 itl ms'))
+    for concurrency in args.concurrency:
+        if engine is not None:
+            engine.num_requests_per_step.clear()
+        steps_per_sec, tokens_per_sec, p50, p99 = run(driver, job, concurrency, args)
+        requests_per_step = sum(engine.num_requests_per_step) / max(len(engine.num_requests_per_step), 1) if engine is not None else float('nan')
+        print('{:>12} {:>10.1f} {:>12.2f} {:>10.1f} {:>12.2f} {:>12.2f}'.format(concurrency, steps_per_sec, requests_per_step, tokens_per_sec, p50, p99))
+    if engine is not None:
+        # aborts of cancelled requests are applied by the driver thread between steps
+        deadline = time.time() + 1
+        while len(engine.requests) != 0 and time.time() < deadline:
+            time.sleep(0.01)
+        assert len(engine.requests) == 0, '{} requests are left in the engine'.format(len(engine.requests))
+        print('aborted requests: {}'.format(engine.num_aborted))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cosyvoice.cli.cosyvoice import CosyVoice2
+from cosyvoice.utils.common import CancelToken
+
+
+class AsyncCosyVoice:
+    """asyncio facade of CosyVoice2/CosyVoice3 for servers which multiplex many streams in one event loop.
+
+    Each stream runs the synchronous inference generator on a dedicated thread pool and hands chunks to the
+    event loop through a bounded asyncio.Queue, so model compute never runs on the loop thread and a slow client
+    pauses its producer once max_queue_chunks chunks are pending. When the consumer stops iterating, e.g. the
+    client disconnects, the CancelToken of the stream is cancelled right away from the event loop, which stops
+    the llm_job and frees the caches of its sessions, and the generator is closed later in its own thread.
+
+    Usage:
+        async for model_output in async_cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_wav, stream=True):
+            ...
+    """
+    def __init__(self, cosyvoice: CosyVoice2, max_workers: int = 8, max_queue_chunks: int = 4):
+        """
+        Args:
+            cosyvoice: CosyVoice2 or CosyVoice3
+            max_workers: max number of concurrently synthesized streams, later streams wait for a free worker
+            max_queue_chunks: max number of chunks produced ahead of the consumer of one stream
+        """
+        assert isinstance(cosyvoice, CosyVoice2), 'AsyncCosyVoice only supports CosyVoice2/CosyVoice3'
+        self.cosyvoice = cosyvoice
+        self.sample_rate = cosyvoice.sample_rate
+        self.max_queue_chunks = max_queue_chunks
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='cosyvoice')
+
+    def produce_job(self, inference_fn, args, kwargs, chunk_queue, stop, loop):
+        generator = inference_fn(*args, **kwargs)
+        try:
+            for model_output in generator:
+                if stop.is_set():
+                    break
+                # NOTE blocks this worker, not the event loop, until the consumer has room
+                asyncio.run_coroutine_threadsafe(chunk_queue.put(model_output), loop).result()
+        except Exception as e:
+            if not stop.is_set():
+                asyncio.run_coroutine_threadsafe(chunk_queue.put(e), loop).result()
+            return
+        finally:
+            # close the generator in the thread which runs it, stops llm_job if the consumer is gone
+            generator.close()
+        if not stop.is_set():
+            asyncio.run_coroutine_threadsafe(chunk_queue.put(None), loop).result()
+
+    async def stream(self, inference_fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        chunk_queue, stop = asyncio.Queue(maxsize=self.max_queue_chunks), threading.Event()
+        cancel_token = CancelToken()
+        kwargs = dict(kwargs, cancel_token=cancel_token)
+        loop.run_in_executor(self.executor, self.produce_job, inference_fn, args, kwargs, chunk_queue, stop, loop)
+        try:
+            while True:
+                model_output = await chunk_queue.get()
+                if model_output is None:
+                    break
+                if isinstance(model_output, Exception):
+                    raise model_output
+                yield model_output
+        finally:
+            stop.set()
+            cancel_token.cancel()
+            # make room for a put which is in flight, so that the producer sees stop and exits
+            while not chunk_queue.empty():
+                chunk_queue.get_nowait()
+
+    def inference_sft(self, *args, **kwargs):
+        return self.stream(self.cosyvoice.inference_sft, *args, **kwargs)
+
+    def inference_zero_shot(self, *args, **kwargs):
+        return self.stream(self.cosyvoice.inference_zero_shot, *args, **kwargs)
+
+    def inference_cross_lingual(self, *args, **kwargs):
+        return self.stream(self.cosyvoice.inference_cross_lingual, *args, **kwargs)
+
+    def inference_instruct2(self, *args, **kwargs):
+        return self.stream(self.cosyvoice.inference_instruct2, *args, **kwargs)
+
+    def inference_vc(self, *args, **kwargs):
+        return self.stream(self.cosyvoice.inference_vc, *args, **kwargs)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
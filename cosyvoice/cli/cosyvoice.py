@@ -13,6 +13,10 @@
 # limitations under the License.
 import os
 import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from typing import Generator
 from tqdm import tqdm
 from hyperpyyaml import load_hyperpyyaml
@@ -20,8 +24,9 @@ from modelscope import snapshot_download
 import torch
 from cosyvoice.cli.frontend import CosyVoiceFrontEnd
 from cosyvoice.cli.model import CosyVoiceModel, CosyVoice2Model, CosyVoice3Model
-from cosyvoice.utils.file_utils import logging
+from cosyvoice.utils.file_utils import logging, load_prompt_audio, init_empty_weights
 from cosyvoice.utils.class_utils import get_model_type
+from cosyvoice.utils.common import CancelToken, StartupTimer
 
 
 class CosyVoice:
@@ -77,59 +82,118 @@ class CosyVoice:
     def save_spkinfo(self):
         torch.save(self.frontend.spk2info, '{}/spk2info.pt'.format(self.model_dir))
 
-    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_sft(i, spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
+    def pipeline_job(self, model_inputs, session_queue, slots, stop, speculative, cancel_token):
+        try:
+            for i, model_input in model_inputs:
+                slots.acquire()
+                if stop.is_set() or cancel_token.cancelled is True:
+                    break
+                session = self.model.start_session(**model_input, speculative=speculative, cancel_token=cancel_token)
+                session_queue.put((i, model_input, session))
+                # NOTE segments of one request take turns on the llm, its flow and hift overlap the llm of next segments
+                session['thread'].join()
+        except Exception as e:
+            session_queue.put(e)
+            return
+        session_queue.put(None)
+
+    def pipeline_release(self, session_queue, slots):
+        # cancel and release sessions which were started ahead but are not consumed
+        while True:
+            item = session_queue.get()
+            if item is None or isinstance(item, Exception):
+                break
+            self.model.cancel_session(item[2])
+            self.model.release_session(item[2])
+            slots.release()
+
+    def inference_pipeline(self, model_inputs, lookahead=1, speculative=False, cancel_token=None, **tts_kwargs):
+        """Synthesize text segments in order, the frontend and llm of next segments run while current segment is in flow and hift.
+
+        A long paragraph costs about max(llm, flow + hift) per segment instead of the sum, output order and streaming
+        chunks of each segment are the same as running model.tts segment by segment.
+
+        Args:
+            model_inputs: iterator of (segment text, frontend output), consumed in a background thread
+            lookahead: number of segments whose llm can run ahead of the segment being vocoded
+            cancel_token: CancelToken shared by the sessions of all segments, None means not cancellable from other threads
+        """
+        cancel_token = CancelToken() if cancel_token is None else cancel_token
+        session_queue, slots, stop = queue.Queue(), threading.Semaphore(lookahead + 1), threading.Event()
+        threading.Thread(target=self.pipeline_job, args=(model_inputs, session_queue, slots, stop, speculative, cancel_token), daemon=True).start()
+        finished, tts_generator = False, None
+        try:
+            while True:
+                item = session_queue.get()
+                if item is None:
+                    finished = True
+                    break
+                if isinstance(item, Exception):
+                    finished = True
+                    raise item
+                i, model_input, session = item
                 start_time = time.time()
+                logging.info('synthesis text {}'.format(i))
+                tts_generator = self.model.tts(**model_input, session=session, **tts_kwargs)
+                for model_output in tts_generator:
+                    speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
+                    logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
+                    yield model_output
+                    start_time = time.time()
+                slots.release()
+        finally:
+            if tts_generator is not None:
+                # NOTE cancels the llm_job of current session if the caller stops in the middle of it
+                tts_generator.close()
+            if finished is False:
+                stop.set()
+                slots.release()
+                threading.Thread(target=self.pipeline_release, args=(session_queue, slots), daemon=True).start()
 
-    def inference_zero_shot(self, tts_text, prompt_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
+    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True, speculative=False,
+                      n_timesteps=None, first_chunk_n_timesteps=None, cancel_token=None):
+        model_inputs = ((i, self.frontend.frontend_sft(i, spk_id)) for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)))
+        yield from self.inference_pipeline(model_inputs, stream=stream, speed=speed, speculative=speculative,
+                                           n_timesteps=n_timesteps, first_chunk_n_timesteps=first_chunk_n_timesteps, cancel_token=cancel_token)
+
+    def inference_zero_shot(self, tts_text, prompt_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True, speculative=False,
+                            n_timesteps=None, first_chunk_n_timesteps=None, cancel_token=None):
         prompt_text = self.frontend.text_normalize(prompt_text, split=False, text_frontend=text_frontend)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            if (not isinstance(i, Generator)) and len(i) < 0.5 * len(prompt_text):
-                logging.warning('synthesis text {} too short than prompt text {}, this may lead to bad performance'.format(i, prompt_text))
-            model_input = self.frontend.frontend_zero_shot(i, prompt_text, prompt_wav, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+        if zero_shot_spk_id == '':
+            prompt_wav = load_prompt_audio(prompt_wav)
 
-    def inference_cross_lingual(self, tts_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_cross_lingual(i, prompt_wav, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+        def frontend():
+            for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+                if (not isinstance(i, Generator)) and len(i) < 0.5 * len(prompt_text):
+                    logging.warning('synthesis text {} too short than prompt text {}, this may lead to bad performance'.format(i, prompt_text))
+                yield i, self.frontend.frontend_zero_shot(i, prompt_text, prompt_wav, self.sample_rate, zero_shot_spk_id)
+        yield from self.inference_pipeline(frontend(), stream=stream, speed=speed, speculative=speculative,
+                                           n_timesteps=n_timesteps, first_chunk_n_timesteps=first_chunk_n_timesteps, cancel_token=cancel_token)
 
-    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, text_frontend=True):
+    def inference_cross_lingual(self, tts_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True, speculative=False,
+                                n_timesteps=None, first_chunk_n_timesteps=None, cancel_token=None):
+        if zero_shot_spk_id == '':
+            prompt_wav = load_prompt_audio(prompt_wav)
+        model_inputs = ((i, self.frontend.frontend_cross_lingual(i, prompt_wav, self.sample_rate, zero_shot_spk_id))
+                        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)))
+        yield from self.inference_pipeline(model_inputs, stream=stream, speed=speed, speculative=speculative,
+                                           n_timesteps=n_timesteps, first_chunk_n_timesteps=first_chunk_n_timesteps, cancel_token=cancel_token)
+
+    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, text_frontend=True,
+                           n_timesteps=None, first_chunk_n_timesteps=None, cancel_token=None):
         assert isinstance(self.model, CosyVoiceModel), 'inference_instruct is only implemented for CosyVoice!'
         instruct_text = self.frontend.text_normalize(instruct_text, split=False, text_frontend=text_frontend)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_instruct(i, spk_id, instruct_text)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+        model_inputs = ((i, self.frontend.frontend_instruct(i, spk_id, instruct_text))
+                        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)))
+        yield from self.inference_pipeline(model_inputs, stream=stream, speed=speed,
+                                           n_timesteps=n_timesteps, first_chunk_n_timesteps=first_chunk_n_timesteps, cancel_token=cancel_token)
 
-    def inference_vc(self, source_wav, prompt_wav, stream=False, speed=1.0):
+    def inference_vc(self, source_wav, prompt_wav, stream=False, speed=1.0,
+                     n_timesteps=None, first_chunk_n_timesteps=None, cancel_token=None):
         model_input = self.frontend.frontend_vc(source_wav, prompt_wav, self.sample_rate)
         start_time = time.time()
-        for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+        for model_output in self.model.tts(**model_input, stream=stream, speed=speed,
+                                           n_timesteps=n_timesteps, first_chunk_n_timesteps=first_chunk_n_timesteps, cancel_token=cancel_token):
             speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
             logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
             yield model_output
@@ -138,23 +202,24 @@ class CosyVoice:
 
 class CosyVoice2(CosyVoice):
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1, llm_batch_size=0, flow_batch_size=0, hift_batch_size=0,
+                 load_speculative=False, draft_layers=0, prefix_cache_mb=0, lazy_load=False):
         self.model_dir = model_dir
         self.fp16 = fp16
+        self.startup_timer = StartupTimer()
         if not os.path.exists(model_dir):
             model_dir = snapshot_download(model_dir)
         hyper_yaml_path = '{}/cosyvoice2.yaml'.format(model_dir)
         if not os.path.exists(hyper_yaml_path):
             raise ValueError('{} not found!'.format(hyper_yaml_path))
-        with open(hyper_yaml_path, 'r') as f:
-            configs = load_hyperpyyaml(f, overrides={'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN')})
+        # lazy_load builds llm/flow/hift without allocating or initializing weights, they are loaded from llm.pt/flow.pt/hift.pt right after
+        with self.startup_timer.phase('config'), init_empty_weights() if lazy_load is True else nullcontext():
+            with open(hyper_yaml_path, 'r') as f:
+                configs = load_hyperpyyaml(f, overrides={'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN')})
         assert get_model_type(configs) == CosyVoice2Model, 'do not use {} for CosyVoice2 initialization!'.format(model_dir)
-        self.frontend = CosyVoiceFrontEnd(configs['get_tokenizer'],
-                                          configs['feat_extractor'],
-                                          '{}/campplus.onnx'.format(model_dir),
-                                          '{}/speech_tokenizer_v2.onnx'.format(model_dir),
-                                          '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+        # NOTE frontend (tokenizer, onnx sessions, text normalizer) is built in a thread while model weights are loaded
+        executor = ThreadPoolExecutor(max_workers=1)
+        frontend = executor.submit(self.build_frontend, configs, model_dir, 'speech_tokenizer_v2.onnx')
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or load_vllm is True or fp16 is True):
             load_jit, load_trt, load_vllm, fp16 = False, False, False, False
@@ -162,49 +227,73 @@ class CosyVoice2(CosyVoice):
         self.model = CosyVoice2Model(configs['llm'], configs['flow'], configs['hift'], fp16)
         self.model.load('{}/llm.pt'.format(model_dir),
                         '{}/flow.pt'.format(model_dir),
-                        '{}/hift.pt'.format(model_dir))
-        if load_vllm:
-            self.model.load_vllm('{}/vllm'.format(model_dir))
+                        '{}/hift.pt'.format(model_dir),
+                        timer=self.startup_timer)
+        with self.startup_timer.phase('llm backend'):
+            if load_vllm:
+                self.model.load_vllm('{}/vllm'.format(model_dir))
+            elif llm_batch_size > 0:
+                self.model.load_batch_scheduler(llm_batch_size)
+            # NOTE draft for requests with speculative=True, an n-gram draft if draft_layers is 0 else the first draft_layers llm layers
+            if load_speculative:
+                self.model.load_speculative(draft_layers=draft_layers)
+            if not load_vllm and prefix_cache_mb > 0:
+                self.model.load_prefix_cache(prefix_cache_mb)
         if load_jit:
-            self.model.load_jit('{}/flow.encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'))
+            with self.startup_timer.phase('jit'):
+                self.model.load_jit('{}/flow.encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'))
         if load_trt:
-            self.model.load_trt('{}/flow.decoder.estimator.{}.mygpu.plan'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
-                                '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
-                                trt_concurrent,
-                                self.fp16)
+            with self.startup_timer.phase('trt'):
+                self.model.load_trt('{}/flow.decoder.estimator.{}.mygpu.plan'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
+                                    '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
+                                    trt_concurrent,
+                                    self.fp16)
+        if flow_batch_size > 0:
+            self.model.load_flow_batcher(flow_batch_size)
+        if hift_batch_size > 0:
+            self.model.load_hift_batcher(hift_batch_size)
+        self.frontend = frontend.result()
+        executor.shutdown()
         del configs
+        logging.info(self.startup_timer.report())
 
-    def inference_instruct2(self, tts_text, instruct_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_instruct2(i, instruct_text, prompt_wav, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+    def build_frontend(self, configs, model_dir, speech_tokenizer):
+        with self.startup_timer.phase('frontend'):
+            return CosyVoiceFrontEnd(configs['get_tokenizer'],
+                                     configs['feat_extractor'],
+                                     '{}/campplus.onnx'.format(model_dir),
+                                     '{}/{}'.format(model_dir, speech_tokenizer),
+                                     '{}/spk2info.pt'.format(model_dir),
+                                     configs['allowed_special'])
+
+    def inference_instruct2(self, tts_text, instruct_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True, speculative=False,
+                            n_timesteps=None, first_chunk_n_timesteps=None, cancel_token=None):
+        if zero_shot_spk_id == '':
+            prompt_wav = load_prompt_audio(prompt_wav)
+        model_inputs = ((i, self.frontend.frontend_instruct2(i, instruct_text, prompt_wav, self.sample_rate, zero_shot_spk_id))
+                        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)))
+        yield from self.inference_pipeline(model_inputs, stream=stream, speed=speed, speculative=speculative,
+                                           n_timesteps=n_timesteps, first_chunk_n_timesteps=first_chunk_n_timesteps, cancel_token=cancel_token)
 
 
 class CosyVoice3(CosyVoice2):
 
-    def __init__(self, model_dir, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1, llm_batch_size=0, load_speculative=False, draft_layers=0,
+                 prefix_cache_mb=0, lazy_load=False):
         self.model_dir = model_dir
         self.fp16 = fp16
+        self.startup_timer = StartupTimer()
         if not os.path.exists(model_dir):
             model_dir = snapshot_download(model_dir)
         hyper_yaml_path = '{}/cosyvoice3.yaml'.format(model_dir)
         if not os.path.exists(hyper_yaml_path):
             raise ValueError('{} not found!'.format(hyper_yaml_path))
-        with open(hyper_yaml_path, 'r') as f:
-            configs = load_hyperpyyaml(f, overrides={'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN')})
+        with self.startup_timer.phase('config'), init_empty_weights() if lazy_load is True else nullcontext():
+            with open(hyper_yaml_path, 'r') as f:
+                configs = load_hyperpyyaml(f, overrides={'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN')})
         assert get_model_type(configs) == CosyVoice3Model, 'do not use {} for CosyVoice3 initialization!'.format(model_dir)
-        self.frontend = CosyVoiceFrontEnd(configs['get_tokenizer'],
-                                          configs['feat_extractor'],
-                                          '{}/campplus.onnx'.format(model_dir),
-                                          '{}/speech_tokenizer_v3.onnx'.format(model_dir),
-                                          '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+        executor = ThreadPoolExecutor(max_workers=1)
+        frontend = executor.submit(self.build_frontend, configs, model_dir, 'speech_tokenizer_v3.onnx')
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_trt is True or fp16 is True):
             load_trt, fp16 = False, False
@@ -212,17 +301,30 @@ class CosyVoice3(CosyVoice2):
         self.model = CosyVoice3Model(configs['llm'], configs['flow'], configs['hift'], fp16)
         self.model.load('{}/llm.pt'.format(model_dir),
                         '{}/flow.pt'.format(model_dir),
-                        '{}/hift.pt'.format(model_dir))
-        if load_vllm:
-            self.model.load_vllm('{}/vllm'.format(model_dir))
+                        '{}/hift.pt'.format(model_dir),
+                        timer=self.startup_timer)
+        with self.startup_timer.phase('llm backend'):
+            if load_vllm:
+                self.model.load_vllm('{}/vllm'.format(model_dir))
+            elif llm_batch_size > 0:
+                self.model.load_batch_scheduler(llm_batch_size)
+            # NOTE draft for requests with speculative=True, an n-gram draft if draft_layers is 0 else the first draft_layers llm layers
+            if load_speculative:
+                self.model.load_speculative(draft_layers=draft_layers)
+            if not load_vllm and prefix_cache_mb > 0:
+                self.model.load_prefix_cache(prefix_cache_mb)
         if load_trt:
             if self.fp16 is True:
                 logging.warning('DiT tensorRT fp16 engine have some performance issue, use at caution!')
-            self.model.load_trt('{}/flow.decoder.estimator.{}.mygpu.plan'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
-                                '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
-                                trt_concurrent,
-                                self.fp16)
+            with self.startup_timer.phase('trt'):
+                self.model.load_trt('{}/flow.decoder.estimator.{}.mygpu.plan'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
+                                    '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
+                                    trt_concurrent,
+                                    self.fp16)
+        self.frontend = frontend.result()
+        executor.shutdown()
         del configs
+        logging.info(self.startup_timer.report())
 
 
 def AutoModel(**kwargs):
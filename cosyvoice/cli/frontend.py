@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from typing import Generator
 import json
@@ -32,7 +33,8 @@ except ImportError:
     from wetext import Normalizer as ZhNormalizer
     from wetext import Normalizer as EnNormalizer
     use_ttsfrd = False
-from cosyvoice.utils.file_utils import logging, load_wav
+from cosyvoice.utils.file_utils import logging, load_prompt_audio
+from cosyvoice.utils.prompt_cache import PromptCache
 from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph, is_only_punctuation
 
 
@@ -51,15 +53,19 @@ class CosyVoiceFrontEnd:
         option = onnxruntime.SessionOptions()
         option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
         option.intra_op_num_threads = 1
-        self.campplus_session = onnxruntime.InferenceSession(campplus_model, sess_options=option, providers=["CPUExecutionProvider"])
-        self.speech_tokenizer_session = onnxruntime.InferenceSession(speech_tokenizer_model, sess_options=option,
-                                                                     providers=["CUDAExecutionProvider" if torch.cuda.is_available() else
-                                                                                "CPUExecutionProvider"])
+        # NOTE building onnx sessions releases the gil, build them in parallel with each other and the rest of the frontend
+        executor = ThreadPoolExecutor(max_workers=2)
+        campplus_session = executor.submit(onnxruntime.InferenceSession, campplus_model, sess_options=option, providers=["CPUExecutionProvider"])
+        speech_tokenizer_session = executor.submit(onnxruntime.InferenceSession, speech_tokenizer_model, sess_options=option,
+                                                   providers=["CUDAExecutionProvider" if torch.cuda.is_available() else "CPUExecutionProvider"])
         if os.path.exists(spk2info):
             self.spk2info = torch.load(spk2info, map_location=self.device)
         else:
             self.spk2info = {}
         self.allowed_special = allowed_special
+        # cache of prompt wav related features, replace it to enable disk tier or change memory budget
+        self.prompt_cache = PromptCache()
+        self.prompt_model_id = PromptCache.model_id(self.tokenizer, speech_tokenizer_model, campplus_model)
         self.use_ttsfrd = use_ttsfrd
         if self.use_ttsfrd:
             self.frd = ttsfrd.TtsFrontendEngine()
@@ -71,6 +77,8 @@ class CosyVoiceFrontEnd:
             self.zh_tn_model = ZhNormalizer(remove_erhua=False)
             self.en_tn_model = EnNormalizer()
             self.inflect_parser = inflect.engine()
+        self.campplus_session, self.speech_tokenizer_session = campplus_session.result(), speech_tokenizer_session.result()
+        executor.shutdown()
 
     def _extract_text_token(self, text):
         if isinstance(text, Generator):
@@ -90,7 +98,7 @@ class CosyVoiceFrontEnd:
                 yield text_token[:, i: i + 1]
 
     def _extract_speech_token(self, prompt_wav):
-        speech = load_wav(prompt_wav, 16000)
+        speech = load_prompt_audio(prompt_wav).resample(16000)
         assert speech.shape[1] / 16000 <= 30, 'do not support extract speech token for audio longer than 30s'
         feat = whisper.log_mel_spectrogram(speech, n_mels=128)
         speech_token = self.speech_tokenizer_session.run(None,
@@ -103,7 +111,7 @@ class CosyVoiceFrontEnd:
         return speech_token, speech_token_len
 
     def _extract_spk_embedding(self, prompt_wav):
-        speech = load_wav(prompt_wav, 16000)
+        speech = load_prompt_audio(prompt_wav).resample(16000)
         feat = kaldi.fbank(speech,
                            num_mel_bins=80,
                            dither=0,
@@ -115,7 +123,7 @@ class CosyVoiceFrontEnd:
         return embedding
 
     def _extract_speech_feat(self, prompt_wav):
-        speech = load_wav(prompt_wav, 24000)
+        speech = load_prompt_audio(prompt_wav).resample(24000)
         speech_feat = self.feat_extractor(speech).squeeze(dim=0).transpose(0, 1).to(self.device)
         speech_feat = speech_feat.unsqueeze(dim=0)
         speech_feat_len = torch.tensor([speech_feat.shape[1]], dtype=torch.int32).to(self.device)
@@ -163,20 +171,31 @@ class CosyVoiceFrontEnd:
     def frontend_zero_shot(self, tts_text, prompt_text, prompt_wav, resample_rate, zero_shot_spk_id):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
         if zero_shot_spk_id == '':
-            prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
-            speech_feat, speech_feat_len = self._extract_speech_feat(prompt_wav)
-            speech_token, speech_token_len = self._extract_speech_token(prompt_wav)
-            if resample_rate == 24000:
-                # cosyvoice2, force speech_feat % speech_token = 2
-                token_len = min(int(speech_feat.shape[1] / 2), speech_token.shape[1])
-                speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
-                speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
-            embedding = self._extract_spk_embedding(prompt_wav)
-            model_input = {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
-                           'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
-                           'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
-                           'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
-                           'llm_embedding': embedding, 'flow_embedding': embedding}
+            # NOTE decode prompt wav only once, all extractors share its resampled views
+            prompt_wav = load_prompt_audio(prompt_wav)
+            prompt_key = self.prompt_cache.key(prompt_wav, prompt_text, resample_rate, self.prompt_model_id)
+            prompt_input = self.prompt_cache.get(prompt_key, self.device)
+            if prompt_input is None:
+                prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
+                speech_feat, speech_feat_len = self._extract_speech_feat(prompt_wav)
+                speech_token, speech_token_len = self._extract_speech_token(prompt_wav)
+                if resample_rate == 24000:
+                    # cosyvoice2, force speech_feat % speech_token = 2
+                    token_len = min(int(speech_feat.shape[1] / 2), speech_token.shape[1])
+                    speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
+                    speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
+                embedding = self._extract_spk_embedding(prompt_wav)
+                prompt_input = {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
+                                'speech_token': speech_token, 'speech_token_len': speech_token_len,
+                                'speech_feat': speech_feat, 'speech_feat_len': speech_feat_len,
+                                'embedding': embedding}
+                self.prompt_cache.put(prompt_key, prompt_input)
+            # NOTE build a new dict every time, callers delete keys from model_input
+            model_input = {'prompt_text': prompt_input['prompt_text'], 'prompt_text_len': prompt_input['prompt_text_len'],
+                           'llm_prompt_speech_token': prompt_input['speech_token'], 'llm_prompt_speech_token_len': prompt_input['speech_token_len'],
+                           'flow_prompt_speech_token': prompt_input['speech_token'], 'flow_prompt_speech_token_len': prompt_input['speech_token_len'],
+                           'prompt_speech_feat': prompt_input['speech_feat'], 'prompt_speech_feat_len': prompt_input['speech_feat_len'],
+                           'llm_embedding': prompt_input['embedding'], 'flow_embedding': prompt_input['embedding']}
         else:
             model_input = self.spk2info[zero_shot_spk_id]
         model_input['text'] = tts_text_token
@@ -208,6 +227,7 @@ class CosyVoiceFrontEnd:
         return model_input
 
     def frontend_vc(self, source_speech_16k, prompt_wav, resample_rate):
+        prompt_wav = load_prompt_audio(prompt_wav)
         prompt_speech_token, prompt_speech_token_len = self._extract_speech_token(prompt_wav)
         prompt_speech_feat, prompt_speech_feat_len = self._extract_speech_feat(prompt_wav)
         embedding = self._extract_spk_embedding(prompt_wav)
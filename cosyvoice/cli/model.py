@@ -17,13 +17,14 @@ from typing import Generator
 import torch
 import numpy as np
 import threading
-import time
 from torch.nn import functional as F
 from contextlib import nullcontext
 import uuid
 from cosyvoice.utils.common import fade_in_out
-from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm
-from cosyvoice.utils.common import TrtContextWrapper
+from cosyvoice.utils.file_utils import export_cosyvoice2_vllm, load_checkpoint, load_module_state_dict
+from cosyvoice.utils.trt_cache import TrtEngineCache
+from cosyvoice.utils.common import TrtContextWrapper, TokenChannel, MicroBatcher, CancelToken, StartupTimer
+from cosyvoice.utils.quantize import load_quant_config, prepare_quantized, init_quantized_kernels, is_quantized
 
 
 class CosyVoiceModel:
@@ -52,24 +53,39 @@ class CosyVoiceModel:
         # rtf and decoding related
         self.stream_scale_factor = 1
         assert self.stream_scale_factor >= 1, 'stream_scale_factor should be greater than 1, change it according to your actual rtf'
+        # flow matching steps, can be overridden per request by tts(n_timesteps=..., first_chunk_n_timesteps=...)
+        self.n_timesteps = 5
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
         self.lock = threading.Lock()
         # dict used to store session related variable
         self.tts_speech_token_dict = {}
-        self.llm_end_dict = {}
         self.mel_overlap_dict = {}
         self.flow_cache_dict = {}
         self.hift_cache_dict = {}
+        self.session_dict = {}
 
-    def load(self, llm_model, flow_model, hift_model):
-        self.llm.load_state_dict(torch.load(llm_model, map_location=self.device), strict=True)
-        self.llm.to(self.device).eval()
-        self.flow.load_state_dict(torch.load(flow_model, map_location=self.device), strict=True)
-        self.flow.to(self.device).eval()
-        # in case hift_model is a hifigan model
-        hift_state_dict = {k.replace('generator.', ''): v for k, v in torch.load(hift_model, map_location=self.device).items()}
-        self.hift.load_state_dict(hift_state_dict, strict=True)
-        self.hift.to(self.device).eval()
+    def load(self, llm_model, flow_model, hift_model, timer=None):
+        # NOTE modules built under init_empty_weights take the loaded tensors, the others copy them as before
+        timer = timer if timer is not None else StartupTimer()
+        # quantization.json is written by quantize_model.py/simple_quantize.py, llm.pt/flow.pt then store int8/int4 weights
+        quant_config = load_quant_config(os.path.dirname(llm_model))
+        with timer.phase('llm'):
+            if 'llm' in quant_config:
+                prepare_quantized(self.llm, quant_config['llm'])
+            load_module_state_dict(self.llm, load_checkpoint(llm_model, self.device))
+            self.llm.to(self.device).eval()
+            init_quantized_kernels(self.llm)
+        with timer.phase('flow'):
+            if 'flow' in quant_config:
+                prepare_quantized(self.flow, quant_config['flow'])
+            load_module_state_dict(self.flow, load_checkpoint(flow_model, self.device))
+            self.flow.to(self.device).eval()
+            init_quantized_kernels(self.flow)
+        with timer.phase('hift'):
+            # in case hift_model is a hifigan model
+            hift_state_dict = {k.replace('generator.', ''): v for k, v in load_checkpoint(hift_model, self.device).items()}
+            load_module_state_dict(self.hift, hift_state_dict)
+            self.hift.to(self.device).eval()
 
     def load_jit(self, llm_text_encoder_model, llm_llm_model, flow_encoder_model):
         llm_text_encoder = torch.jit.load(llm_text_encoder_model, map_location=self.device)
@@ -81,8 +97,8 @@ class CosyVoiceModel:
 
     def load_trt(self, flow_decoder_estimator_model, flow_decoder_onnx_model, trt_concurrent, fp16):
         assert torch.cuda.is_available(), 'tensorrt only supports gpu!'
-        if not os.path.exists(flow_decoder_estimator_model) or os.path.getsize(flow_decoder_estimator_model) == 0:
-            convert_onnx_to_trt(flow_decoder_estimator_model, self.get_trt_kwargs(), flow_decoder_onnx_model, fp16)
+        # NOTE the plan actually loaded is keyed on onnx, tensorrt version, gpu, precision and profiles, it is rebuilt when any changes
+        flow_decoder_estimator_model = TrtEngineCache().get(flow_decoder_estimator_model, flow_decoder_onnx_model, self.get_trt_kwargs(), fp16)
         del self.flow.decoder.estimator
         import tensorrt as trt
         with open(flow_decoder_estimator_model, 'rb') as f:
@@ -91,40 +107,138 @@ class CosyVoiceModel:
         self.flow.decoder.estimator = TrtContextWrapper(estimator_engine, trt_concurrent=trt_concurrent, device=self.device)
 
     def get_trt_kwargs(self):
-        min_shape = [(2, 80, 4), (2, 1, 4), (2, 80, 4), (2, 80, 4)]
-        opt_shape = [(2, 80, 500), (2, 1, 500), (2, 80, 500), (2, 80, 500)]
-        max_shape = [(2, 80, 3000), (2, 1, 3000), (2, 80, 3000), (2, 80, 3000)]
-        input_names = ["x", "mask", "mu", "cond"]
-        return {'min_shape': min_shape, 'opt_shape': opt_shape, 'max_shape': max_shape, 'input_names': input_names}
-
-    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid):
-        with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
-            if isinstance(text, Generator):
-                assert isinstance(self, CosyVoice2Model) and not hasattr(self.llm, 'vllm'), 'streaming input text is only implemented for CosyVoice2 and do not support vllm!'
-                for i in self.llm.inference_bistream(text=text,
-                                                     prompt_text=prompt_text.to(self.device),
-                                                     prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
-                                                     prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                                                     prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                                     embedding=llm_embedding.to(self.device)):
-                    self.tts_speech_token_dict[uuid].append(i)
-            else:
-                for i in self.llm.inference(text=text.to(self.device),
-                                            text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
-                                            prompt_text=prompt_text.to(self.device),
-                                            prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
-                                            prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                                            prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                            embedding=llm_embedding.to(self.device),
-                                            uuid=uuid):
-                    self.tts_speech_token_dict[uuid].append(i)
-        self.llm_end_dict[uuid] = True
+        # NOTE batch 1 runs the conditional half only (cfg_rate=0 or cfg_interval>1), batch 2 is classifier free guidance
+        # profile 0 is tuned for short inputs, e.g. streaming chunks, profile 1 for long offline utterances,
+        # each estimator call runs on the first profile which fits its shape
+        input_names = ["x", "mask", "mu", "t", "spks", "cond"]
+        profiles = []
+        for opt_len, max_len in [(200, 500), (1000, 3000)]:
+            profiles.append({'min_shape': [(1, 80, 4), (1, 1, 4), (1, 80, 4), (1,), (1, 80), (1, 80, 4)],
+                             'opt_shape': [(2, 80, opt_len), (2, 1, opt_len), (2, 80, opt_len), (2,), (2, 80), (2, 80, opt_len)],
+                             'max_shape': [(2, 80, max_len), (2, 1, max_len), (2, 80, max_len), (2,), (2, 80), (2, 80, max_len)]})
+        return {'input_names': input_names, 'profiles': profiles}
+
+    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid, speculative=False):
+        try:
+            with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
+                if isinstance(text, Generator):
+                    assert isinstance(self, CosyVoice2Model) and not hasattr(self.llm, 'vllm'), 'streaming input text is only implemented for CosyVoice2 and do not support vllm!'
+                    token_generator = self.llm.inference_bistream(text=text,
+                                                                  prompt_text=prompt_text.to(self.device),
+                                                                  prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                                                                  prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                                                  prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                                  embedding=llm_embedding.to(self.device))
+                else:
+                    token_generator = self.llm.inference(text=text.to(self.device),
+                                                         text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
+                                                         prompt_text=prompt_text.to(self.device),
+                                                         prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                                                         prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                                         prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                         embedding=llm_embedding.to(self.device),
+                                                         uuid=uuid,
+                                                         speculative=speculative)
+                try:
+                    for i in token_generator:
+                        if self.tts_speech_token_dict[uuid].cancelled is True:
+                            break
+                        self.tts_speech_token_dict[uuid].put(i)
+                finally:
+                    # NOTE close in this thread, so that a cancelled session leaves vllm/batch scheduler right away
+                    token_generator.close()
+        except Exception as e:
+            # NOTE propagate llm error to token2wav consumer, otherwise it waits forever
+            self.tts_speech_token_dict[uuid].close(error=e)
+            raise
+        self.tts_speech_token_dict[uuid].close()
 
     def vc_job(self, source_speech_token, uuid):
-        self.tts_speech_token_dict[uuid] = source_speech_token.flatten().tolist()
-        self.llm_end_dict[uuid] = True
+        self.tts_speech_token_dict[uuid].put(source_speech_token.flatten().tolist())
+        self.tts_speech_token_dict[uuid].close()
+
+    def start_session(self, text=torch.zeros(1, 0, dtype=torch.int32), llm_embedding=torch.zeros(0, 192), prompt_text=torch.zeros(1, 0, dtype=torch.int32),
+                      llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32), source_speech_token=torch.zeros(1, 0, dtype=torch.int32),
+                      speculative=False, cancel_token=None, **kwargs):
+        """Create session variables and start generating its speech tokens in background.
+
+        tts(session=...) consumes the tokens later, so the llm of a session can run ahead of its flow and hift.
+        Cancelling cancel_token stops the llm_job and frees flow/hift caches of the session right away.
+
+        Returns:
+            session dict, released by tts or release_session
+        """
+        # this_uuid is used to track variables related to this inference thread
+        this_uuid = str(uuid.uuid1())
+        self.init_session(this_uuid)
+        if source_speech_token.shape[1] == 0:
+            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid, speculative))
+        else:
+            p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
+        # busy is True while token2wav of the session runs, its caches are then freed by token2wav instead of cancel
+        session = {'uuid': this_uuid, 'thread': p, 'cancel_token': CancelToken() if cancel_token is None else cancel_token, 'busy': False}
+        with self.lock:
+            self.session_dict[this_uuid] = session
+        p.start()
+        session['cancel_token'].add_callback(lambda: self.on_cancel(session))
+        return session
+
+    def init_session(self, this_uuid):
+        with self.lock:
+            self.tts_speech_token_dict[this_uuid] = TokenChannel()
+            self.hift_cache_dict[this_uuid] = None
+            self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0)
+            self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2)
+
+    def free_session_cache(self, this_uuid):
+        # NOTE called with self.lock held
+        self.mel_overlap_dict.pop(this_uuid, None)
+        self.hift_cache_dict.pop(this_uuid, None)
+        self.flow_cache_dict.pop(this_uuid, None)
+
+    def cancel_session(self, session):
+        session['cancel_token'].cancel()
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0):
+    def on_cancel(self, session):
+        with self.lock:
+            if session['uuid'] not in self.session_dict:
+                return
+            self.tts_speech_token_dict[session['uuid']].cancel()
+            if session['busy'] is False:
+                self.free_session_cache(session['uuid'])
+
+    def release_session(self, session):
+        session['thread'].join()
+        with self.lock:
+            self.session_dict.pop(session['uuid'], None)
+            self.tts_speech_token_dict.pop(session['uuid'], None)
+            self.free_session_cache(session['uuid'])
+
+    def session_stats(self):
+        """Number of sessions, leaked ones are cancelled and their llm_job has stopped, but the tts generator
+        which owns them was dropped without being closed, so only release_session frees them."""
+        with self.lock:
+            sessions = list(self.session_dict.values())
+        cancelled = [i for i in sessions if i['cancel_token'].cancelled is True]
+        leaked = [i for i in cancelled if i['thread'].is_alive() is False and i['busy'] is False]
+        return {'active': len(sessions) - len(cancelled), 'cancelled': len(cancelled), 'leaked': len(leaked)}
+
+    def session_token2wav(self, session, **kwargs):
+        """token2wav of one chunk of session, returns None if the session is cancelled."""
+        with self.lock:
+            if session['cancel_token'].cancelled is True:
+                return None
+            session['busy'] = True
+        try:
+            return self.token2wav(uuid=session['uuid'], **kwargs)
+        finally:
+            with self.lock:
+                session['busy'] = False
+                if session['cancel_token'].cancelled is True:
+                    self.free_session_cache(session['uuid'])
+
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0, n_timesteps=None):
+        n_timesteps = self.n_timesteps if n_timesteps is None else n_timesteps
         with torch.cuda.amp.autocast(self.fp16):
             tts_mel, self.flow_cache_dict[uuid] = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
                                                                       token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
@@ -133,7 +247,8 @@ class CosyVoiceModel:
                                                                       prompt_feat=prompt_feat.to(self.device),
                                                                       prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
                                                                       embedding=embedding.to(self.device),
-                                                                      flow_cache=self.flow_cache_dict[uuid])
+                                                                      flow_cache=self.flow_cache_dict[uuid],
+                                                                      n_timesteps=n_timesteps)
 
         # mel overlap fade in out
         if self.mel_overlap_dict[uuid].shape[2] != 0:
@@ -168,67 +283,65 @@ class CosyVoiceModel:
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
-        # this_uuid is used to track variables related to this inference thread
-        this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
-            self.hift_cache_dict[this_uuid] = None
-            self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0)
-            self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2)
-        if source_speech_token.shape[1] == 0:
-            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
-        else:
-            p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
-        p.start()
-        if stream is True:
-            token_hop_len = self.token_min_hop_len
-            while True:
-                time.sleep(0.1)
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
-                        .unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                                     prompt_token=flow_prompt_speech_token,
-                                                     prompt_feat=prompt_speech_feat,
-                                                     embedding=flow_embedding,
-                                                     uuid=this_uuid,
-                                                     finalize=False)
+            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0,
+            n_timesteps=None, first_chunk_n_timesteps=None, session=None, cancel_token=None, **kwargs):
+        # NOTE fewer flow matching steps for the first chunk cuts time to first audio
+        n_timesteps = self.n_timesteps if n_timesteps is None else n_timesteps
+        first_chunk_n_timesteps = n_timesteps if first_chunk_n_timesteps is None else first_chunk_n_timesteps
+        if session is None:
+            session = self.start_session(text=text, llm_embedding=llm_embedding, prompt_text=prompt_text, llm_prompt_speech_token=llm_prompt_speech_token,
+                                         source_speech_token=source_speech_token, cancel_token=cancel_token)
+        this_uuid, p = session['uuid'], session['thread']
+        try:
+            if stream is True:
+                token_hop_len = self.token_min_hop_len
+                this_n_timesteps = first_chunk_n_timesteps
+                while self.tts_speech_token_dict[this_uuid].wait(token_hop_len + self.token_overlap_len) is True:
+                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid].get(0, token_hop_len + self.token_overlap_len)).unsqueeze(dim=0)
+                    this_tts_speech = self.session_token2wav(session, token=this_tts_speech_token,
+                                                             prompt_token=flow_prompt_speech_token,
+                                                             prompt_feat=prompt_speech_feat,
+                                                             embedding=flow_embedding,
+                                                             finalize=False,
+                                                             n_timesteps=this_n_timesteps)
+                    if this_tts_speech is None:
+                        return
+                    this_n_timesteps = n_timesteps
                     yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
+                    self.tts_speech_token_dict[this_uuid].pop(token_hop_len)
                     # increase token_hop_len for better speech quality
                     token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
-            self.flow_cache_dict.pop(this_uuid)
+                p.join()
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid].get()).unsqueeze(dim=0)
+                this_tts_speech = self.session_token2wav(session, token=this_tts_speech_token,
+                                                         prompt_token=flow_prompt_speech_token,
+                                                         prompt_feat=prompt_speech_feat,
+                                                         embedding=flow_embedding,
+                                                         finalize=True,
+                                                         n_timesteps=this_n_timesteps)
+                if this_tts_speech is None:
+                    return
+                yield {'tts_speech': this_tts_speech.cpu()}
+            else:
+                # deal with all tokens
+                p.join()
+                self.tts_speech_token_dict[this_uuid].wait()
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid].get()).unsqueeze(dim=0)
+                this_tts_speech = self.session_token2wav(session, token=this_tts_speech_token,
+                                                         prompt_token=flow_prompt_speech_token,
+                                                         prompt_feat=prompt_speech_feat,
+                                                         embedding=flow_embedding,
+                                                         finalize=True,
+                                                         speed=speed,
+                                                         n_timesteps=n_timesteps)
+                if this_tts_speech is None:
+                    return
+                yield {'tts_speech': this_tts_speech.cpu()}
+        finally:
+            # NOTE stop llm_job as soon as the consumer stops iterating, e.g. client disconnects
+            self.tts_speech_token_dict[this_uuid].cancel()
+            self.release_session(session)
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.current_stream().synchronize()
@@ -248,6 +361,12 @@ class CosyVoice2Model(CosyVoiceModel):
         self.fp16 = fp16
         # NOTE must matching training static_chunk_size
         self.token_hop_len = 25
+        # flow matching steps, can be overridden per request by tts(n_timesteps=..., first_chunk_n_timesteps=...)
+        self.n_timesteps = 10
+        # classifier free guidance of flow matching, None means inference_cfg_rate of the flow config,
+        # cfg_rate=0 skips the unconditional half of the batch, cfg_interval=k evaluates it every k estimator calls
+        self.cfg_rate = None
+        self.cfg_interval = 1
         # hift cache
         self.mel_cache_len = 8
         self.source_cache_len = int(self.mel_cache_len * 480)
@@ -258,36 +377,133 @@ class CosyVoice2Model(CosyVoiceModel):
         self.lock = threading.Lock()
         # dict used to store session related variable
         self.tts_speech_token_dict = {}
-        self.llm_end_dict = {}
+        self.flow_cache_dict = {}
         self.hift_cache_dict = {}
+        self.session_dict = {}
 
     def load_jit(self, flow_encoder_model):
         flow_encoder = torch.jit.load(flow_encoder_model, map_location=self.device)
         self.flow.encoder = flow_encoder
 
     def load_vllm(self, model_dir):
+        assert not is_quantized(self.llm), 'vllm does not support int8/int4 weight-only quantized llm'
         export_cosyvoice2_vllm(self.llm, model_dir, self.device)
         from vllm import EngineArgs, LLMEngine
+        from cosyvoice.llm.vllm_driver import VllmEngineDriver
         engine_args = EngineArgs(model=model_dir,
                                  skip_tokenizer_init=True,
                                  enable_prompt_embeds=True,
                                  gpu_memory_utilization=0.2)
-        self.llm.vllm = LLMEngine.from_engine_args(engine_args)
-        self.llm.lock = threading.Lock()
+        self.llm.vllm = VllmEngineDriver(LLMEngine.from_engine_args(engine_args))
         del self.llm.llm.model.model.layers
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
+    def load_batch_scheduler(self, max_batch_size):
+        from cosyvoice.llm.batch_scheduler import Qwen2LMBatchScheduler
+        if hasattr(self.llm, 'batch_scheduler'):
+            self.llm.batch_scheduler.stop()
+        self.llm.batch_scheduler = Qwen2LMBatchScheduler(self.llm, max_batch_size=max_batch_size, fp16=self.fp16)
+
+    def load_speculative(self, num_draft_tokens=4, draft_layers=0):
+        from cosyvoice.llm.speculative import NgramDraft, LayerSkipDraft
+        assert not hasattr(self.llm, 'vllm'), 'speculative decoding does not support vllm'
+        self.llm.draft = LayerSkipDraft(self.llm, draft_layers, num_draft_tokens) if draft_layers > 0 else NgramDraft(num_draft_tokens)
+
+    def load_prefix_cache(self, max_mb=64):
+        from cosyvoice.llm.prefix_cache import PrefixKVCache
+        assert not hasattr(self.llm, 'vllm'), 'prompt prefix kv cache does not support vllm'
+        self.llm.prefix_cache = PrefixKVCache(max_bytes=max_mb * 1024 * 1024)
+
+    def load_flow_batcher(self, max_batch_size, max_wait_ms=5):
+        assert isinstance(self.flow.decoder.estimator, torch.nn.Module), 'batched flow inference does not support tensorrt estimator, its profile has fixed batch 2'
+        self.flow_batcher = MicroBatcher(self.flow_batch_job, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+
+    def flow_batch_job(self, requests):
+        # sessions can share one decoder call only when streaming/finalize/n_timesteps/guidance are the same
+        groups = {}
+        for i, request in enumerate(requests):
+            groups.setdefault((request['streaming'], request['finalize'], request['n_timesteps'], request['cfg_rate'], request['cfg_interval']), []).append(i)
+        tts_mels = [None] * len(requests)
         with torch.cuda.amp.autocast(self.fp16):
-            tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
-                                             token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_token=prompt_token.to(self.device),
-                                             prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_feat=prompt_feat.to(self.device),
-                                             prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                             embedding=embedding.to(self.device),
-                                             streaming=stream,
-                                             finalize=finalize)
-        tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
+            for (streaming, finalize, n_timesteps, cfg_rate, cfg_interval), index in groups.items():
+                this_tts_mels = self.flow.inference_batch(token=[requests[i]['token'] for i in index],
+                                                          prompt_token=[requests[i]['prompt_token'] for i in index],
+                                                          prompt_feat=[requests[i]['prompt_feat'] for i in index],
+                                                          embedding=torch.concat([requests[i]['embedding'] for i in index], dim=0),
+                                                          streaming=streaming,
+                                                          finalize=finalize,
+                                                          n_timesteps=n_timesteps,
+                                                          cfg_rate=cfg_rate,
+                                                          cfg_interval=cfg_interval)
+                for i, tts_mel in zip(index, this_tts_mels):
+                    tts_mels[i] = tts_mel
+        return tts_mels
+
+    def load_hift_batcher(self, max_batch_size, max_wait_ms=5):
+        from cosyvoice.hifigan.generator import CausalHiFTGenerator
+        assert not isinstance(self.hift, CausalHiFTGenerator), 'batched vocoder does not support CausalHiFTGenerator, use its stateful inference_chunk'
+        self.hift_batcher = MicroBatcher(self.hift_batch_job, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+
+    def hift_batch_job(self, requests):
+        return self.hift.inference_batch(speech_feats=[request['speech_feat'] for request in requests],
+                                         cache_sources=[request['cache_source'] for request in requests])
+
+    def hift_inference(self, speech_feat, cache_source):
+        if hasattr(self, 'hift_batcher'):
+            # NOTE vocoded together with other sessions which have mel ready at the same time
+            return self.hift_batcher.submit(speech_feat=speech_feat, cache_source=cache_source)
+        return self.hift.inference(speech_feat=speech_feat, cache_source=cache_source)
+
+    def flow_chunk_supported(self):
+        # NOTE incremental streaming flow needs forward_chunk of the torch encoder and estimator, jit encoder and trt estimator recompute the prefix
+        encoder = getattr(self.flow, 'encoder', None)
+        return hasattr(self.flow.decoder.estimator, 'forward_chunk') and (encoder is None or hasattr(encoder, 'forward_chunk'))
+
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0, n_timesteps=None,
+                  cfg_rate=None, cfg_interval=None):
+        n_timesteps = self.n_timesteps if n_timesteps is None else n_timesteps
+        cfg_rate = self.cfg_rate if cfg_rate is None else cfg_rate
+        cfg_interval = self.cfg_interval if cfg_interval is None else cfg_interval
+        if hasattr(self, 'flow_batcher'):
+            # NOTE decoded together with other sessions which have a chunk ready at the same time
+            tts_mel = self.flow_batcher.submit(token=token.to(self.device, dtype=torch.int32),
+                                               prompt_token=prompt_token.to(self.device),
+                                               prompt_feat=prompt_feat.to(self.device),
+                                               embedding=embedding.to(self.device),
+                                               streaming=stream,
+                                               finalize=finalize,
+                                               n_timesteps=n_timesteps,
+                                               cfg_rate=cfg_rate,
+                                               cfg_interval=cfg_interval)
+            tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
+        elif stream is True and self.flow_chunk_supported():
+            with torch.cuda.amp.autocast(self.fp16):
+                # NOTE incremental streaming inference, only tokens after token_offset are computed
+                tts_mel, self.flow_cache_dict[uuid] = self.flow.inference_chunk(token=token[:, token_offset:].to(self.device, dtype=torch.int32),
+                                                                                prompt_token=prompt_token.to(self.device),
+                                                                                prompt_feat=prompt_feat.to(self.device),
+                                                                                embedding=embedding.to(self.device),
+                                                                                finalize=finalize,
+                                                                                flow_cache=self.flow_cache_dict[uuid],
+                                                                                n_timesteps=n_timesteps,
+                                                                                cfg_rate=cfg_rate,
+                                                                                cfg_interval=cfg_interval)
+        else:
+            # NOTE the last chunk is decoded with full attention over all tokens, the incremental cache is not needed any more
+            self.flow_cache_dict[uuid] = None
+            with torch.cuda.amp.autocast(self.fp16):
+                tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
+                                                 token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                                                 prompt_token=prompt_token.to(self.device),
+                                                 prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                 prompt_feat=prompt_feat.to(self.device),
+                                                 prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                                                 embedding=embedding.to(self.device),
+                                                 streaming=stream,
+                                                 finalize=finalize,
+                                                 n_timesteps=n_timesteps,
+                                                 cfg_rate=cfg_rate,
+                                                 cfg_interval=cfg_interval)
+            tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
         # append hift cache
         if self.hift_cache_dict[uuid] is not None:
             hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
@@ -296,7 +512,7 @@ class CosyVoice2Model(CosyVoiceModel):
             hift_cache_source = torch.zeros(1, 1, 0)
         # keep overlap mel and hift cache
         if finalize is False:
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+            tts_speech, tts_source = self.hift_inference(tts_mel, hift_cache_source)
             if self.hift_cache_dict[uuid] is not None:
                 tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
             self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
@@ -307,74 +523,90 @@ class CosyVoice2Model(CosyVoiceModel):
             if speed != 1.0:
                 assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+            tts_speech, tts_source = self.hift_inference(tts_mel, hift_cache_source)
             if self.hift_cache_dict[uuid] is not None:
                 tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
         return tts_speech
 
+    def init_session(self, this_uuid):
+        with self.lock:
+            self.tts_speech_token_dict[this_uuid] = TokenChannel()
+            self.flow_cache_dict[this_uuid] = None
+            self.hift_cache_dict[this_uuid] = None
+
+    def free_session_cache(self, this_uuid):
+        # NOTE called with self.lock held
+        self.flow_cache_dict.pop(this_uuid, None)
+        self.hift_cache_dict.pop(this_uuid, None)
+
     def tts(self, text=torch.zeros(1, 0, dtype=torch.int32), flow_embedding=torch.zeros(0, 192), llm_embedding=torch.zeros(0, 192),
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
-        # this_uuid is used to track variables related to this inference thread
-        this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
-            self.hift_cache_dict[this_uuid] = None
-        if source_speech_token.shape[1] == 0:
-            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
-        else:
-            p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
-        p.start()
-        if stream is True:
-            token_offset = 0
-            prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
-            while True:
-                time.sleep(0.1)
-                this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
-                if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]).unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                                     prompt_token=flow_prompt_speech_token,
-                                                     prompt_feat=prompt_speech_feat,
-                                                     embedding=flow_embedding,
-                                                     token_offset=token_offset,
-                                                     uuid=this_uuid,
-                                                     stream=stream,
-                                                     finalize=False)
+            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0,
+            speculative=False, n_timesteps=None, first_chunk_n_timesteps=None, session=None, cancel_token=None, **kwargs):
+        # NOTE fewer flow matching steps for the first chunk cuts time to first audio
+        n_timesteps = self.n_timesteps if n_timesteps is None else n_timesteps
+        first_chunk_n_timesteps = n_timesteps if first_chunk_n_timesteps is None else first_chunk_n_timesteps
+        if session is None:
+            session = self.start_session(text=text, llm_embedding=llm_embedding, prompt_text=prompt_text, llm_prompt_speech_token=llm_prompt_speech_token,
+                                         source_speech_token=source_speech_token, speculative=speculative, cancel_token=cancel_token)
+        this_uuid, p = session['uuid'], session['thread']
+        try:
+            if stream is True:
+                token_offset = 0
+                prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
+                while True:
+                    this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
+                    if self.tts_speech_token_dict[this_uuid].wait(token_offset + this_token_hop_len + self.flow.pre_lookahead_len) is False:
+                        break
+                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid].get(0, token_offset + this_token_hop_len +
+                                                                                                   self.flow.pre_lookahead_len)).unsqueeze(dim=0)
+                    this_tts_speech = self.session_token2wav(session, token=this_tts_speech_token,
+                                                             prompt_token=flow_prompt_speech_token,
+                                                             prompt_feat=prompt_speech_feat,
+                                                             embedding=flow_embedding,
+                                                             token_offset=token_offset,
+                                                             stream=stream,
+                                                             finalize=False,
+                                                             n_timesteps=first_chunk_n_timesteps if token_offset == 0 else n_timesteps)
+                    if this_tts_speech is None:
+                        return
                     token_offset += this_token_hop_len
                     yield {'tts_speech': this_tts_speech.cpu()}
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=token_offset,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=0,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
+                p.join()
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid].get()).unsqueeze(dim=0)
+                this_tts_speech = self.session_token2wav(session, token=this_tts_speech_token,
+                                                         prompt_token=flow_prompt_speech_token,
+                                                         prompt_feat=prompt_speech_feat,
+                                                         embedding=flow_embedding,
+                                                         token_offset=token_offset,
+                                                         finalize=True,
+                                                         n_timesteps=first_chunk_n_timesteps if token_offset == 0 else n_timesteps)
+                if this_tts_speech is None:
+                    return
+                yield {'tts_speech': this_tts_speech.cpu()}
+            else:
+                # deal with all tokens
+                p.join()
+                self.tts_speech_token_dict[this_uuid].wait()
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid].get()).unsqueeze(dim=0)
+                this_tts_speech = self.session_token2wav(session, token=this_tts_speech_token,
+                                                         prompt_token=flow_prompt_speech_token,
+                                                         prompt_feat=prompt_speech_feat,
+                                                         embedding=flow_embedding,
+                                                         token_offset=0,
+                                                         finalize=True,
+                                                         speed=speed,
+                                                         n_timesteps=n_timesteps)
+                if this_tts_speech is None:
+                    return
+                yield {'tts_speech': this_tts_speech.cpu()}
+        finally:
+            # NOTE stop llm_job as soon as the consumer stops iterating, e.g. client disconnects
+            self.tts_speech_token_dict[this_uuid].cancel()
+            self.release_session(session)
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.current_stream().synchronize()
@@ -394,37 +626,57 @@ class CosyVoice3Model(CosyVoice2Model):
         self.fp16 = fp16
         # NOTE must matching training static_chunk_size
         self.token_hop_len = 25
+        # flow matching steps, can be overridden per request by tts(n_timesteps=..., first_chunk_n_timesteps=...)
+        self.n_timesteps = 10
+        # classifier free guidance of flow matching, None means inference_cfg_rate of the flow config,
+        # cfg_rate=0 skips the unconditional half of the batch, cfg_interval=k evaluates it every k estimator calls
+        self.cfg_rate = None
+        self.cfg_interval = 1
         # rtf and decoding related
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
         self.lock = threading.Lock()
         # dict used to store session related variable
         self.tts_speech_token_dict = {}
-        self.llm_end_dict = {}
+        self.flow_cache_dict = {}
         self.hift_cache_dict = {}
+        self.session_dict = {}
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0, n_timesteps=None,
+                  cfg_rate=None, cfg_interval=None):
+        n_timesteps = self.n_timesteps if n_timesteps is None else n_timesteps
+        cfg_rate = self.cfg_rate if cfg_rate is None else cfg_rate
+        cfg_interval = self.cfg_interval if cfg_interval is None else cfg_interval
         with torch.cuda.amp.autocast(self.fp16):
-            tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
-                                             token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_token=prompt_token.to(self.device),
-                                             prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_feat=prompt_feat.to(self.device),
-                                             prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                             embedding=embedding.to(self.device),
-                                             streaming=stream,
-                                             finalize=finalize)
-            tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
-            # append mel cache
-            if self.hift_cache_dict[uuid] is not None:
-                hift_cache_mel = self.hift_cache_dict[uuid]['mel']
-                tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
-                self.hift_cache_dict[uuid]['mel'] = tts_mel
+            if stream is True and self.flow_chunk_supported():
+                # NOTE incremental streaming inference, only tokens after token_offset are computed
+                tts_mel, self.flow_cache_dict[uuid] = self.flow.inference_chunk(token=token[:, token_offset:].to(self.device, dtype=torch.int32),
+                                                                                prompt_token=prompt_token.to(self.device),
+                                                                                prompt_feat=prompt_feat.to(self.device),
+                                                                                embedding=embedding.to(self.device),
+                                                                                finalize=finalize,
+                                                                                flow_cache=self.flow_cache_dict[uuid],
+                                                                                n_timesteps=n_timesteps,
+                                                                                cfg_rate=cfg_rate,
+                                                                                cfg_interval=cfg_interval)
             else:
-                self.hift_cache_dict[uuid] = {'mel': tts_mel, 'speech_offset': 0}
+                # NOTE the last chunk is decoded with full attention over all tokens, the incremental cache is not needed any more
+                self.flow_cache_dict[uuid] = None
+                tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
+                                                 token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                                                 prompt_token=prompt_token.to(self.device),
+                                                 prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                 prompt_feat=prompt_feat.to(self.device),
+                                                 prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                                                 embedding=embedding.to(self.device),
+                                                 streaming=stream,
+                                                 finalize=finalize,
+                                                 n_timesteps=n_timesteps,
+                                                 cfg_rate=cfg_rate,
+                                                 cfg_interval=cfg_interval)
+                tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
             if speed != 1.0:
                 assert token_offset == 0 and finalize is True, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, _ = self.hift.inference(speech_feat=tts_mel, finalize=finalize)
-            tts_speech = tts_speech[:, self.hift_cache_dict[uuid]['speech_offset']:]
-            self.hift_cache_dict[uuid]['speech_offset'] += tts_speech.shape[1]
+            # NOTE incremental vocoding, only new mel frames and a bounded left context are vocoded
+            tts_speech, self.hift_cache_dict[uuid] = self.hift.inference_chunk(speech_feat=tts_mel, cache=self.hift_cache_dict[uuid], finalize=finalize)
         return tts_speech
@@ -0,0 +1,311 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Shared weight serving, one model owner process and many lightweight front end workers.
+
+The owner loads the model once and serves a request queue over a local socket (multiprocessing manager),
+requests of all workers run concurrently in the owner, so the llm/flow/hift batchers batch across workers.
+Audio chunks go back through shared memory, only the block name and shape are sent over the socket.
+
+The owner and its clients share the secret in COSYVOICE_MODEL_SERVER_AUTHKEY, start the owner:
+    export COSYVOICE_MODEL_SERVER_AUTHKEY=$(python -c 'import secrets; print(secrets.token_hex(16))')
+    python -m cosyvoice.cli.model_server --model_dir pretrained_models/CosyVoice2-0.5B --port 50100 --flow_batch_size 8
+then in each worker:
+    client = ModelClient('127.0.0.1:50100')
+    async for model_output in client.inference_zero_shot(tts_text, prompt_text, prompt_wav, stream=True):
+        ...
+"""
+import argparse
+import asyncio
+import atexit
+import os
+import queue
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.managers import BaseManager
+import numpy as np
+import torch
+from cosyvoice.utils.common import CancelToken
+from cosyvoice.utils.file_utils import logging
+
+AUTHKEY_ENV = 'COSYVOICE_MODEL_SERVER_AUTHKEY'
+
+
+def get_authkey():
+    # NOTE no default key, anyone who can reach the port with it could run requests and read the shared memory of others
+    authkey = os.getenv(AUTHKEY_ENV, '')
+    assert authkey != '', 'set {} to the same secret in the model server and its clients, ' \
+        'e.g. export {}=$(python -c "import secrets; print(secrets.token_hex(16))")'.format(AUTHKEY_ENV, AUTHKEY_ENV)
+    return authkey.encode('utf8')
+
+
+class OwnerManager(BaseManager):
+    pass
+
+
+class ClientManager(BaseManager):
+    pass
+
+
+ClientManager.register('get_request_queue')
+ClientManager.register('get_response_queue')
+
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def write_shared_audio(tts_speech: torch.Tensor):
+    """Copy a (1, T) float32 chunk into a new shared memory block, which is unlinked by the reader."""
+    speech = tts_speech.float().numpy()
+    shm = shared_memory.SharedMemory(create=True, size=max(speech.nbytes, 1))
+    np.ndarray(speech.shape, dtype=np.float32, buffer=shm.buf)[:] = speech
+    # NOTE the reader owns the block from now on, do not let the resource tracker of this process unlink it at exit
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    shm.close()
+    return {'name': shm.name, 'shape': speech.shape}
+
+
+def read_shared_audio(name, shape):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        speech = torch.from_numpy(np.ndarray(shape, dtype=np.float32, buffer=shm.buf).copy())
+    finally:
+        shm.close()
+        shm.unlink()
+    return speech
+
+
+class ModelServer:
+    """Model owner, runs the requests of all connected ModelClient.
+
+    Requests are dicts put on the request queue:
+        {'type': 'inference', 'client_id', 'request_id', 'method', 'args', 'kwargs'}, method is one of inference_*
+        {'type': 'cancel', 'client_id', 'request_id'}
+        {'type': 'stats', 'client_id', 'request_id'}
+        {'type': 'close', 'client_id'}, the response queue of the client is dropped once its running requests finish
+    responses on the queue of client_id are {'request_id', 'type': 'chunk'/'end'/'error'/'stats', ...}.
+    """
+    def __init__(self, cosyvoice, address='127.0.0.1:50100', authkey=None, max_streams=32):
+        self.cosyvoice = cosyvoice
+        self.address = address
+        self.authkey = authkey if authkey is not None else get_authkey()
+        self.executor = ThreadPoolExecutor(max_workers=max_streams, thread_name_prefix='cosyvoice')
+        self.lock = threading.Lock()
+        self.request_queue = queue.Queue()
+        self.response_queues = {}
+        # cancel token of running requests, keyed by (client_id, request_id)
+        self.cancel_tokens = {}
+        # clients which sent close while some of their requests were still running
+        self.closed_clients = set()
+
+    def get_response_queue(self, client_id):
+        with self.lock:
+            if client_id not in self.response_queues:
+                self.response_queues[client_id] = queue.Queue()
+            return self.response_queues[client_id]
+
+    def serve(self):
+        OwnerManager.register('get_request_queue', callable=lambda: self.request_queue)
+        OwnerManager.register('get_response_queue', callable=self.get_response_queue)
+        manager = OwnerManager(address=parse_address(self.address), authkey=self.authkey)
+        server = manager.get_server()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info('model server listening on {}'.format(self.address))
+        while True:
+            request = self.request_queue.get()
+            if request is None:
+                break
+            key = (request['client_id'], request['request_id'])
+            if request['type'] == 'inference':
+                cancel_token = CancelToken()
+                with self.lock:
+                    self.cancel_tokens[key] = cancel_token
+                self.executor.submit(self.inference_job, request, cancel_token)
+            elif request['type'] == 'cancel':
+                with self.lock:
+                    cancel_token = self.cancel_tokens.get(key)
+                if cancel_token is not None:
+                    cancel_token.cancel()
+            elif request['type'] == 'stats':
+                self.get_response_queue(request['client_id']).put({'request_id': request['request_id'], 'type': 'stats', 'stats': self.stats()})
+            elif request['type'] == 'close':
+                with self.lock:
+                    self.closed_clients.add(request['client_id'])
+                    self.release_client(request['client_id'])
+            else:
+                logging.warning('unknown model server request type {}'.format(request['type']))
+
+    def inference_job(self, request, cancel_token):
+        response_queue = self.get_response_queue(request['client_id'])
+        try:
+            assert request['method'].startswith('inference_'), 'unknown method {}'.format(request['method'])
+            for model_output in getattr(self.cosyvoice, request['method'])(*request['args'], **request['kwargs'], cancel_token=cancel_token):
+                if cancel_token.cancelled is True:
+                    break
+                response_queue.put(dict(write_shared_audio(model_output['tts_speech']), request_id=request['request_id'], type='chunk'))
+            response_queue.put({'request_id': request['request_id'], 'type': 'end'})
+        except Exception as e:
+            logging.error('model server request {} failed: {}'.format(request['request_id'], e))
+            response_queue.put({'request_id': request['request_id'], 'type': 'error', 'error': str(e)})
+        finally:
+            with self.lock:
+                self.cancel_tokens.pop((request['client_id'], request['request_id']), None)
+                self.release_client(request['client_id'])
+
+    def release_client(self, client_id):
+        # NOTE called with self.lock held, the response queue of a live client is kept, it only reads the queue it got when connecting
+        if client_id in self.closed_clients and not any(key[0] == client_id for key in self.cancel_tokens):
+            self.closed_clients.discard(client_id)
+            self.response_queues.pop(client_id, None)
+
+    def stats(self):
+        with self.lock:
+            num_requests = len(self.cancel_tokens)
+        stats = {'model_type': type(self.cosyvoice).__name__, 'sample_rate': self.cosyvoice.sample_rate,
+                 'requests': num_requests, 'sessions': self.cosyvoice.model.session_stats()}
+        if getattr(self.cosyvoice.frontend, 'prompt_cache', None) is not None:
+            stats['prompt_cache'] = self.cosyvoice.frontend.prompt_cache.stats()
+        if hasattr(self.cosyvoice.model.llm, 'prefix_cache'):
+            stats['prefix_cache'] = self.cosyvoice.model.llm.prefix_cache.stats()
+        return stats
+
+
+class ModelClient:
+    """Front end of ModelServer with the same async inference_* api as AsyncCosyVoice.
+
+    A dispatcher thread reads the response queue of this client and routes chunks to the streams, stopping
+    to iterate a stream, e.g. client disconnect, cancels the request in the owner.
+    """
+    def __init__(self, address='127.0.0.1:50100', authkey=None):
+        self.client_id = str(uuid.uuid1())
+        self.manager = ClientManager(address=parse_address(address), authkey=authkey if authkey is not None else get_authkey())
+        self.manager.connect()
+        self.request_queue = self.manager.get_request_queue()
+        self.response_queue = self.manager.get_response_queue(self.client_id)
+        self.lock = threading.Lock()
+        # (event loop or None, queue) of each pending request
+        self.streams = {}
+        threading.Thread(target=self.dispatch_job, daemon=True).start()
+        info = self.stats()
+        self.model_type, self.sample_rate = info['model_type'], info['sample_rate']
+        atexit.register(self.close)
+
+    def close(self):
+        """Let the owner drop the response queue of this client, e.g. when a gunicorn worker exits."""
+        try:
+            self.send({'type': 'close'})
+        except (OSError, EOFError) as e:
+            logging.warning('failed to close model server client {}: {}'.format(self.client_id, e))
+
+    def dispatch_job(self):
+        while True:
+            response = self.response_queue.get()
+            # NOTE always read chunks, shared memory of cancelled requests is freed here too
+            item = read_shared_audio(response['name'], response['shape']) if response['type'] == 'chunk' else response
+            with self.lock:
+                stream = self.streams.get(response['request_id'])
+            if stream is None:
+                continue
+            loop, stream_queue = stream
+            if loop is None:
+                stream_queue.put(item)
+            else:
+                loop.call_soon_threadsafe(stream_queue.put_nowait, item)
+
+    def send(self, request):
+        # NOTE proxy of the request queue keeps one connection per thread
+        self.request_queue.put(dict(request, client_id=self.client_id))
+
+    def stats(self):
+        request_id, stream_queue = str(uuid.uuid1()), queue.Queue()
+        with self.lock:
+            self.streams[request_id] = (None, stream_queue)
+        try:
+            self.send({'type': 'stats', 'request_id': request_id})
+            return stream_queue.get()['stats']
+        finally:
+            with self.lock:
+                self.streams.pop(request_id)
+
+    async def stream(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        request_id, stream_queue = str(uuid.uuid1()), asyncio.Queue()
+        with self.lock:
+            self.streams[request_id] = (loop, stream_queue)
+        finished = False
+        try:
+            await loop.run_in_executor(None, self.send, {'type': 'inference', 'request_id': request_id, 'method': method, 'args': args, 'kwargs': kwargs})
+            while True:
+                item = await stream_queue.get()
+                if isinstance(item, torch.Tensor):
+                    yield {'tts_speech': item}
+                elif item['type'] == 'end':
+                    finished = True
+                    break
+                else:
+                    finished = True
+                    raise RuntimeError('model server request failed: {}'.format(item['error']))
+        finally:
+            with self.lock:
+                self.streams.pop(request_id)
+            if finished is False:
+                loop.run_in_executor(None, self.send, {'type': 'cancel', 'request_id': request_id})
+
+    def inference_sft(self, *args, **kwargs):
+        return self.stream('inference_sft', *args, **kwargs)
+
+    def inference_zero_shot(self, *args, **kwargs):
+        return self.stream('inference_zero_shot', *args, **kwargs)
+
+    def inference_cross_lingual(self, *args, **kwargs):
+        return self.stream('inference_cross_lingual', *args, **kwargs)
+
+    def inference_instruct2(self, *args, **kwargs):
+        return self.stream('inference_instruct2', *args, **kwargs)
+
+    def inference_vc(self, *args, **kwargs):
+        return self.stream('inference_vc', *args, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, required=True)
+    parser.add_argument('--port', type=int, default=50100)
+    parser.add_argument('--fp16', action='store_true')
+    parser.add_argument('--lazy_load', action='store_true')
+    parser.add_argument('--max_streams', type=int, default=32)
+    parser.add_argument('--llm_batch_size', type=int, default=0)
+    parser.add_argument('--flow_batch_size', type=int, default=0)
+    parser.add_argument('--hift_batch_size', type=int, default=0)
+    parser.add_argument('--prefix_cache_mb', type=int, default=64)
+    parser.add_argument('--prompt_cache_mb', type=int, default=256)
+    parser.add_argument('--prompt_cache_dir', type=str, default='')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    from cosyvoice.cli.cosyvoice import AutoModel
+    from cosyvoice.utils.prompt_cache import PromptCache
+    # only pass options which are enabled, CosyVoice3 does not take flow/hift batch size
+    kwargs = {k: getattr(args, k) for k in ['llm_batch_size', 'flow_batch_size', 'hift_batch_size', 'prefix_cache_mb'] if getattr(args, k) > 0}
+    if args.lazy_load:
+        kwargs['lazy_load'] = True
+    cosyvoice = AutoModel(model_dir=args.model_dir, fp16=args.fp16, **kwargs)
+    cosyvoice.frontend.prompt_cache = PromptCache(max_bytes=args.prompt_cache_mb * 1024 * 1024, cache_dir=args.prompt_cache_dir)
+    ModelServer(cosyvoice, address='127.0.0.1:{}'.format(args.port), max_streams=args.max_streams).serve()
+
+
+if __name__ == '__main__':
+    main()
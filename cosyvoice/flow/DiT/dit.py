@@ -87,7 +87,13 @@ class InputEmbedding(nn.Module):
             cond: float["b n d"],
             text_embed: float["b n d"],
             spks: float["b d"],
+            static: float["b n d"] = None,
     ):
+        if static is not None:
+            # the projection of cond/text_embed/spks is given by forward_static, only project the noised input
+            x = F.linear(x, self.proj.weight[:, :x.shape[-1]]) + static
+            return self.conv_pos_embed(x) + x
+
         to_cat = [x, cond, text_embed]
         if self.spk_dim > 0:
             spks = repeat(spks, "b c -> b t c", t=x.shape[1])
@@ -97,6 +103,36 @@ class InputEmbedding(nn.Module):
         x = self.conv_pos_embed(x) + x
         return x
 
+    def forward_static(
+            self,
+            cond: float["b n d"],  # noqa: F722
+            text_embed: float["b n d"],  # noqa: F722
+            spks: float["b d"],  # noqa: F821
+    ):
+        """Projection of the step invariant inputs plus bias, to be added to the projection of x."""
+        to_cat = [cond, text_embed]
+        if self.spk_dim > 0:
+            spks = repeat(spks, "b c -> b t c", t=cond.shape[1])
+            to_cat.append(spks)
+        return F.linear(torch.cat(to_cat, dim=-1), self.proj.weight[:, -sum(i.shape[-1] for i in to_cat):], self.proj.bias)
+
+    def forward_chunk(
+            self,
+            x: float["b n d"],  # noqa: F722
+            cond: float["b n d"],  # noqa: F722
+            text_embed: float["b n d"],  # noqa: F722
+            spks: float["b d"],  # noqa: F821
+            cache: torch.Tensor = torch.zeros(0, 0, 0),
+    ):
+        to_cat = [x, cond, text_embed]
+        if self.spk_dim > 0:
+            spks = repeat(spks, "b c -> b t c", t=x.shape[1])
+            to_cat.append(spks)
+
+        x = self.proj(torch.cat(to_cat, dim=-1))
+        pos_embed, new_cache = self.conv_pos_embed.forward_chunk(x, cache)
+        return pos_embed + x, new_cache
+
 
 # Transformer backbone using DiT blocks
 
@@ -142,29 +178,51 @@ class DiT(nn.Module):
         self.static_chunk_size = static_chunk_size
         self.num_decoding_left_chunks = num_decoding_left_chunks
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False):
+    def prepare_context(self, mask, mu, spks=None, cond=None, streaming=False):
+        """Precompute the step invariant inputs of forward, built once per ode solve and reused by every euler step.
+
+        Args:
+            mask (torch.Tensor): shape (batch_size, 1, time)
+            mu, cond (torch.Tensor): shape (batch_size, mel_dim, time)
+            spks (torch.Tensor): shape (batch_size, spk_dim)
+
+        Returns:
+            dict: rope table, attention mask and projection of mu/spks/cond
+        """
+        seq_len = mask.shape[-1]
+        if streaming is True:
+            attn_mask = add_optional_chunk_mask(mu.transpose(1, 2), mask.bool(), False, False, 0, self.static_chunk_size, -1).unsqueeze(dim=1)
+        else:
+            # (b, 1, 1, n) padding mask, broadcast over heads and queries by sdpa
+            attn_mask = mask.bool().unsqueeze(dim=1)
+        return {'rope': self.rotary_embed.forward_from_seq_len(seq_len),
+                'attn_mask': attn_mask,
+                'static': self.input_embed.forward_static(cond.transpose(1, 2), mu.transpose(1, 2), spks)}
+
+    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False, context=None):
         x = x.transpose(1, 2)
-        mu = mu.transpose(1, 2)
-        cond = cond.transpose(1, 2)
-        spks = spks.unsqueeze(dim=1)
         batch, seq_len = x.shape[0], x.shape[1]
         if t.ndim == 0:
             t = t.repeat(batch)
 
         # t: conditioning time, c: context (text + masked cond audio), x: noised input audio
         t = self.time_embed(t)
-        x = self.input_embed(x, cond, mu, spks.squeeze(1))
-
-        rope = self.rotary_embed.forward_from_seq_len(seq_len)
+        if context is not None:
+            x = self.input_embed(x, None, None, None, static=context['static'])
+            rope, attn_mask = context['rope'], context['attn_mask']
+        else:
+            mu = mu.transpose(1, 2)
+            cond = cond.transpose(1, 2)
+            x = self.input_embed(x, cond, mu, spks)
+            rope = self.rotary_embed.forward_from_seq_len(seq_len)
+            if streaming is True:
+                attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, self.static_chunk_size, -1).unsqueeze(dim=1)
+            else:
+                attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1).unsqueeze(dim=1)
 
         if self.long_skip_connection is not None:
             residual = x
 
-        if streaming is True:
-            attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, self.static_chunk_size, -1).unsqueeze(dim=1)
-        else:
-            attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1).unsqueeze(dim=1)
-
         for block in self.transformer_blocks:
             x = block(x, t, mask=attn_mask.bool(), rope=rope)
 
@@ -174,3 +232,47 @@ class DiT(nn.Module):
         x = self.norm_out(x, t)
         output = self.proj_out(x).transpose(1, 2)
         return output
+
+    def forward_chunk(self, x, mu, t, spks, cond, offset, att_cache=torch.zeros(0, 0, 0, 0, 0), cnn_cache=torch.zeros(0, 0, 0)):
+        """Incremental streaming forward, only the new frames are computed.
+
+        Args:
+            x, mu, cond (torch.Tensor): shape (batch_size, mel_dim, new_frames)
+            t (torch.Tensor): shape (batch_size)
+            spks (torch.Tensor): shape (batch_size, spk_dim)
+            offset (int): number of history frames, i.e. absolute position of x[:, :, 0]
+            att_cache (torch.Tensor): (depth, batch_size, heads, offset, dim_head * 2), (0, 0, 0, 0, 0) means no history
+            cnn_cache (torch.Tensor): conv position embedding cache, (0, 0, 0) means no history
+
+        Returns:
+            output (torch.Tensor): shape (batch_size, mel_dim, new_frames)
+            new_att_cache, new_cnn_cache
+        """
+        assert self.long_skip_connection is None, 'long_skip_connection is not supported in forward_chunk'
+        x = x.transpose(1, 2)
+        mu = mu.transpose(1, 2)
+        cond = cond.transpose(1, 2)
+        batch, seq_len = x.shape[0], x.shape[1]
+        if t.ndim == 0:
+            t = t.repeat(batch)
+
+        t = self.time_embed(t)
+        x, new_cnn_cache = self.input_embed.forward_chunk(x, cond, mu, spks, cnn_cache)
+
+        rope = self.rotary_embed(torch.arange(offset, offset + seq_len, device=x.device))
+
+        # history frames are always visible, new frames follow the static chunk mask with absolute position
+        pos_q = torch.arange(offset, offset + seq_len, device=x.device)
+        pos_k = torch.arange(offset + seq_len, device=x.device)
+        attn_mask = pos_k.unsqueeze(0) < ((torch.div(pos_q, self.static_chunk_size, rounding_mode='trunc') + 1) * self.static_chunk_size).unsqueeze(1)
+        attn_mask = attn_mask.unsqueeze(0).repeat(batch, 1, 1)
+
+        new_att_cache = []
+        for i, block in enumerate(self.transformer_blocks):
+            x, this_att_cache = block.forward_chunk(x, t, mask=attn_mask, rope=rope,
+                                                    att_cache=att_cache[i] if att_cache.size(0) > 0 else torch.zeros(0, 0, 0, 0))
+            new_att_cache.append(this_att_cache)
+
+        x = self.norm_out(x, t)
+        output = self.proj_out(x).transpose(1, 2)
+        return output, torch.stack(new_att_cache, dim=0), new_cnn_cache
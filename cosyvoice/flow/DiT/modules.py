@@ -143,6 +143,23 @@ class CausalConvPositionEmbedding(nn.Module):
 
         return out
 
+    def forward_chunk(self, x: float["b n d"], cache: torch.Tensor = torch.zeros(0, 0, 0)):  # noqa: F722
+        """
+        x: (b, n, d), only the new frames
+        cache: (b, d, 2 * (kernel_size - 1)), left context of conv1 and conv2 inputs, (0, 0, 0) means no history
+        """
+        x = x.permute(0, 2, 1)
+        if cache.size(2) == 0:
+            cache = torch.zeros(x.shape[0], x.shape[1], 2 * (self.kernel_size - 1)).to(x)
+        x = torch.concat([cache[:, :, :self.kernel_size - 1], x], dim=2)
+        new_cache1 = x[:, :, -(self.kernel_size - 1):]
+        x = self.conv1(x)
+        x = torch.concat([cache[:, :, self.kernel_size - 1:], x], dim=2)
+        new_cache2 = x[:, :, -(self.kernel_size - 1):]
+        x = self.conv2(x)
+        out = x.permute(0, 2, 1)
+        return out, torch.concat([new_cache1, new_cache2], dim=2)
+
 
 # rotary positional embedding related
 
@@ -342,6 +359,44 @@ class Attention(nn.Module):
         else:
             return self.processor(self, x, mask=mask, rope=rope)
 
+    def forward_chunk(
+        self,
+        x: float["b n d"],  # noised input x of new frames  # noqa: F722
+        mask: bool["b n m"],  # noqa: F722
+        rope=None,  # rotary position embedding of new frames
+        att_cache: torch.Tensor = torch.zeros(0, 0, 0, 0),
+    ):
+        """
+        mask: (b, n, cache_t + n), True for attended keys
+        att_cache: (b, heads, cache_t, dim_head * 2), rope applied key and value of history frames
+        """
+        batch_size = x.shape[0]
+        query = self.to_q(x)
+        key = self.to_k(x)
+        value = self.to_v(x)
+        if rope is not None:
+            freqs, xpos_scale = rope
+            q_xpos_scale, k_xpos_scale = (xpos_scale, xpos_scale**-1.0) if xpos_scale is not None else (1.0, 1.0)
+            query = apply_rotary_pos_emb(query, freqs, q_xpos_scale)
+            key = apply_rotary_pos_emb(key, freqs, k_xpos_scale)
+
+        head_dim = key.shape[-1] // self.heads
+        query = query.view(batch_size, -1, self.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, self.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, self.heads, head_dim).transpose(1, 2)
+        if att_cache.size(0) > 0:
+            key_cache, value_cache = torch.split(att_cache, head_dim, dim=-1)
+            key = torch.concat([key_cache, key], dim=2)
+            value = torch.concat([value_cache, value], dim=2)
+        new_att_cache = torch.concat([key, value], dim=-1)
+
+        x = F.scaled_dot_product_attention(query, key, value, attn_mask=mask.unsqueeze(1), dropout_p=0.0, is_causal=False)
+        x = x.transpose(1, 2).reshape(batch_size, -1, self.heads * head_dim)
+        x = x.to(query.dtype)
+        x = self.to_out[0](x)
+        x = self.to_out[1](x)
+        return x, new_att_cache
+
 
 # Attention processor
 
@@ -529,6 +584,16 @@ class DiTBlock(nn.Module):
 
         return x
 
+    def forward_chunk(self, x, t, mask, rope=None, att_cache=torch.zeros(0, 0, 0, 0)):
+        norm, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.attn_norm(x, emb=t)
+        attn_output, new_att_cache = self.attn.forward_chunk(x=norm, mask=mask, rope=rope, att_cache=att_cache)
+        x = x + gate_msa.unsqueeze(1) * attn_output
+
+        ff_norm = self.ff_norm(x) * (1 + scale_mlp[:, None]) + shift_mlp[:, None]
+        ff_output = self.ff(ff_norm)
+        x = x + gate_mlp.unsqueeze(1) * ff_output
+        return x, new_att_cache
+
 
 # MMDiT Block https://arxiv.org/abs/2403.03206
 
@@ -61,6 +61,19 @@ class CausalConv1d(torch.nn.Conv1d):
         x = super(CausalConv1d, self).forward(x)
         return x
 
+    def forward_chunk(self, x: torch.Tensor, cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        x: (b, c, n), only the new frames
+        cache: (b, c, kernel_size - 1), left context of x, (0, 0, 0) means no history
+        """
+        if cache.size(2) == 0:
+            x = F.pad(x, (self.causal_padding, 0), value=0.0)
+        else:
+            x = torch.concat([cache, x], dim=2)
+        new_cache = x[:, :, -self.causal_padding:]
+        x = super(CausalConv1d, self).forward(x)
+        return x, new_cache
+
 
 class CausalBlock1D(Block1D):
     def __init__(self, dim: int, dim_out: int):
@@ -77,6 +90,10 @@ class CausalBlock1D(Block1D):
         output = self.block(x * mask)
         return output * mask
 
+    def forward_chunk(self, x: torch.Tensor, cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+        output, new_cache = self.block[0].forward_chunk(x, cache)
+        return self.block[1:](output), new_cache
+
 
 class CausalResnetBlock1D(ResnetBlock1D):
     def __init__(self, dim: int, dim_out: int, time_emb_dim: int, groups: int = 8):
@@ -84,6 +101,51 @@ class CausalResnetBlock1D(ResnetBlock1D):
         self.block1 = CausalBlock1D(dim, dim_out)
         self.block2 = CausalBlock1D(dim_out, dim_out)
 
+    def forward_chunk(self, x: torch.Tensor, time_emb: torch.Tensor, cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        x: (b, dim, n), only the new frames
+        cache: (b, dim + dim_out, 2), left context of block1 and block2 inputs, (0, 0, 0) means no history
+        """
+        cache1, cache2 = (cache[:, :x.size(1)], cache[:, x.size(1):]) if cache.size(0) > 0 else (cache, cache)
+        h, new_cache1 = self.block1.forward_chunk(x, cache1)
+        h += self.mlp(time_emb).unsqueeze(-1)
+        h, new_cache2 = self.block2.forward_chunk(h, cache2)
+        output = h + self.res_conv(x)
+        return output, torch.concat([new_cache1, new_cache2], dim=1)
+
+
+def transformer_block_forward_chunk(block: BasicTransformerBlock, x: torch.Tensor, mask: torch.Tensor,
+                                    att_cache: torch.Tensor = torch.zeros(0, 0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+    """BasicTransformerBlock.forward with key and value of history frames, see DiTBlock.forward_chunk.
+
+    x: (b, n, dim), only the new frames
+    mask: (b, n, cache_t + n), True for attended keys
+    att_cache: (b, heads, cache_t, dim_head * 2), (0, 0, 0, 0) means no history
+    """
+    assert block.attn2 is None and not block.use_ada_layer_norm and not block.use_ada_layer_norm_zero
+    attn = block.attn1
+    batch_size = x.shape[0]
+    norm_x = block.norm1(x)
+    query = attn.to_q(norm_x)
+    key = attn.to_k(norm_x)
+    value = attn.to_v(norm_x)
+    head_dim = key.shape[-1] // attn.heads
+    query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+    key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+    value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+    if att_cache.size(0) > 0:
+        key_cache, value_cache = torch.split(att_cache, head_dim, dim=-1)
+        key = torch.concat([key_cache, key], dim=2)
+        value = torch.concat([value_cache, value], dim=2)
+    new_att_cache = torch.concat([key, value], dim=-1)
+
+    attn_output = F.scaled_dot_product_attention(query, key, value, attn_mask=mask.unsqueeze(1), dropout_p=0.0, is_causal=False)
+    attn_output = attn_output.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim).to(query.dtype)
+    attn_output = attn.to_out[1](attn.to_out[0](attn_output))
+    x = attn_output + x
+    x = block.ff(block.norm3(x)) + x
+    return x, new_att_cache
+
 
 class ConditionalDecoder(nn.Module):
     def __init__(
@@ -207,7 +269,47 @@ class ConditionalDecoder(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False):
+    def prepare_context(self, mask, mu, spks=None, cond=None, streaming=False):
+        """Precompute the step invariant inputs of forward, built once per ode solve and reused by every euler step.
+
+        Args:
+            mask (torch.Tensor): shape (batch_size, 1, time)
+            mu (torch.Tensor): shape (batch_size, in_channels, time)
+            spks (torch.Tensor, optional): shape (batch_size, condition_channels)
+            cond (torch.Tensor, optional): shape (batch_size, in_channels, time)
+
+        Returns:
+            dict: packed mu/spks/cond, and attention bias of each resolution filled lazily by forward
+        """
+        static = [mu]
+        if spks is not None:
+            static.append(repeat(spks, "b c -> b c t", t=mu.shape[-1]))
+        if cond is not None:
+            static.append(cond)
+        return {'static': pack(static, "b * t")[0], 'attn_bias': {}}
+
+    def attention_bias(self, x, mask, streaming=False, context=None):
+        """Attention bias of x (batch_size, time, channels) at the resolution of mask (batch_size, 1, time).
+
+        Without context the dense (batch_size, time, time) bias is built on every call, which is what onnx export
+        expects. With context it is built once per resolution and dtype, and the non streaming padding bias stays
+        (batch_size, 1, time) so that sdpa broadcasts it over queries.
+        """
+        key = (mask.shape[-1], x.dtype)
+        if context is not None and key in context['attn_bias']:
+            return context['attn_bias'][key]
+        if streaming is True:
+            attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, self.static_chunk_size, -1)
+        elif context is not None:
+            attn_mask = mask.bool()
+        else:
+            attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
+        attn_bias = mask_to_bias(attn_mask, x.dtype)
+        if context is not None:
+            context['attn_bias'][key] = attn_bias
+        return attn_bias
+
+    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False, context=None):
         """Forward pass of the UNet1DConditional model.
 
         Args:
@@ -216,6 +318,7 @@ class ConditionalDecoder(nn.Module):
             t (_type_): shape (batch_size)
             spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
             cond (_type_, optional): placeholder for future use. Defaults to None.
+            context (dict, optional): output of prepare_context, reused by every step of one ode solve. Defaults to None.
 
         Raises:
             ValueError: _description_
@@ -228,13 +331,15 @@ class ConditionalDecoder(nn.Module):
         t = self.time_embeddings(t).to(t.dtype)
         t = self.time_mlp(t)
 
-        x = pack([x, mu], "b * t")[0]
-
-        if spks is not None:
-            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
-            x = pack([x, spks], "b * t")[0]
-        if cond is not None:
-            x = pack([x, cond], "b * t")[0]
+        if context is not None:
+            x = pack([x, context['static']], "b * t")[0]
+        else:
+            x = pack([x, mu], "b * t")[0]
+            if spks is not None:
+                spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
+                x = pack([x, spks], "b * t")[0]
+            if cond is not None:
+                x = pack([x, cond], "b * t")[0]
 
         hiddens = []
         masks = [mask]
@@ -242,8 +347,7 @@ class ConditionalDecoder(nn.Module):
             mask_down = masks[-1]
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.attention_bias(x, mask_down, context=context)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -260,8 +364,7 @@ class ConditionalDecoder(nn.Module):
         for resnet, transformer_blocks in self.mid_blocks:
             x = resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.attention_bias(x, mask_mid, context=context)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -276,8 +379,7 @@ class ConditionalDecoder(nn.Module):
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.attention_bias(x, mask_up, context=context)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -402,7 +504,7 @@ class CausalConditionalDecoder(ConditionalDecoder):
         self.final_proj = nn.Conv1d(channels[-1], self.out_channels, 1)
         self.initialize_weights()
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False):
+    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False, context=None):
         """Forward pass of the UNet1DConditional model.
 
         Args:
@@ -411,6 +513,7 @@ class CausalConditionalDecoder(ConditionalDecoder):
             t (_type_): shape (batch_size)
             spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
             cond (_type_, optional): placeholder for future use. Defaults to None.
+            context (dict, optional): output of prepare_context, reused by every step of one ode solve. Defaults to None.
 
         Raises:
             ValueError: _description_
@@ -422,13 +525,15 @@ class CausalConditionalDecoder(ConditionalDecoder):
         t = self.time_embeddings(t).to(t.dtype)
         t = self.time_mlp(t)
 
-        x = pack([x, mu], "b * t")[0]
-
-        if spks is not None:
-            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
-            x = pack([x, spks], "b * t")[0]
-        if cond is not None:
-            x = pack([x, cond], "b * t")[0]
+        if context is not None:
+            x = pack([x, context['static']], "b * t")[0]
+        else:
+            x = pack([x, mu], "b * t")[0]
+            if spks is not None:
+                spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
+                x = pack([x, spks], "b * t")[0]
+            if cond is not None:
+                x = pack([x, cond], "b * t")[0]
 
         hiddens = []
         masks = [mask]
@@ -436,11 +541,7 @@ class CausalConditionalDecoder(ConditionalDecoder):
             mask_down = masks[-1]
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.attention_bias(x, mask_down, streaming, context)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -457,11 +558,7 @@ class CausalConditionalDecoder(ConditionalDecoder):
         for resnet, transformer_blocks in self.mid_blocks:
             x = resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.attention_bias(x, mask_mid, streaming, context)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -476,11 +573,7 @@ class CausalConditionalDecoder(ConditionalDecoder):
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.attention_bias(x, mask_up, streaming, context)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -492,3 +585,72 @@ class CausalConditionalDecoder(ConditionalDecoder):
         x = self.final_block(x, mask_up)
         output = self.final_proj(x * mask_up)
         return output * mask
+
+    def forward_chunk(self, x, mu, t, spks, cond, offset, att_cache=torch.zeros(0, 0, 0, 0, 0), cnn_cache=torch.zeros(0, 0, 0)):
+        """Incremental streaming forward, only the new frames are computed, see DiT.forward_chunk.
+
+        Args:
+            x, mu, cond (torch.Tensor): shape (batch_size, out_channels, new_frames)
+            t (torch.Tensor): shape (batch_size)
+            spks (torch.Tensor): shape (batch_size, condition_channels)
+            offset (int): number of history frames, i.e. absolute position of x[:, :, 0]
+            att_cache (torch.Tensor): (transformer blocks, batch_size, heads, offset, attention_head_dim * 2), (0, 0, 0, 0, 0) means no history
+            cnn_cache (torch.Tensor): left context of every causal conv input concatenated on channel dim,
+                (batch_size, channels, 2), (0, 0, 0) means no history
+
+        Returns:
+            output (torch.Tensor): shape (batch_size, out_channels, new_frames)
+            new_att_cache, new_cnn_cache
+        """
+        # NOTE Downsample1D/Upsample1D of len(channels) > 1 change the frame rate, they are not supported
+        assert all(isinstance(block[-1], CausalConv1d) for block in list(self.down_blocks) + list(self.up_blocks)), \
+            'only a single resolution, i.e. len(channels) == 1, is supported in forward_chunk'
+        t = self.time_embeddings(t).to(t.dtype)
+        t = self.time_mlp(t)
+        x = pack([x, mu, repeat(spks, "b c -> b c t", t=x.shape[-1]), cond], "b * t")[0]
+
+        # history frames are always visible, new frames follow the static chunk mask with absolute position
+        pos_q = torch.arange(offset, offset + x.shape[-1], device=x.device)
+        pos_k = torch.arange(offset + x.shape[-1], device=x.device)
+        attn_mask = pos_k.unsqueeze(0) < ((torch.div(pos_q, self.static_chunk_size, rounding_mode='trunc') + 1) * self.static_chunk_size).unsqueeze(1)
+        attn_mask = attn_mask.unsqueeze(0)
+
+        new_att_cache, new_cnn_cache = [], []
+
+        def causal_forward_chunk(module, x, *args):
+            # resnet/causal conv/causal block with its slice of cnn_cache, caches are consumed in call order
+            start = sum(cache.size(1) for cache in new_cnn_cache)
+            channels = sum(m.in_channels for m in module.modules() if isinstance(m, CausalConv1d))
+            x, cache = module.forward_chunk(x, *args, cache=cnn_cache[:, start:start + channels] if cnn_cache.size(0) > 0 else cnn_cache)
+            new_cnn_cache.append(cache)
+            return x
+
+        def transformer_forward_chunk(transformer_blocks, x):
+            x = rearrange(x, "b c t -> b t c").contiguous()
+            for transformer_block in transformer_blocks:
+                i = len(new_att_cache)
+                x, cache = transformer_block_forward_chunk(transformer_block, x, attn_mask,
+                                                           att_cache=att_cache[i] if att_cache.size(0) > 0 else torch.zeros(0, 0, 0, 0))
+                new_att_cache.append(cache)
+            return rearrange(x, "b t c -> b c t").contiguous()
+
+        hiddens = []
+        for resnet, transformer_blocks, downsample in self.down_blocks:
+            x = causal_forward_chunk(resnet, x, t)
+            x = transformer_forward_chunk(transformer_blocks, x)
+            hiddens.append(x)  # Save hidden states for skip connections
+            x = causal_forward_chunk(downsample, x)
+
+        for resnet, transformer_blocks in self.mid_blocks:
+            x = causal_forward_chunk(resnet, x, t)
+            x = transformer_forward_chunk(transformer_blocks, x)
+
+        for resnet, transformer_blocks, upsample in self.up_blocks:
+            skip = hiddens.pop()
+            x = pack([x, skip], "b * t")[0]
+            x = causal_forward_chunk(resnet, x, t)
+            x = transformer_forward_chunk(transformer_blocks, x)
+            x = causal_forward_chunk(upsample, x)
+        x = causal_forward_chunk(self.final_block, x)
+        output = self.final_proj(x)
+        return output, torch.stack(new_att_cache, dim=0), torch.concat(new_cnn_cache, dim=1)
@@ -17,6 +17,7 @@ from typing import Dict, Optional
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.nn.utils.rnn import pad_sequence
 from omegaconf import DictConfig
 from cosyvoice.utils.mask import make_pad_mask
 
@@ -107,7 +108,8 @@ class MaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  flow_cache):
+                  flow_cache,
+                  n_timesteps=5):
         assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
@@ -136,8 +138,7 @@ class MaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            # n_timesteps=10,
-            n_timesteps=5,
+            n_timesteps=n_timesteps,
             prompt_len=mel_len1,
             cache=flow_cache
         )
@@ -237,7 +238,10 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat_len,
                   embedding,
                   streaming,
-                  finalize):
+                  finalize,
+                  n_timesteps=10,
+                  cfg_rate=None,
+                  cfg_interval=1):
         assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
@@ -268,13 +272,139 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
-            streaming=streaming
+            n_timesteps=n_timesteps,
+            streaming=streaming,
+            cfg_rate=cfg_rate,
+            cfg_interval=cfg_interval
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
         return feat.float(), None
 
+    @torch.inference_mode()
+    def inference_batch(self,
+                        token,
+                        prompt_token,
+                        prompt_feat,
+                        embedding,
+                        streaming,
+                        finalize,
+                        n_timesteps=10,
+                        cfg_rate=None,
+                        cfg_interval=1):
+        """Batched inference of several sessions with different prompt and target lengths.
+        The encoder runs per session, the flow matching decoder runs once on the right padded batch.
+
+        Args:
+            token: list of (1, T_i) speech token
+            prompt_token: list of (1, P_i) prompt speech token
+            prompt_feat: list of (1, token_mel_ratio * P_i, 80) prompt feat
+            embedding: (N, spk_embed_dim)
+            streaming, finalize, n_timesteps, cfg_rate, cfg_interval: shared by all sessions
+        Returns:
+            list of (1, 80, mel_len2_i) feat
+        """
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+
+        # text encode
+        h, mel_len1, mel_len2 = [], [], []
+        for i in range(len(token)):
+            this_token = torch.concat([prompt_token[i], token[i]], dim=1)
+            this_token_len = torch.tensor([this_token.shape[1]], dtype=torch.int32, device=this_token.device)
+            this_token = self.input_embedding(torch.clamp(this_token, min=0))
+            if finalize is True:
+                this_h, _ = self.encoder(this_token, this_token_len, streaming=streaming)
+            else:
+                this_token, context = this_token[:, :-self.pre_lookahead_len], this_token[:, -self.pre_lookahead_len:]
+                this_h, _ = self.encoder(this_token, this_token_len, context=context, streaming=streaming)
+            mel_len1.append(prompt_feat[i].shape[1])
+            mel_len2.append(this_h.shape[1] - prompt_feat[i].shape[1])
+            h.append(self.encoder_proj(this_h).squeeze(dim=0))
+        h = pad_sequence(h, batch_first=True)
+
+        # get conditions
+        conds = torch.zeros([h.shape[0], h.shape[1], self.output_size], device=h.device).to(h.dtype)
+        for i in range(len(token)):
+            conds[i, :mel_len1[i]] = prompt_feat[i][0]
+        conds = conds.transpose(1, 2)
+
+        mask = (~make_pad_mask(torch.tensor([i + j for i, j in zip(mel_len1, mel_len2)]), h.shape[1])).to(h)
+        feat, _ = self.decoder(
+            mu=h.transpose(1, 2).contiguous(),
+            mask=mask.unsqueeze(1),
+            spks=embedding,
+            cond=conds,
+            n_timesteps=n_timesteps,
+            streaming=streaming,
+            cfg_rate=cfg_rate,
+            cfg_interval=cfg_interval
+        )
+        return [feat[i:i + 1, :, mel_len1[i]:mel_len1[i] + mel_len2[i]].float() for i in range(len(token))]
+
+    @torch.inference_mode()
+    def inference_chunk(self,
+                        token,
+                        prompt_token,
+                        prompt_feat,
+                        embedding,
+                        finalize,
+                        flow_cache=None,
+                        n_timesteps=10,
+                        cfg_rate=None,
+                        cfg_interval=1):
+        """Incremental streaming inference, equals to inference(streaming=True) on the whole prefix
+           but only computes the new frames, see CausalMaskedDiffWithDiT.inference_chunk.
+
+        Args:
+            token: speech tokens not decoded by previous calls, plus pre_lookahead_len context tokens if finalize is False,
+                every chunk but the last one must end at a static chunk boundary of the encoder
+            prompt_token, prompt_feat: only used in the first call, when flow_cache is None
+            flow_cache: returned by previous call, None for the first chunk
+
+        Returns:
+            feat: mel of the new tokens (1, 80, T)
+            flow_cache: encoder/estimator cache for next call
+        """
+        assert token.shape[0] == 1
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+
+        if flow_cache is None:
+            token = torch.concat([prompt_token, token], dim=1)
+            mel_len1 = prompt_feat.shape[1]
+        else:
+            mel_len1 = 0
+        token = self.input_embedding(torch.clamp(token, min=0))
+
+        # text encode, the encoder cache keeps attention and conv state of history tokens
+        if finalize is True:
+            h, encoder_cache = self.encoder.forward_chunk(token, cache=flow_cache['encoder'] if flow_cache is not None else None)
+        else:
+            token, context = token[:, :-self.pre_lookahead_len], token[:, -self.pre_lookahead_len:]
+            h, encoder_cache = self.encoder.forward_chunk(token, context=context, cache=flow_cache['encoder'] if flow_cache is not None else None)
+        h = self.encoder_proj(h)
+
+        # get conditions
+        conds = torch.zeros([1, h.shape[1], self.output_size], device=token.device).to(h.dtype)
+        if flow_cache is None:
+            conds[:, :mel_len1] = prompt_feat
+        conds = conds.transpose(1, 2)
+
+        feat, decoder_cache = self.decoder.forward_chunk(
+            mu=h.transpose(1, 2).contiguous(),
+            n_timesteps=n_timesteps,
+            spks=embedding,
+            cond=conds,
+            cache=flow_cache['decoder'] if flow_cache is not None else None,
+            cfg_rate=cfg_rate,
+            cfg_interval=cfg_interval
+        )
+        feat = feat[:, :, mel_len1:]
+        return feat.float(), {'encoder': encoder_cache, 'decoder': decoder_cache}
+
 
 class CausalMaskedDiffWithDiT(torch.nn.Module):
     def __init__(self,
@@ -366,7 +496,10 @@ class CausalMaskedDiffWithDiT(torch.nn.Module):
                   prompt_feat_len,
                   embedding,
                   streaming,
-                  finalize):
+                  finalize,
+                  n_timesteps=10,
+                  cfg_rate=None,
+                  cfg_interval=1):
         assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
@@ -396,38 +529,124 @@ class CausalMaskedDiffWithDiT(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
-            streaming=streaming
+            n_timesteps=n_timesteps,
+            streaming=streaming,
+            cfg_rate=cfg_rate,
+            cfg_interval=cfg_interval
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
         return feat.float(), None
 
+    @torch.inference_mode()
+    def inference_chunk(self,
+                        token,
+                        prompt_token,
+                        prompt_feat,
+                        embedding,
+                        finalize,
+                        flow_cache=None,
+                        n_timesteps=10,
+                        cfg_rate=None,
+                        cfg_interval=1):
+        """Incremental streaming inference, equals to inference(streaming=True) on the whole prefix
+           but only computes the new frames.
+
+        Args:
+            token: speech tokens not decoded by previous calls, plus pre_lookahead_len context tokens if finalize is False
+            prompt_token, prompt_feat: only used in the first call, when flow_cache is None
+            flow_cache: returned by previous call, None for the first chunk
+            n_timesteps: may differ between chunks, e.g. fewer steps for the first chunk
+            cfg_rate, cfg_interval: classifier free guidance, see ConditionalCFM.solve_ode
+
+        Returns:
+            feat: mel of the new tokens (1, 80, T)
+            flow_cache: lookahead/estimator cache for next call
+        """
+        assert token.shape[0] == 1
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+
+        if flow_cache is None:
+            token = torch.concat([prompt_token, token], dim=1)
+            mel_len1 = prompt_feat.shape[1]
+        else:
+            mel_len1 = 0
+        token = self.input_embedding(torch.clamp(token, min=0))
+
+        # text encode, keep last token embeddings as left context of pre_lookahead_layer.conv2
+        history = flow_cache['token_emb'] if flow_cache is not None else token[:, :0]
+        token = torch.concat([history, token], dim=1)
+        if finalize is True:
+            h = self.pre_lookahead_layer(token)
+        else:
+            token, context = token[:, :-self.pre_lookahead_len], token[:, -self.pre_lookahead_len:]
+            h = self.pre_lookahead_layer(token, context=context)
+        h = h[:, history.size(1):]
+        h = h.repeat_interleave(self.token_mel_ratio, dim=1)
+
+        # get conditions
+        conds = torch.zeros([1, h.shape[1], self.output_size], device=token.device).to(h.dtype)
+        if flow_cache is None:
+            # NOTE callers may pass the prompt on every chunk, it is only conditioned on in the first one
+            conds[:, :mel_len1] = prompt_feat
+        conds = conds.transpose(1, 2)
+
+        feat, decoder_cache = self.decoder.forward_chunk(
+            mu=h.transpose(1, 2).contiguous(),
+            n_timesteps=n_timesteps,
+            spks=embedding,
+            cond=conds,
+            cache=flow_cache['decoder'] if flow_cache is not None else None,
+            cfg_rate=cfg_rate,
+            cfg_interval=cfg_interval
+        )
+        feat = feat[:, :, mel_len1:]
+        flow_cache = {'token_emb': token[:, -(self.pre_lookahead_layer.conv2.kernel_size[0] - 1):], 'decoder': decoder_cache}
+        return feat.float(), flow_cache
+
 
 if __name__ == '__main__':
     torch.backends.cudnn.deterministic = True
     torch.backends.cudnn.benchmark = False
     from hyperpyyaml import load_hyperpyyaml
-    with open('./pretrained_models/Fun-CosyVoice3-0.5B-2512/cosyvoice3.yaml', 'r') as f:
-        configs = load_hyperpyyaml(f, overrides={'llm': None, 'hift': None})
-    model = configs['flow']
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    model.to(device)
-    model.eval()
-    max_len = 10 * model.decoder.estimator.static_chunk_size
-    chunk_size = model.decoder.estimator.static_chunk_size
-    context_size = model.pre_lookahead_layer.pre_lookahead_len
-    token = torch.randint(0, 6561, size=(1, max_len)).to(device)
-    token_len = torch.tensor([max_len]).to(device)
-    prompt_token = torch.randint(0, 6561, size=(1, chunk_size)).to(device)
-    prompt_token_len = torch.tensor([chunk_size]).to(device)
-    prompt_feat = torch.rand(1, chunk_size * 2, 80).to(device)
-    prompt_feat_len = torch.tensor([chunk_size * 2]).to(device)
-    prompt_embedding = torch.rand(1, 192).to(device)
-    pred_gt, _ = model.inference(token, token_len, prompt_token, prompt_token_len, prompt_feat, prompt_feat_len, prompt_embedding, streaming=True, finalize=True)
-    for i in range(0, max_len, chunk_size):
-        finalize = True if i + chunk_size + context_size >= max_len else False
-        pred_chunk, _ = model.inference(token[:, :i + chunk_size + context_size], torch.tensor([token[:, :i + chunk_size + context_size].shape[1]]).to(device),
-                                        prompt_token, prompt_token_len, prompt_feat, prompt_feat_len, prompt_embedding, streaming=True, finalize=finalize)
-        pred_chunk = pred_chunk[:, :, i * model.token_mel_ratio:]
-        print((pred_gt[:, :, i * model.token_mel_ratio: i * model.token_mel_ratio + pred_chunk.shape[2]] - pred_chunk).abs().max().item())
+    for config in ['./pretrained_models/Fun-CosyVoice3-0.5B-2512/cosyvoice3.yaml', './pretrained_models/CosyVoice2-0.5B/cosyvoice2.yaml']:
+        with open(config, 'r') as f:
+            configs = load_hyperpyyaml(f, overrides={'llm': None, 'hift': None})
+        model = configs['flow']
+        model.to(device)
+        model.eval()
+        max_len = 10 * model.decoder.estimator.static_chunk_size
+        chunk_size = model.decoder.estimator.static_chunk_size
+        context_size = model.pre_lookahead_len
+        token = torch.randint(0, 6561, size=(1, max_len)).to(device)
+        token_len = torch.tensor([max_len]).to(device)
+        prompt_token = torch.randint(0, 6561, size=(1, chunk_size)).to(device)
+        prompt_token_len = torch.tensor([chunk_size]).to(device)
+        prompt_feat = torch.rand(1, chunk_size * 2, 80).to(device)
+        prompt_feat_len = torch.tensor([chunk_size * 2]).to(device)
+        prompt_embedding = torch.rand(1, 192).to(device)
+        pred_gt, _ = model.inference(token, token_len, prompt_token, prompt_token_len, prompt_feat, prompt_feat_len, prompt_embedding, streaming=True, finalize=True)
+        for i in range(0, max_len, chunk_size):
+            finalize = True if i + chunk_size + context_size >= max_len else False
+            pred_chunk, _ = model.inference(token[:, :i + chunk_size + context_size], torch.tensor([token[:, :i + chunk_size + context_size].shape[1]]).to(device),
+                                            prompt_token, prompt_token_len, prompt_feat, prompt_feat_len, prompt_embedding, streaming=True, finalize=finalize)
+            pred_chunk = pred_chunk[:, :, i * model.token_mel_ratio:]
+            print((pred_gt[:, :, i * model.token_mel_ratio: i * model.token_mel_ratio + pred_chunk.shape[2]] - pred_chunk).abs().max().item())
+        # incremental streaming inference should match the full recompute of each non final chunk in token2wav,
+        # the prompt is passed on every chunk as token2wav does
+        flow_cache = None
+        for i in range(0, max_len, chunk_size):
+            if i + chunk_size + context_size >= max_len:
+                # NOTE the last chunk is decoded by inference(streaming=False) on all tokens in token2wav, not by inference_chunk
+                break
+            pred_full, _ = model.inference(token[:, :i + chunk_size + context_size], torch.tensor([token[:, :i + chunk_size + context_size].shape[1]]).to(device),
+                                           prompt_token, prompt_token_len, prompt_feat, prompt_feat_len, prompt_embedding, streaming=True, finalize=False)
+            pred_full = pred_full[:, :, i * model.token_mel_ratio:]
+            pred_chunk, flow_cache = model.inference_chunk(token[:, i:i + chunk_size + context_size], prompt_token, prompt_feat, prompt_embedding,
+                                                           finalize=False, flow_cache=flow_cache)
+            diff = (pred_full - pred_chunk).abs().max().item()
+            print('{} incremental chunk {} diff {}'.format(config, i // chunk_size, diff))
+            assert pred_full.shape == pred_chunk.shape and diff < 1e-3, 'incremental streaming inference mismatch at chunk {}'.format(i // chunk_size)
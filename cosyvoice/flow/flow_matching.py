@@ -16,6 +16,8 @@ import torch
 import torch.nn.functional as F
 from matcha.models.components.flow_matching import BASECFM
 from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.flow.ode_solver import ODE_SOLVERS, get_t_span
+from cosyvoice.utils.file_utils import logging
 
 
 class ConditionalCFM(BASECFM):
@@ -26,6 +28,9 @@ class ConditionalCFM(BASECFM):
             n_spks=n_spks,
             spk_emb_dim=spk_emb_dim,
         )
+        # NOTE solver and t_scheduler can be changed after loading, e.g. heun with fewer steps
+        self.solver = cfm_params.solver
+        assert self.solver in ODE_SOLVERS, 'unknown solver {}'.format(self.solver)
         self.t_scheduler = cfm_params.t_scheduler
         self.training_cfg_rate = cfm_params.training_cfg_rate
         self.inference_cfg_rate = cfm_params.inference_cfg_rate
@@ -34,7 +39,8 @@ class ConditionalCFM(BASECFM):
         self.estimator = estimator
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2)):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2),
+                cfg_rate=None, cfg_interval=1):
         """Forward diffusion
 
         Args:
@@ -47,6 +53,7 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            cfg_rate, cfg_interval: classifier free guidance of this call, see solve_ode
 
         Returns:
             sample: generated mel-spectrogram
@@ -63,14 +70,12 @@ class ConditionalCFM(BASECFM):
         mu_cache = torch.concat([mu[:, :, :prompt_len], mu[:, :, -34:]], dim=2)
         cache = torch.stack([z_cache, mu_cache], dim=-1)
 
-        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
-        if self.t_scheduler == 'cosine':
-            t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), cache
+        t_span = get_t_span(n_timesteps, self.t_scheduler, device=mu.device, dtype=mu.dtype)
+        return self.solve_ode(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, cfg_rate=cfg_rate, cfg_interval=cfg_interval), cache
 
-    def solve_euler(self, x, t_span, mu, mask, spks, cond, streaming=False):
+    def solve_ode(self, x, t_span, mu, mask, spks, cond, streaming=False, cfg_rate=None, cfg_interval=1):
         """
-        Fixed euler solver for ODEs.
+        Fixed step solver for ODEs, self.solver is one of ODE_SOLVERS.
         Args:
             x (torch.Tensor): random noise
             t_span (torch.Tensor): n_timesteps interpolated
@@ -82,61 +87,98 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            cfg_rate (float, optional): classifier free guidance rate, None for inference_cfg_rate,
+                0 runs the conditional half of the batch only. Defaults to None.
+            cfg_interval (int, optional): the unconditional half is evaluated every cfg_interval estimator calls,
+                other calls run the conditional half only and reuse the last guidance. Defaults to 1.
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        t = t.unsqueeze(dim=0)
-
-        # I am storing this because I can later plot it by putting a debugger here and saving it to a file
-        # Or in future might add like a return_all_steps flag
-        sol = []
-
+        cfg_rate, cfg_interval = self.get_guidance(mu.size(0), cfg_rate, cfg_interval)
         # Do not use concat, it may cause memory format changed and trt infer with wrong results!
         # NOTE when flow run in amp mode, x.dtype is float32, which cause nan in trt fp16 inference, so set dtype=spks.dtype
-        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
-        mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=spks.dtype)
-        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
-        t_in = torch.zeros([2], device=x.device, dtype=spks.dtype)
-        spks_in = torch.zeros([2, 80], device=x.device, dtype=spks.dtype)
-        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
-        for step in range(1, len(t_span)):
+        # NOTE first half of the batch is conditional, second half is unconditional, batch_size = 2 * mu.size(0)
+        b = mu.size(0)
+        x_in = torch.zeros([2 * b, 80, x.size(2)], device=x.device, dtype=spks.dtype)
+        mask_in = torch.zeros([2 * b, 1, x.size(2)], device=x.device, dtype=spks.dtype)
+        mu_in = torch.zeros([2 * b, 80, x.size(2)], device=x.device, dtype=spks.dtype)
+        t_in = torch.zeros([2 * b], device=x.device, dtype=spks.dtype)
+        spks_in = torch.zeros([2 * b, 80], device=x.device, dtype=spks.dtype)
+        cond_in = torch.zeros([2 * b, 80, x.size(2)], device=x.device, dtype=spks.dtype)
+        # mask/mu/spks/cond do not change across steps, so fill them and build the solver context only once
+        mask_in[:b] = mask
+        mask_in[b:] = mask
+        mu_in[:b] = mu
+        spks_in[:b] = spks
+        cond_in[:b] = cond
+        context = self.prepare_context(mask_in, mu_in, spks_in, cond_in, streaming) if cfg_interval != 0 else None
+        cond_context = self.prepare_context(mask_in[:b], mu_in[:b], spks_in[:b], cond_in[:b], streaming) if cfg_interval != 1 else None
+        num_calls, guidance = [0], [None]
+
+        def velocity(x, t):
+            i = num_calls[0]
+            num_calls[0] += 1
+            if cfg_interval == 0 or i % cfg_interval != 0:
+                # conditional half only, NOTE trt writes output into x_in, so always return a new tensor
+                x_in[:b] = x
+                t_in[:b] = t
+                dphi_dt = self.forward_estimator(x_in[:b], mask_in[:b], mu_in[:b], t_in[:b], spks_in[:b], cond_in[:b], streaming, context=cond_context)
+                return dphi_dt.clone() if cfg_interval == 0 else dphi_dt + cfg_rate * guidance[0]
             # Classifier-Free Guidance inference introduced in VoiceBox
-            x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
-            t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
+            x_in[:b] = x
+            x_in[b:] = x
+            t_in[:] = t
             dphi_dt = self.forward_estimator(
                 x_in, mask_in,
                 mu_in, t_in,
                 spks_in,
                 cond_in,
-                streaming
+                streaming,
+                context=context
             )
-            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
+            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [b, b], dim=0)
+            if cfg_interval > 1:
+                guidance[0] = dphi_dt - cfg_dphi_dt
+            return ((1.0 + cfg_rate) * dphi_dt - cfg_rate * cfg_dphi_dt)
+
+        return ODE_SOLVERS[self.solver](velocity, x, t_span).float()
+
+    def get_guidance(self, batch_size, cfg_rate=None, cfg_interval=1):
+        """Resolve guidance of one solve.
 
-        return sol[-1].float()
+        Returns:
+            cfg_rate (float)
+            cfg_interval (int): 0 if the unconditional half is never evaluated, 1 if it is evaluated by every estimator call
+        """
+        cfg_rate = self.inference_cfg_rate if cfg_rate is None else cfg_rate
+        assert cfg_interval >= 1, 'cfg_interval should be at least 1'
+        cfg_interval = 0 if cfg_rate == 0 else cfg_interval
+        if cfg_interval != 1 and not isinstance(self.estimator, torch.nn.Module) and not self.estimator.support_batch_size(batch_size):
+            logging.warning('trt estimator does not support batch size {}, rebuild it from an onnx with dynamic batch, fall back to full guidance'.format(batch_size))
+            cfg_interval = 1
+        return cfg_rate, cfg_interval
 
-    def forward_estimator(self, x, mask, mu, t, spks, cond, streaming=False):
+    def prepare_context(self, mask, mu, spks, cond, streaming=False):
+        """Step invariant inputs of the torch estimator for one ode solve, None for trt estimator."""
+        if isinstance(self.estimator, torch.nn.Module) and hasattr(self.estimator, 'prepare_context'):
+            return self.estimator.prepare_context(mask, mu, spks, cond, streaming=streaming)
+        return None
+
+    def forward_estimator(self, x, mask, mu, t, spks, cond, streaming=False, context=None):
         if isinstance(self.estimator, torch.nn.Module):
+            if context is not None:
+                return self.estimator(x, mask, mu, t, spks, cond, streaming=streaming, context=context)
             return self.estimator(x, mask, mu, t, spks, cond, streaming=streaming)
         else:
-            [estimator, stream], trt_engine = self.estimator.acquire_estimator()
+            # NOTE the context of the optimization profile which fits this shape, e.g. short streaming chunk or long utterance
+            [estimator, stream], trt_engine = self.estimator.acquire_estimator(x.size(0), x.size(2))
             # NOTE need to synchronize when switching stream
             torch.cuda.current_stream().synchronize()
             with stream:
-                estimator.set_input_shape('x', (2, 80, x.size(2)))
-                estimator.set_input_shape('mask', (2, 1, x.size(2)))
-                estimator.set_input_shape('mu', (2, 80, x.size(2)))
-                estimator.set_input_shape('t', (2,))
-                estimator.set_input_shape('spks', (2, 80))
-                estimator.set_input_shape('cond', (2, 80, x.size(2)))
+                estimator.set_input_shape('x', (x.size(0), 80, x.size(2)))
+                estimator.set_input_shape('mask', (x.size(0), 1, x.size(2)))
+                estimator.set_input_shape('mu', (x.size(0), 80, x.size(2)))
+                estimator.set_input_shape('t', (x.size(0),))
+                estimator.set_input_shape('spks', (x.size(0), 80))
+                estimator.set_input_shape('cond', (x.size(0), 80, x.size(2)))
                 data_ptrs = [x.contiguous().data_ptr(),
                              mask.contiguous().data_ptr(),
                              mu.contiguous().data_ptr(),
@@ -201,7 +243,7 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = torch.randn([1, 80, 50 * 300])
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False, cfg_rate=None, cfg_interval=1):
         """Forward diffusion
 
         Args:
@@ -214,15 +256,95 @@ class CausalConditionalCFM(ConditionalCFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            cfg_rate, cfg_interval: classifier free guidance of this call, see solve_ode
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
-        z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
-        # fix prompt and overlap part mu and z
-        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
-        if self.t_scheduler == 'cosine':
-            t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming), None
+        # NOTE every session in the batch uses the same noise as if it was decoded alone
+        z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype).repeat(mu.size(0), 1, 1) * temperature
+        t_span = get_t_span(n_timesteps, self.t_scheduler, device=mu.device, dtype=mu.dtype)
+        return self.solve_ode(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming, cfg_rate=cfg_rate, cfg_interval=cfg_interval), None
+
+    @torch.inference_mode()
+    def forward_chunk(self, mu, n_timesteps, temperature=1.0, spks=None, cond=None, cache=None, cfg_rate=None, cfg_interval=1):
+        """Incremental streaming forward diffusion, only the new frames are denoised
+
+        Args:
+            mu (torch.Tensor): output of encoder for new frames
+                shape: (batch_size, n_feats, new_frames)
+            n_timesteps (int): number of diffusion steps, may differ from previous chunks
+            spks (torch.Tensor): shape: (batch_size, spk_emb_dim)
+            cond (torch.Tensor): shape: (batch_size, n_feats, new_frames)
+            cache (dict, optional): returned by previous call, None for the first chunk
+            cfg_rate, cfg_interval: classifier free guidance of this call, see solve_ode
+
+        Returns:
+            sample: generated mel-spectrogram of new frames
+                shape: (batch_size, n_feats, new_frames)
+            cache: estimator kv/conv cache of every estimator call
+        """
+        t_span = get_t_span(n_timesteps, self.t_scheduler, device=mu.device, dtype=mu.dtype)
+        cfg_rate, cfg_interval = self.get_guidance(mu.size(0), cfg_rate, cfg_interval)
+        if cache is not None and (cache['solver'] != self.solver or not torch.equal(cache['t_span'], t_span) or
+                                  cache['cfg_rate'] != cfg_rate or cache['cfg_interval'] != cfg_interval):
+            # NOTE history frames were solved with another schedule or guidance, e.g. fewer steps for the first chunk,
+            # so rebuild the estimator cache of history frames with this schedule, its output is dropped
+            z = self.rand_noise[:, :, :cache['offset']].to(mu.device).to(mu.dtype) * temperature
+            _, cache = self.solve_ode_chunk(z, t_span=t_span, mu=cache['mu'], spks=spks, cond=cache['cond'], offset=0, cache=None,
+                                            cfg_rate=cfg_rate, cfg_interval=cfg_interval)
+        offset = 0 if cache is None else cache['offset']
+        z = self.rand_noise[:, :, offset:offset + mu.size(2)].to(mu.device).to(mu.dtype) * temperature
+        return self.solve_ode_chunk(z, t_span=t_span, mu=mu, spks=spks, cond=cond, offset=offset, cache=cache, cfg_rate=cfg_rate, cfg_interval=cfg_interval)
+
+    def solve_ode_chunk(self, x, t_span, mu, spks, cond, offset, cache, cfg_rate, cfg_interval):
+        """
+        Fixed step solver which keeps estimator kv/conv cache of history frames for every estimator call,
+        the result is the same as solve_ode on the whole sequence with streaming=True.
+        cfg_rate/cfg_interval are resolved by get_guidance.
+        """
+        assert isinstance(self.estimator, torch.nn.Module) and hasattr(self.estimator, 'forward_chunk'), \
+            'incremental streaming inference is only supported by torch estimator with forward_chunk'
+        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
+        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
+        t_in = torch.zeros([2], device=x.device, dtype=spks.dtype)
+        spks_in = torch.zeros([2, 80], device=x.device, dtype=spks.dtype)
+        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
+        mu_in[0] = mu
+        spks_in[0] = spks
+        cond_in[0] = cond
+        new_att_cache, new_cnn_cache = [], []
+        guidance = [None]
+
+        def velocity(x, t):
+            # Classifier-Free Guidance inference introduced in VoiceBox, i-th estimator call uses i-th cache
+            i = len(new_att_cache)
+            # the conditional half only if the unconditional one is not evaluated by this call
+            n = 1 if cfg_interval == 0 or i % cfg_interval != 0 else 2
+            x_in[:] = x
+            t_in[:] = t
+            dphi_dt, att_cache, cnn_cache = self.estimator.forward_chunk(
+                x_in[:n], mu_in[:n], t_in[:n],
+                spks_in[:n],
+                cond_in[:n],
+                offset,
+                att_cache=cache['att_cache'][i] if cache is not None else torch.zeros(0, 0, 0, 0, 0),
+                cnn_cache=cache['cnn_cache'][i] if cache is not None else torch.zeros(0, 0, 0)
+            )
+            new_att_cache.append(att_cache)
+            new_cnn_cache.append(cnn_cache)
+            if n == 1:
+                return dphi_dt if cfg_interval == 0 else dphi_dt + cfg_rate * guidance[0]
+            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
+            if cfg_interval > 1:
+                guidance[0] = dphi_dt - cfg_dphi_dt
+            return ((1.0 + cfg_rate) * dphi_dt - cfg_rate * cfg_dphi_dt)
+
+        x = ODE_SOLVERS[self.solver](velocity, x, t_span)
+        # mu/cond of all history frames are kept in case a later chunk uses another schedule
+        return x.float(), {'offset': offset + x.size(2), 'att_cache': new_att_cache, 'cnn_cache': new_cnn_cache,
+                           'solver': self.solver, 't_span': t_span, 'cfg_rate': cfg_rate, 'cfg_interval': cfg_interval,
+                           'mu': mu if cache is None else torch.concat([cache['mu'], mu], dim=2),
+                           'cond': cond if cache is None else torch.concat([cache['cond'], cond], dim=2)}
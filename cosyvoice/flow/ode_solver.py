@@ -0,0 +1,100 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Fixed step ODE solvers for flow matching inference.
+
+Every solver takes velocity(x, t) -> dx/dt, the initial noise x and t_span of shape (n_timesteps + 1,)
+going from 0 to 1, and returns x at t_span[-1]. velocity is called a fixed number of times for a given
+solver and t_span, see num_function_evals, so that per call estimator caches can be indexed by call order.
+"""
+import math
+import torch
+
+
+def get_t_span(n_timesteps, t_scheduler='cosine', device=None, dtype=None, sway_coef=-1.0):
+    """Time steps of the solver.
+
+    Args:
+        t_scheduler: linear, cosine (more steps near t=0) or sway (sway sampling of F5-TTS, more steps near t=0 when sway_coef < 0)
+    """
+    t_span = torch.linspace(0, 1, n_timesteps + 1, device=device, dtype=dtype)
+    if t_scheduler == 'cosine':
+        t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
+    elif t_scheduler == 'sway':
+        t_span = t_span + sway_coef * (torch.cos(torch.pi / 2 * t_span) - 1 + t_span)
+    else:
+        assert t_scheduler == 'linear', 'unknown t_scheduler {}'.format(t_scheduler)
+    return t_span
+
+
+def euler(velocity, x, t_span):
+    """First order, one estimator call per step."""
+    t_span = t_span.tolist()
+    for step in range(1, len(t_span)):
+        t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+        x = x + dt * velocity(x, t)
+    return x
+
+
+def midpoint(velocity, x, t_span):
+    """Second order, two estimator calls per step."""
+    t_span = t_span.tolist()
+    for step in range(1, len(t_span)):
+        t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+        v = velocity(x, t)
+        x = x + dt * velocity(x + 0.5 * dt * v, t + 0.5 * dt)
+    return x
+
+
+def heun(velocity, x, t_span):
+    """Second order, two estimator calls per step."""
+    t_span = t_span.tolist()
+    for step in range(1, len(t_span)):
+        t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+        v = velocity(x, t)
+        x_pred = x + dt * v
+        x = x + 0.5 * dt * (v + velocity(x_pred, t + dt))
+    return x
+
+
+def dpm_solver_2m(velocity, x, t_span):
+    """Second order multistep DPM-Solver++(2M), one estimator call per step.
+
+    Flow matching x_t = (1 - t) * x0 + t * x1 is a diffusion with alpha_t = t and sigma_t = 1 - t (sigma_min ignored),
+    the data prediction is x1 = x_t + (1 - t) * v. First order steps equal euler: the first and the last step, and also the second
+    step when t_span starts at t = 0 (as get_t_span does), since lambda_t = log(t / (1 - t)) of the previous step is undefined there.
+    """
+    t_span = t_span.tolist()
+    x1_prev, lambda_prev = None, None
+    for step in range(1, len(t_span)):
+        t, s = t_span[step - 1], t_span[step]
+        v = velocity(x, t)
+        x1 = x + (1 - t) * v
+        lambda_t = math.log(t / (1 - t)) if t > 0 else None
+        if x1_prev is None or lambda_prev is None or step == len(t_span) - 1:
+            x = x + (s - t) * v
+        else:
+            lambda_s = math.log(s / (1 - s))
+            r = (lambda_t - lambda_prev) / (lambda_s - lambda_t)
+            d = (1 + 0.5 / r) * x1 - 0.5 / r * x1_prev
+            x = (1 - s) / (1 - t) * x + (s - (1 - s) * t / (1 - t)) * d
+        x1_prev, lambda_prev = x1, lambda_t
+    return x
+
+
+ODE_SOLVERS = {'euler': euler, 'midpoint': midpoint, 'heun': heun, 'dpm_solver_2m': dpm_solver_2m}
+
+
+def num_function_evals(solver, n_timesteps):
+    """Number of velocity calls of one solve, the same for all inputs."""
+    return n_timesteps * 2 if solver in ['midpoint', 'heun'] else n_timesteps
@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from typing import Dict, Optional, Tuple
 import torch
 import torch.nn as nn
 try:
@@ -101,3 +102,37 @@ class CausalConvRNNF0Predictor(nn.Module):
             x = self.condnet[i](x)
         x = x.transpose(1, 2)
         return torch.abs(self.classifier(x).squeeze(-1))
+
+    def forward_chunk(self, x: torch.Tensor, cache: Optional[Dict] = None, finalize: bool = True) -> Tuple[torch.Tensor, Dict]:
+        """Stateful streaming forward, x only contains new mel frames since last call.
+
+        Args:
+            x: new mel frames (B, in_channels, T)
+            cache: None for the first chunk, otherwise cache returned by last call, it holds the mel frames
+                waiting for right context of condnet[0] and the left context of each causal conv
+            finalize: whether x is the last chunk
+        Returns:
+            torch.Tensor: f0 of frames whose right context is complete since last call, (B, T')
+            Dict: cache for next call
+        """
+        look_right = self.condnet[0].causal_padding
+        if cache is None:
+            cache = {'mel': x[:, :, :0],
+                     'conv': [torch.zeros(x.shape[0], self.condnet[i].in_channels, self.condnet[i].causal_padding).to(x) for i in range(2, len(self.condnet), 2)]}
+        x = torch.concat([cache['mel'], x], dim=2)
+        if finalize is False and x.shape[2] <= look_right:
+            return x.new_zeros(x.shape[0], 0), {'mel': x, 'conv': cache['conv']}
+        if finalize is True:
+            x, mel_cache = self.condnet[0](x), x[:, :, :0]
+        else:
+            x, mel_cache = self.condnet[0](x[:, :, :-look_right], x[:, :, -look_right:]), x[:, :, -look_right:]
+        conv_cache = []
+        for i in range(1, len(self.condnet)):
+            if i % 2 == 0:
+                # NOTE condnet[i] with even i >= 2 is a left causal conv, its cache is the tail of its input
+                conv_cache.append(torch.concat([cache['conv'][i // 2 - 1], x], dim=2)[:, :, -self.condnet[i].causal_padding:])
+                x = self.condnet[i](x, cache['conv'][i // 2 - 1])
+            else:
+                x = self.condnet[i](x)
+        x = x.transpose(1, 2)
+        return torch.abs(self.classifier(x).squeeze(-1)), {'mel': mel_cache, 'conv': conv_cache}
@@ -14,7 +14,8 @@
 
 """HIFI-GAN"""
 
-from typing import Dict, Optional, List
+import copy
+from typing import Dict, Optional, List, Tuple
 import numpy as np
 from scipy.signal import get_window
 import torch
@@ -32,6 +33,7 @@ from cosyvoice.transformer.convolution import CausalConv1d, CausalConv1dDownSamp
 from cosyvoice.transformer.activation import Snake
 from cosyvoice.utils.common import get_padding
 from cosyvoice.utils.common import init_weights
+from cosyvoice.utils.common import set_all_random_seed
 
 
 """hifigan based generator implementation.
@@ -221,6 +223,9 @@ class SineGen2(torch.nn.Module):
         self.upsample_scale = upsample_scale
         self.causal = causal
         if causal is True:
+            # NOTE explicit seed, so the fixed noise does not depend on how many random draws the modules built before took,
+            # e.g. none under init_empty_weights
+            set_all_random_seed(0)
             self.rand_ini = torch.rand(1, 9)
             self.rand_ini[:, 0] = 0
             self.sine_waves = torch.rand(1, 300 * 24000, 9)
@@ -316,6 +321,34 @@ class SineGen2(torch.nn.Module):
         sine_waves = sine_waves * uv + noise
         return sine_waves, uv, noise
 
+    def forward_chunk(self, f0, phase, offset):
+        """ streaming version of forward for causal inference, f0 is a chunk starting at sample offset
+        input F0: tensor(batchsize=1, length, dim=1), length is a multiple of upsample_scale
+        input phase: tensor(batchsize=1, 1, dim), accumulated rad of all frames before this chunk
+        input offset: int, sample offset of this chunk in the utterance
+        output sine_tensor: tensor(batchsize=1, length, dim)
+        output uv: tensor(batchsize=1, length, 1)
+        output rad_cumsum: tensor(batchsize=1, length // upsample_scale, dim), accumulated rad at each frame
+        """
+        assert self.training is False and self.causal is True and self.flag_for_pulse is False
+        fn = torch.multiply(f0, torch.FloatTensor([[range(1, self.harmonic_num + 2)]]).to(f0.device))
+        rad_values = (fn / self.sampling_rate) % 1
+        if offset == 0:
+            rad_values[:, 0, :] = rad_values[:, 0, :] + self.rand_ini.to(rad_values.device)
+        rad_values = torch.nn.functional.interpolate(rad_values.transpose(1, 2),
+                                                     scale_factor=1 / self.upsample_scale,
+                                                     mode="linear").transpose(1, 2)
+        rad_cumsum = torch.cumsum(rad_values, dim=1) + phase
+        phase = torch.nn.functional.interpolate(rad_cumsum.transpose(1, 2) * 2 * np.pi * self.upsample_scale,
+                                                scale_factor=self.upsample_scale, mode="nearest").transpose(1, 2)
+        sine_waves = torch.sin(phase) * self.sine_amp
+
+        uv = self._f02uv(f0)
+        noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
+        noise = noise_amp * self.sine_waves[:, offset:offset + sine_waves.shape[1]].to(sine_waves.device)
+        sine_waves = sine_waves * uv + noise
+        return sine_waves, uv, rad_cumsum
+
 
 class SourceModuleHnNSF(torch.nn.Module):
     """ SourceModule for hn-nsf
@@ -353,6 +386,8 @@ class SourceModuleHnNSF(torch.nn.Module):
         self.l_tanh = torch.nn.Tanh()
         self.causal = causal
         if causal is True:
+            # NOTE explicit seed, see SineGen2
+            set_all_random_seed(1)
             self.uv = torch.rand(1, 300 * 24000, 1)
 
     def forward(self, x):
@@ -374,6 +409,17 @@ class SourceModuleHnNSF(torch.nn.Module):
             noise = torch.randn_like(uv) * self.sine_amp / 3
         return sine_merge, noise, uv
 
+    def forward_chunk(self, x, phase, offset):
+        """
+        streaming version of forward for causal inference, see SineGen2.forward_chunk
+        Sine_source, noise_source, uv, rad_cumsum = SourceModuleHnNSF.forward_chunk(F0_sampled, phase, offset)
+        """
+        with torch.no_grad():
+            sine_wavs, uv, rad_cumsum = self.l_sin_gen.forward_chunk(x, phase, offset)
+        sine_merge = self.l_tanh(self.l_linear(sine_wavs))
+        noise = self.uv[:, offset:offset + uv.shape[1]].to(uv.device) * self.sine_amp / 3
+        return sine_merge, noise, uv, rad_cumsum
+
 
 class HiFTGenerator(nn.Module):
     """
@@ -568,6 +614,39 @@ class HiFTGenerator(nn.Module):
         generated_speech = self.decode(x=speech_feat, s=s)
         return generated_speech, s
 
+    @torch.inference_mode()
+    def inference_batch(self, speech_feats: List[torch.Tensor], cache_sources: List[torch.Tensor]) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        """Vocode mel of several sessions in one right padded batch.
+
+        Source after the end of each session is zeroed, which is what its convs see in single session inference,
+        and speech/source are cut back to each session's own length. Only the last few frames within the right
+        receptive field of the padding can differ slightly from inference.
+
+        Args:
+            speech_feats: list of mel (1, 80, T_i)
+            cache_sources: list of source (1, 1, S_i) of each session, S_i can be 0
+        Returns:
+            list of (speech (1, T_i * hop), source (1, 1, T_i * hop)), same as inference
+        """
+        hop_size = int(np.prod(self.upsample_rates) * self.istft_params['hop_len'])
+        speech_len = [i.shape[2] * hop_size for i in speech_feats]
+        speech_feat = speech_feats[0].new_zeros(len(speech_feats), speech_feats[0].shape[1], max(i.shape[2] for i in speech_feats))
+        for i, feat in enumerate(speech_feats):
+            speech_feat[i, :, :feat.shape[2]] = feat[0]
+        # mel->f0
+        f0 = self.f0_predictor(speech_feat)
+        # f0->source
+        s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
+        s, _, _ = self.m_source(s)
+        s = s.transpose(1, 2)
+        for i, cache_source in enumerate(cache_sources):
+            s[i, :, speech_len[i]:] = 0
+            # use cache_source to avoid glitch
+            if cache_source.shape[2] != 0:
+                s[i, :, :cache_source.shape[2]] = cache_source[0]
+        generated_speech = self.decode(x=speech_feat, s=s)
+        return [(generated_speech[i:i + 1, :speech_len[i]], s[i:i + 1, :, :speech_len[i]]) for i in range(len(speech_feats))]
+
 
 class CausalHiFTGenerator(HiFTGenerator):
     """
@@ -594,6 +673,7 @@ class CausalHiFTGenerator(HiFTGenerator):
             audio_limit: float = 0.99,
             conv_pre_look_right: int = 4,
             f0_predictor: torch.nn.Module = None,
+            f0_backend: str = 'cpu',
     ):
         torch.nn.Module.__init__(self)
 
@@ -668,6 +748,32 @@ class CausalHiFTGenerator(HiFTGenerator):
         self.stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
         self.conv_pre_look_right = conv_pre_look_right
         self.f0_predictor = f0_predictor
+        self.set_f0_backend(f0_backend)
+
+    def set_f0_backend(self, f0_backend: str):
+        """Select where the causal f0 predictor runs, its precision is crucial for causal inference.
+            cpu: float32 on cpu, costs a device sync and two copies per call
+            fp64: float64 copy of f0 predictor on the device of speech_feat, no copy and no sync
+            native: f0 predictor on the device and dtype of speech_feat, fastest but least precise
+        """
+        assert f0_backend in ['cpu', 'fp64', 'native'], 'unknown f0_backend {}'.format(f0_backend)
+        self.f0_backend = f0_backend
+        # NOTE plain dict so that the float64 copy is not registered as submodule and not saved in state_dict
+        self.f0_predictor_fp64 = {}
+
+    def get_f0_predictor(self, device: torch.device):
+        """Return f0 predictor of self.f0_backend, and the device and dtype its input should be moved to."""
+        if self.f0_backend == 'cpu':
+            if next(self.f0_predictor.parameters()).device.type != 'cpu':
+                self.f0_predictor.to('cpu')
+            return self.f0_predictor, torch.device('cpu'), torch.float32
+        if self.f0_backend == 'fp64':
+            if device not in self.f0_predictor_fp64:
+                # built lazily, so that it is a copy of the loaded weights
+                self.f0_predictor_fp64[device] = copy.deepcopy(self.f0_predictor).to(device, torch.float64).eval()
+            return self.f0_predictor_fp64[device], device, torch.float64
+        self.f0_predictor.to(device)
+        return self.f0_predictor, device, None
 
     def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0), finalize: bool = True) -> torch.Tensor:
         s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
@@ -712,9 +818,10 @@ class CausalHiFTGenerator(HiFTGenerator):
 
     @torch.inference_mode()
     def inference(self, speech_feat: torch.Tensor, finalize: bool = True) -> torch.Tensor:
-        # mel->f0 NOTE f0_predictor precision is crucial for causal inference, move self.f0_predictor to cpu if necessary
-        self.f0_predictor.to('cpu')
-        f0 = self.f0_predictor(speech_feat.cpu(), finalize=finalize).to(speech_feat)
+        # mel->f0 NOTE f0_predictor precision is crucial for causal inference, see set_f0_backend
+        f0_predictor, f0_device, f0_dtype = self.get_f0_predictor(speech_feat.device)
+        with torch.cuda.amp.autocast(f0_dtype is None and torch.is_autocast_enabled()):
+            f0 = f0_predictor(speech_feat.to(device=f0_device, dtype=f0_dtype), finalize=finalize).to(speech_feat)
         # f0->source
         s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
         s, _, _ = self.m_source(s)
@@ -725,6 +832,55 @@ class CausalHiFTGenerator(HiFTGenerator):
             generated_speech = self.decode(x=speech_feat[:, :, :-self.f0_predictor.condnet[0].causal_padding], s=s, finalize=finalize)
         return generated_speech, s
 
+    @torch.inference_mode()
+    def inference_chunk(self, speech_feat: torch.Tensor, cache: Optional[Dict] = None, finalize: bool = True,
+                        context_len: int = 32) -> Tuple[torch.Tensor, Dict]:
+        """Stateful streaming inference, speech_feat only contains new mel frames since last call.
+
+        The f0 predictor runs on new frames with its conv cache. The source carries its phase and noise position
+        in cache, and decode reruns only context_len history frames, which covers the left receptive field of
+        the causal decode network (about 22 frames for the CosyVoice3 config), so each call costs O(chunk)
+        instead of re-vocoding the whole accumulated mel as inference does.
+
+        Args:
+            speech_feat: new mel frames (1, 80, T)
+            cache: None for the first chunk, otherwise cache returned by last call
+            finalize: whether speech_feat is the last chunk
+            context_len: number of history mel frames decoded again for left context
+        Returns:
+            torch.Tensor: speech which becomes final since last call
+            Dict: cache for next call
+        """
+        assert isinstance(self.m_source.l_sin_gen, SineGen2), 'inference_chunk is only implemented for SineGen2 source'
+        hop_size = int(np.prod(self.upsample_rates) * self.istft_params['hop_len'])
+        if cache is None:
+            # offset is the first frame of mel/f0 in cache, speech_offset is the number of frames already vocoded
+            cache = {'mel': speech_feat[:, :, :0], 'f0': speech_feat.new_zeros(speech_feat.shape[0], 0), 'f0_cache': None,
+                     'phase': speech_feat.new_zeros(speech_feat.shape[0], 1, self.m_source.l_sin_gen.dim), 'offset': 0, 'speech_offset': 0}
+        mel = torch.concat([cache['mel'], speech_feat], dim=2)
+        # mel->f0 NOTE f0_predictor precision is crucial for causal inference, see set_f0_backend
+        f0_predictor, f0_device, f0_dtype = self.get_f0_predictor(speech_feat.device)
+        with torch.cuda.amp.autocast(f0_dtype is None and torch.is_autocast_enabled()):
+            f0, f0_cache = f0_predictor.forward_chunk(speech_feat.to(device=f0_device, dtype=f0_dtype), cache['f0_cache'], finalize=finalize)
+        f0 = torch.concat([cache['f0'], f0.to(speech_feat)], dim=1)
+        offset, speech_offset = cache['offset'], cache['speech_offset']
+        if finalize is False and f0.shape[1] <= self.conv_pre_look_right + 1:
+            # not enough right context to vocode any new frame yet
+            return speech_feat.new_zeros(speech_feat.shape[0], 0), dict(cache, mel=mel, f0=f0, f0_cache=f0_cache)
+        # f0->source
+        s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
+        s, _, _, rad_cumsum = self.m_source.forward_chunk(s, cache['phase'], offset * hop_size)
+        s = s.transpose(1, 2)
+        generated_speech = self.decode(x=mel[:, :, :f0.shape[1]], s=s, finalize=finalize)
+        new_speech_offset = offset + generated_speech.shape[1] // hop_size
+        generated_speech = generated_speech[:, (speech_offset - offset) * hop_size:]
+        # drop history which is no longer needed as left context
+        trim = max(new_speech_offset - context_len - offset, 0)
+        phase = (rad_cumsum[:, trim - 1:trim] % 1) if trim > 0 else cache['phase']
+        cache = {'mel': mel[:, :, trim:], 'f0': f0[:, trim:], 'f0_cache': f0_cache,
+                 'phase': phase, 'offset': offset + trim, 'speech_offset': new_speech_offset}
+        return generated_speech, cache
+
 
 if __name__ == '__main__':
     torch.backends.cudnn.deterministic = True
@@ -744,3 +900,22 @@ if __name__ == '__main__':
         pred_chunk, _ = model.inference(mel[:, :, : i + chunk_size + context_size], finalize=finalize)
         pred_chunk = pred_chunk[:, i * 480:]
         print((pred_gt[:, i * 480:i * 480 + pred_chunk.shape[1]] - pred_chunk).abs().max().item())
+
+    # incremental inference_chunk should match the full inference as well
+    pred_chunks, cache = [], None
+    for i in range(0, max_len, chunk_size):
+        pred_chunk, cache = model.inference_chunk(mel[:, :, i:i + chunk_size], cache=cache, finalize=i + chunk_size >= max_len)
+        pred_chunks.append(pred_chunk)
+    pred_chunk = torch.concat(pred_chunks, dim=1)
+    assert pred_chunk.shape[1] == pred_gt.shape[1], 'inference_chunk length {} != {}'.format(pred_chunk.shape[1], pred_gt.shape[1])
+    diff = (pred_gt - pred_chunk).abs().max().item()
+    print('inference_chunk diff {}'.format(diff))
+    assert diff < 1e-3, 'inference_chunk mismatch, diff {}'.format(diff)
+
+    # other f0 backends should be close to the default cpu float32 one, f0 errors accumulate in the sine phase so the tolerance is looser
+    for f0_backend, tolerance in [('fp64', 1e-2), ('native', 5e-2)]:
+        model.set_f0_backend(f0_backend)
+        pred, _ = model.inference(mel)
+        diff = (pred_gt - pred).abs().max().item()
+        print('f0_backend {} diff {}'.format(f0_backend, diff))
+        assert diff < tolerance, 'f0_backend {} mismatch, diff {}'.format(f0_backend, diff)
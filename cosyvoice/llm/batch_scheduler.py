@@ -0,0 +1,204 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import queue
+import threading
+from typing import Generator
+import torch
+from transformers import DynamicCache
+from cosyvoice.utils.common import get_batch_sampling
+from cosyvoice.utils.file_utils import logging
+
+
+def to_legacy_cache(cache):
+    return cache.to_legacy_cache() if hasattr(cache, 'to_legacy_cache') else cache
+
+
+class Qwen2LMBatchScheduler:
+    """Continuous batching scheduler for Qwen2LM decoding without vllm.
+
+    All active sessions are decoded together as one left padded batch per step. New sessions are
+    prefilled and merged into the batch between steps, finished sessions leave the batch right after
+    their stop token, so each session still gets its own token generator as in inference_wrapper.
+    NOTE prefill of a newly admitted session runs between two decoding steps, so it delays the tokens of the active sessions.
+    """
+    def __init__(self, lm: torch.nn.Module, max_batch_size: int = 16, fp16: bool = False):
+        self.lm = lm
+        self.max_batch_size = max_batch_size
+        self.fp16 = fp16
+        self.pending = queue.Queue()
+        # batch state, only touched by scheduler thread
+        self.active = []
+        # legacy kv cache of active sessions, each layer is ((B, H, T, D), (B, H, T, D))
+        self.cache = None
+        # left pad length of each active session in cache
+        self.pad = []
+        # batched sampling keeps recent tokens of active sessions on device, (B, win_size)
+        self.batch_sampling = get_batch_sampling(lm.sampling)
+        self.win_size = lm.sampling.keywords.get('win_size', 10) if self.batch_sampling is not None else 0
+        self.window = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the scheduler thread and wait for it, running and pending sessions get an error, call it before dropping the scheduler."""
+        self.stop_event.set()
+        # NOTE wake up the scheduler thread if it blocks on an empty pending queue
+        self.pending.put(None)
+        self.thread.join()
+
+    def submit(self, lm_input: torch.Tensor, sampling: int, min_len: int, max_len: int, uuid: str, prefix=None) -> Generator[int, None, None]:
+        assert not self.stop_event.is_set(), 'llm batch scheduler is stopped'
+        request = {'uuid': uuid, 'lm_input': lm_input, 'sampling': sampling, 'min_len': min_len, 'max_len': max_len, 'prefix': prefix,
+                   'out_tokens': [], 'next_token': None, 'output_queue': queue.Queue(), 'cancelled': False}
+        self.pending.put(request)
+        try:
+            while True:
+                top_ids = request['output_queue'].get()
+                if top_ids is None:
+                    break
+                if isinstance(top_ids, Exception):
+                    raise top_ids
+                yield top_ids
+        finally:
+            # NOTE the consumer stopped early, e.g. cancelled session, the scheduler drops it before next step
+            request['cancelled'] = True
+
+    def loop(self):
+        while not self.stop_event.is_set():
+            try:
+                with torch.inference_mode(), torch.cuda.amp.autocast(self.fp16):
+                    self.admit()
+                    if len(self.active) != 0:
+                        self.step()
+            except Exception as e:
+                logging.error('llm batch scheduler failed, abort {} active sessions'.format(len(self.active)))
+                for request in self.active:
+                    request['output_queue'].put(e)
+                self.active, self.cache, self.pad, self.window = [], None, [], None
+        error = RuntimeError('llm batch scheduler is stopped')
+        for request in self.active:
+            request['output_queue'].put(error)
+        self.active, self.cache, self.pad, self.window = [], None, [], None
+        while not self.pending.empty():
+            request = self.pending.get()
+            if request is not None:
+                request['output_queue'].put(error)
+
+    def admit(self):
+        """Move pending sessions into the batch, block when there is nothing to decode."""
+        while len(self.active) < self.max_batch_size and not self.stop_event.is_set():
+            try:
+                request = self.pending.get(block=len(self.active) == 0)
+            except queue.Empty:
+                break
+            if request is None or request['cancelled'] is True:
+                continue
+            try:
+                self.prefill(request)
+            except Exception as e:
+                request['output_queue'].put(e)
+
+    def prefill(self, request):
+        if request['max_len'] <= 0:
+            request['output_queue'].put(None)
+            return
+        lm_input = request['lm_input']
+        dtype = torch.get_autocast_gpu_dtype() if torch.is_autocast_enabled() else lm_input.dtype
+        prefix_kv = self.lm.get_prefix_kv(request['prefix'], dtype, lm_input.device)
+        if prefix_kv is not None:
+            # NOTE DynamicCache concatenates into new tensors, so the cached prefix snapshot is never modified
+            y_pred, cache = self.lm.llm.forward_one_step(lm_input[:, request['prefix'][1]:],
+                                                         masks=torch.ones((1, 1, lm_input.shape[1]), dtype=torch.bool, device=lm_input.device),
+                                                         cache=DynamicCache.from_legacy_cache(prefix_kv))
+        else:
+            y_pred, cache = self.lm.llm.forward_one_step(lm_input,
+                                                         masks=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool),
+                                                         cache=None)
+            self.lm.put_prefix_kv(request['prefix'], to_legacy_cache(cache))
+        logp = self.lm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+        if self.emit(request, logp=logp.squeeze(dim=0)) is False:
+            return
+        cache = to_legacy_cache(cache)
+        cache_len, batch_len = cache[0][0].shape[2], self.cache[0][0].shape[2] if self.cache is not None else 0
+        if self.cache is None:
+            self.cache = cache
+        else:
+            # left pad the shorter one so that all sessions end at the same position
+            cache = [(torch.nn.functional.pad(k, (0, 0, batch_len - cache_len, 0)), torch.nn.functional.pad(v, (0, 0, batch_len - cache_len, 0)))
+                     for k, v in cache] if cache_len < batch_len else cache
+            self.cache = [(torch.nn.functional.pad(k, (0, 0, cache_len - batch_len, 0)), torch.nn.functional.pad(v, (0, 0, cache_len - batch_len, 0)))
+                          for k, v in self.cache] if cache_len > batch_len else self.cache
+            self.pad = [i + max(cache_len - batch_len, 0) for i in self.pad]
+            self.cache = [(torch.concat([k1, k2], dim=0), torch.concat([v1, v2], dim=0)) for (k1, v1), (k2, v2) in zip(self.cache, cache)]
+        self.active.append(request)
+        self.pad.append(max(batch_len - cache_len, 0))
+        if self.batch_sampling is not None:
+            window = torch.tensor([([-1] * self.win_size + request['out_tokens'])[-self.win_size:]], device=lm_input.device)
+            self.window = window if self.window is None else torch.concat([self.window, window], dim=0)
+
+    def step(self):
+        device = self.cache[0][0].device
+        cache_len = self.cache[0][0].shape[2]
+        pad = torch.tensor(self.pad, device=device)
+        attention_mask = (torch.arange(cache_len + 1, device=device).unsqueeze(dim=0) >= pad.unsqueeze(dim=1)).long()
+        position_ids = (cache_len - pad).unsqueeze(dim=1)
+        xs = self.lm.speech_embedding.weight[[request['next_token'] for request in self.active]].unsqueeze(dim=1)
+        y_pred, cache = self.lm.llm.forward_batch_step(xs, attention_mask, position_ids, cache=DynamicCache.from_legacy_cache(self.cache))
+        self.cache = to_legacy_cache(cache)
+        logp = self.lm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+        if self.batch_sampling is not None:
+            # NOTE stop tokens are masked out for sessions shorter than min_len instead of resampled, so there is only one host sync per step
+            ignore_eos = torch.tensor([len(request['out_tokens']) < request['min_len'] for request in self.active], device=device)
+            logp[:, self.lm.speech_token_size:] = logp[:, self.lm.speech_token_size:].masked_fill(ignore_eos.unsqueeze(dim=1), -float('inf'))
+            top_ids = self.batch_sampling(logp, self.window)
+            self.window = torch.concat([self.window[:, 1:], top_ids.unsqueeze(dim=1)], dim=1)
+            top_ids = top_ids.tolist()
+            keep = [i for i, request in enumerate(self.active) if self.emit(request, top_ids=top_ids[i]) is True]
+        else:
+            keep = [i for i, request in enumerate(self.active) if self.emit(request, logp=logp[i]) is True]
+        if len(keep) != len(self.active):
+            self.remove(keep)
+
+    def emit(self, request, logp=None, top_ids=None):
+        """Sample next token of one session if top_ids is not given, return False if the session is finished."""
+        if request['cancelled'] is True:
+            return False
+        out_tokens = request['out_tokens']
+        if top_ids is None:
+            top_ids = self.lm.sampling_ids(logp, out_tokens, request['sampling'], ignore_eos=True if len(out_tokens) < request['min_len'] else False)
+        if top_ids in self.lm.stop_token_ids:
+            request['output_queue'].put(None)
+            return False
+        request['output_queue'].put(top_ids)
+        out_tokens.append(top_ids)
+        if len(out_tokens) == request['max_len']:
+            request['output_queue'].put(None)
+            return False
+        request['next_token'] = top_ids
+        return True
+
+    def remove(self, keep):
+        if len(keep) == 0:
+            self.active, self.cache, self.pad, self.window = [], None, [], None
+            return
+        index = torch.tensor(keep, device=self.cache[0][0].device)
+        self.active = [self.active[i] for i in keep]
+        self.pad = [self.pad[i] for i in keep]
+        # drop pad columns shared by all remaining sessions
+        trim = min(self.pad)
+        self.cache = [(k.index_select(0, index)[:, :, trim:], v.index_select(0, index)[:, :, trim:]) for k, v in self.cache]
+        self.pad = [i - trim for i in self.pad]
+        if self.window is not None:
+            self.window = self.window.index_select(0, index)
@@ -12,21 +12,20 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import queue
 import random
-import time
 import threading
 from typing import Dict, Optional, Callable, List, Generator
 import numpy as np
 import torch
 from torch import nn
 import torch.nn.functional as F
-from transformers import Qwen2ForCausalLM
+import transformers
+from transformers import Qwen2Config, Qwen2ForCausalLM, StaticCache
 from torch.nn.utils.rnn import pad_sequence, unpad_sequence
 from cosyvoice.utils.common import IGNORE_ID
 from cosyvoice.transformer.label_smoothing_loss import LabelSmoothingLoss
 from cosyvoice.utils.common import th_accuracy
-from cosyvoice.utils.file_utils import logging
+from cosyvoice.utils.file_utils import logging, empty_weights_enabled
 from cosyvoice.utils.mask import make_pad_mask
 
 
@@ -177,7 +176,9 @@ class TransformerLM(torch.nn.Module):
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
             uuid: str = '',
+            speculative: bool = False,
     ) -> Generator[torch.Tensor, None, None]:
+        assert speculative is False, 'speculative decoding is only implemented for Qwen2LM'
         device = text.device
         text = torch.concat([prompt_text, text], dim=1)
         text_len += prompt_text_len
@@ -210,12 +211,10 @@ class TransformerLM(torch.nn.Module):
         # 5. step by step decode
         out_tokens = []
         offset = 0
-        att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
+        dtype = torch.get_autocast_gpu_dtype() if torch.is_autocast_enabled() else lm_input.dtype
+        att_cache = self.llm.init_incremental_cache(lm_input.size(1) + max_len, lm_input.device, dtype)
         for i in range(max_len):
-            y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
-                                                                  att_cache=att_cache, cnn_cache=cnn_cache,
-                                                                  att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
-                                                                                                 device=lm_input.device)).to(torch.bool))
+            y_pred = self.llm.forward_incremental(lm_input, offset, att_cache)
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
             top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False)
             if top_ids == self.eos_token:
@@ -230,7 +229,16 @@ class TransformerLM(torch.nn.Module):
 class Qwen2Encoder(torch.nn.Module):
     def __init__(self, pretrain_path):
         super().__init__()
-        self.model = Qwen2ForCausalLM.from_pretrained(pretrain_path)
+        if empty_weights_enabled():
+            # NOTE pretrained weights are overwritten by llm.pt anyway, only build the architecture
+            self.model = Qwen2ForCausalLM(Qwen2Config.from_pretrained(pretrain_path))
+        else:
+            self.model = Qwen2ForCausalLM.from_pretrained(pretrain_path)
+        # single token decode step on static cache, can be replaced by torch.compile(mode='reduce-overhead') version
+        self.decode_step = self.forward_one_step_static
+        # released static caches are reused, so compiled decode step sees the same cache buffers
+        self.static_cache_pool = []
+        self.static_cache_lock = threading.Lock()
 
     def forward(self, xs: torch.Tensor, xs_lens: torch.Tensor):
         T = xs.size(1)
@@ -257,6 +265,63 @@ class Qwen2Encoder(torch.nn.Module):
         new_cache = outs.past_key_values
         return xs, new_cache
 
+    def acquire_static_cache(self, max_cache_len, device, dtype, bucket_size=512):
+        """Preallocated kv cache of at least max_cache_len, so decoding never reallocates or concatenates cache.
+        max_cache_len is rounded up to bucket_size to limit the number of different cache shapes.
+        """
+        max_cache_len = (max_cache_len + bucket_size - 1) // bucket_size * bucket_size
+        with self.static_cache_lock:
+            for i, cache in enumerate(self.static_cache_pool):
+                if cache.max_cache_len == max_cache_len and cache.key_cache[0].device == device and cache.key_cache[0].dtype == dtype:
+                    return self.static_cache_pool.pop(i)
+        cache = StaticCache(config=self.model.config, max_batch_size=1, max_cache_len=max_cache_len, device=device, dtype=dtype)
+        # NOTE per layer key_cache/value_cache preallocated by the constructor is the StaticCache api of the transformers pinned in requirements.txt,
+        # later releases keep the kv in cache.layers and allocate it on the first update, fail here instead of in the middle of decoding
+        assert len(getattr(cache, 'key_cache', [])) == self.model.config.num_hidden_layers, \
+            'static kv cache needs the transformers version pinned in requirements.txt, got {}'.format(transformers.__version__)
+        return cache
+
+    def release_static_cache(self, cache):
+        cache.reset()
+        with self.static_cache_lock:
+            self.static_cache_pool.append(cache)
+
+    def forward_one_step_static(self, xs, cache, cache_position):
+        """Forward xs at cache_position on a StaticCache, the causal mask is derived from cache_position.
+        After prefill, xs is always (1, 1, D) and cache_position is (1,), so the step has fixed shapes
+        and can be captured by cuda graph.
+        """
+        outs = self.model.model(
+            inputs_embeds=xs,
+            past_key_values=cache,
+            cache_position=cache_position,
+            use_cache=True,
+            return_dict=True,
+        )
+        return outs.last_hidden_state
+
+    def forward_batch_step(self, xs, attention_mask, position_ids, cache=None):
+        """One decode step over a left padded batch of sessions.
+
+        Args:
+            xs: (B, 1, D) input embedding of each session
+            attention_mask: (B, T + 1), 0 for left padded cache positions
+            position_ids: (B, 1) position of xs in each session
+            cache: past key values of the padded batch
+        """
+        outs = self.model(
+            inputs_embeds=xs,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            output_hidden_states=True,
+            return_dict=True,
+            use_cache=True,
+            past_key_values=cache,
+        )
+        xs = outs.hidden_states[-1]
+        new_cache = outs.past_key_values
+        return xs, new_cache
+
 
 class Qwen2LM(TransformerLM):
     def __init__(
@@ -299,7 +364,6 @@ class Qwen2LM(TransformerLM):
 
         # 5. vllm related
         self.stop_token_ids = [speech_token_size + i for i in range(3)]
-        self.vllm_output_queue = {}
 
     def prepare_lm_input_target(self, sos_emb, text_token, text_token_emb, text_token_len, task_id_emb, speech_token, speech_token_emb, speech_token_len):
         lm_target, lm_input = [], []
@@ -446,8 +510,11 @@ class Qwen2LM(TransformerLM):
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
             uuid: str = '',
+            speculative: bool = False,
     ) -> Generator[torch.Tensor, None, None]:
         device = text.device
+        # NOTE [sos, prompt_text] is the only part of lm_input shared by requests with the same voice/instruction
+        prefix = (tuple(prompt_text[0].tolist()), 1 + prompt_text.shape[1]) if hasattr(self, 'prefix_cache') and prompt_text.shape[1] >= self.prefix_cache.min_len else None
         text = torch.concat([prompt_text, text], dim=1)
         text_len += prompt_text_len
         text = self.llm.model.model.embed_tokens(text)
@@ -466,30 +533,49 @@ class Qwen2LM(TransformerLM):
         max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
 
         # 5. step by step decode
-        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid):
+        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid, speculative=speculative, prefix=prefix):
             yield token
 
+    def get_prefix_kv(self, prefix, dtype, device):
+        """Cached kv snapshot of the prompt prefix, prefix is (prompt_text token ids, prefix length) or None."""
+        if prefix is None or not hasattr(self, 'prefix_cache'):
+            return None
+        return self.prefix_cache.get(self.prefix_cache.key(prefix[0], dtype, device))
+
+    def put_prefix_kv(self, prefix, kv):
+        """Snapshot the prompt prefix positions of kv, a list of (key, value) of each layer which covers at least the prefix."""
+        if prefix is None or not hasattr(self, 'prefix_cache'):
+            return
+        kv = [(k[:, :, :prefix[1]].clone(), v[:, :, :prefix[1]].clone()) for k, v in kv]
+        self.prefix_cache.put(self.prefix_cache.key(prefix[0], kv[0][0].dtype, kv[0][0].device), kv)
+
+    def fork_prefix_kv(self, prefix, cache, dtype):
+        """Copy the cached kv of the prompt prefix into a StaticCache, returns the number of filled positions, 0 on miss."""
+        prefix_kv = self.get_prefix_kv(prefix, dtype, cache.key_cache[0].device)
+        if prefix_kv is None:
+            return 0
+        for i, (k, v) in enumerate(prefix_kv):
+            cache.key_cache[i][:, :, :prefix[1]].copy_(k)
+            cache.value_cache[i][:, :, :prefix[1]].copy_(v)
+        return prefix[1]
+
     @torch.inference_mode()
-    def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid):
-        if hasattr(self, 'vllm'):
-            from vllm import SamplingParams, RequestOutput
+    def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid, speculative=False, prefix=None):
+        if speculative is True:
+            assert hasattr(self, 'draft'), 'speculative decoding needs a draft, call load_speculative first'
+            for top_ids in self.inference_speculative(lm_input, sampling, min_len, max_len, prefix=prefix):
+                yield top_ids
+        elif hasattr(self, 'vllm'):
+            from vllm import SamplingParams
             sampling_params = SamplingParams(top_k=sampling,
                                              stop_token_ids=self.stop_token_ids,
                                              min_tokens=min_len,
                                              max_tokens=max_len)
-            with self.lock:
-                self.vllm.add_request(uuid, {"prompt_embeds": lm_input.squeeze(0).to(torch.bfloat16).to(lm_input.device)}, sampling_params)
-                self.vllm_output_queue[uuid] = queue.Queue()
+            # self.vllm is a VllmEngineDriver, the engine is stepped by its own thread and tokens are pushed to this request
+            token_generator = self.vllm.submit(uuid, {"prompt_embeds": lm_input.squeeze(0).to(torch.bfloat16).to(lm_input.device)}, sampling_params)
             out_tokens = []
-            while True:
-                with self.lock:
-                    if self.vllm_output_queue[uuid].empty() is True:
-                        request_outputs: List[RequestOutput] = self.vllm.step()
-                        for request_output in request_outputs:
-                            top_ids = list(request_output.outputs[0].token_ids)[-1]
-                            self.vllm_output_queue[request_output.request_id].put(top_ids)
-                if self.vllm_output_queue[uuid].empty() is False:
-                    top_ids = self.vllm_output_queue[uuid].get()
+            try:
+                for top_ids in token_generator:
                     if top_ids in self.stop_token_ids:
                         break
                     # in stream mode, yield token one by one
@@ -497,24 +583,89 @@ class Qwen2LM(TransformerLM):
                     out_tokens.append(top_ids)
                     if len(out_tokens) == max_len:
                         break
-                time.sleep(0.001)
-            with self.lock:
-                self.vllm_output_queue.pop(uuid)
+            finally:
+                # NOTE aborts the request in the engine if it is not finished, e.g. cancelled session
+                token_generator.close()
+        elif hasattr(self, 'batch_scheduler'):
+            for top_ids in self.batch_scheduler.submit(lm_input, sampling, min_len, max_len, uuid, prefix=prefix):
+                yield top_ids
         else:
             out_tokens = []
-            cache = None
-            for i in range(max_len):
-                y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                          masks=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool),
-                                                          cache=cache)
-                logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-                top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False)
-                if top_ids in self.stop_token_ids:
+            dtype = torch.get_autocast_gpu_dtype() if torch.is_autocast_enabled() else lm_input.dtype
+            cache = self.llm.acquire_static_cache(lm_input.shape[1] + max_len, lm_input.device, dtype)
+            # only the part of lm_input after a cached prompt prefix is prefilled
+            offset = self.fork_prefix_kv(prefix, cache, dtype)
+            cache_position = torch.arange(offset, lm_input.shape[1], device=lm_input.device)
+            lm_input = lm_input[:, offset:]
+            # NOTE prefill runs eagerly as its shape changes with prompt length, only decode step uses self.llm.decode_step
+            step = self.llm.forward_one_step_static
+            try:
+                for i in range(max_len):
+                    y_pred = step(lm_input, cache, cache_position)
+                    if i == 0 and offset == 0:
+                        self.put_prefix_kv(prefix, zip(cache.key_cache, cache.value_cache))
+                    logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+                    top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False)
+                    if top_ids in self.stop_token_ids:
+                        break
+                    # in stream mode, yield token one by one
+                    yield top_ids
+                    out_tokens.append(top_ids)
+                    lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
+                    cache_position = cache_position[-1:] + 1
+                    step = self.llm.decode_step
+            finally:
+                self.llm.release_static_cache(cache)
+
+    def inference_speculative(self, lm_input, sampling, min_len, max_len, prefix=None):
+        """Speculative decoding, tokens proposed by self.draft are verified by one forward of the main lm.
+
+        Every output token is still drawn by sampling_ids from the main lm logits given the accepted tokens, a draft
+        token is accepted only when it equals the sampled token, so the output follows the same sampling (e.g. ras)
+        as inference_wrapper, and the first mismatched sample is emitted as the correction.
+        """
+        out_tokens = []
+        dtype = torch.get_autocast_gpu_dtype() if torch.is_autocast_enabled() else lm_input.dtype
+        cache = self.llm.acquire_static_cache(lm_input.shape[1] + max_len, lm_input.device, dtype)
+        draft_state = self.draft.start(lm_input)
+        # xs holds the tokens not yet in cache, the prompt after the cached prompt prefix at first and then the last output token
+        offset = self.fork_prefix_kv(prefix, cache, dtype)
+        xs, save_prefix = lm_input[:, offset:], offset == 0
+        try:
+            while True:
+                # NOTE never propose beyond max_len, so cache position is bounded by prompt length + max_len
+                num_draft_tokens = min(self.draft.num_draft_tokens, max_len - len(out_tokens) - 1)
+                draft_tokens = self.draft.propose(draft_state, out_tokens, num_draft_tokens) if len(out_tokens) != 0 and num_draft_tokens > 0 else []
+                if len(draft_tokens) != 0:
+                    xs = torch.concat([xs, self.speech_embedding.weight[draft_tokens].unsqueeze(dim=0)], dim=1)
+                cache_position = torch.arange(offset, offset + xs.shape[1], device=lm_input.device)
+                y_pred = self.llm.forward_one_step_static(xs, cache, cache_position)
+                if save_prefix is True:
+                    self.put_prefix_kv(prefix, zip(cache.key_cache, cache.value_cache))
+                    save_prefix = False
+                logp = self.llm_decoder(y_pred[0, -len(draft_tokens) - 1:]).log_softmax(dim=-1)
+                finished = False
+                for i in range(len(draft_tokens) + 1):
+                    top_ids = self.sampling_ids(logp[i], out_tokens, sampling, ignore_eos=True if len(out_tokens) < min_len else False)
+                    if top_ids in self.stop_token_ids:
+                        finished = True
+                        break
+                    # in stream mode, yield token one by one
+                    yield top_ids
+                    out_tokens.append(top_ids)
+                    if len(out_tokens) == max_len:
+                        finished = True
+                        break
+                    if i == len(draft_tokens) or top_ids != draft_tokens[i]:
+                        break
+                self.draft.update_stats(len(draft_tokens), i)
+                if finished is True:
                     break
-                # in stream mode, yield token one by one
-                yield top_ids
-                out_tokens.append(top_ids)
-                lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
+                # rejected draft tokens stay in cache beyond offset, they are masked by cache_position and overwritten later
+                offset += xs.shape[1] - len(draft_tokens) + i
+                xs = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
+        finally:
+            self.llm.release_static_cache(cache)
 
     @torch.inference_mode()
     def inference_bistream(
@@ -657,7 +808,6 @@ class CosyVoice3LM(Qwen2LM):
 
         # 5. vllm related
         self.stop_token_ids = [speech_token_size + i for i in range(200)]
-        self.vllm_output_queue = {}
 
     def forward(
             self,
@@ -715,8 +865,11 @@ class CosyVoice3LM(Qwen2LM):
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
             uuid: str = '',
+            speculative: bool = False,
     ) -> Generator[torch.Tensor, None, None]:
         device = text.device
+        # NOTE [sos, prompt_text] is the only part of lm_input shared by requests with the same voice/instruction
+        prefix = (tuple(prompt_text[0].tolist()), 1 + prompt_text.shape[1]) if hasattr(self, 'prefix_cache') and prompt_text.shape[1] >= self.prefix_cache.min_len else None
         text = torch.concat([prompt_text, text], dim=1)
         text_len += prompt_text_len
         text = self.llm.model.model.embed_tokens(text)
@@ -735,5 +888,5 @@ class CosyVoice3LM(Qwen2LM):
         max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
 
         # 5. step by step decode
-        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid):
+        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid, speculative=speculative, prefix=prefix):
             yield token
@@ -0,0 +1,69 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+import torch
+
+
+class PrefixKVCache:
+    """LRU cache of the llm kv of the prompt prefix [sos, prompt_text] shared by requests with the same voice/instruction.
+
+    lm input is [sos, prompt_text, text, task_id, prompt_speech_token], the kv of a position only depends on the positions
+    before it, so only [sos, prompt_text] is the same across requests, everything after it depends on text.
+    Entries are legacy kv snapshots, each layer is ((1, H, P, D), (1, H, P, D)). Snapshots are never written in place,
+    a request forks one by copying it into its own static cache, or by DynamicCache which concatenates into new tensors.
+    """
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, min_len: int = 8):
+        """
+        Args:
+            max_bytes: memory budget of all snapshots, least recently used ones are evicted first
+            min_len: prefixes shorter than min_len are not cached, their prefill is cheaper than a cache lookup
+        """
+        self.max_bytes = max_bytes
+        self.min_len = min_len
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def key(prompt_text: Tuple[int, ...], dtype: torch.dtype, device: torch.device) -> tuple:
+        return (prompt_text, str(dtype), str(device))
+
+    def get(self, key: tuple) -> Optional[List[Tuple[torch.Tensor, torch.Tensor]]]:
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: tuple, kv: List[Tuple[torch.Tensor, torch.Tensor]]):
+        size = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in kv)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = kv
+            self.num_bytes += size
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.num_bytes -= sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in evicted)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.num_bytes, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,108 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import copy
+import threading
+from typing import List
+import torch
+from transformers import DynamicCache
+
+
+class SpeculativeDraft:
+    """Base class of draft proposers used by Qwen2LM.inference_speculative.
+
+    A draft is shared by all sessions, so per session state is created by start and passed back to propose.
+    """
+    def __init__(self, num_draft_tokens: int = 4):
+        self.num_draft_tokens = num_draft_tokens
+        self.lock = threading.Lock()
+        self.num_proposed, self.num_accepted = 0, 0
+
+    def start(self, lm_input: torch.Tensor):
+        return None
+
+    def propose(self, state, out_tokens: List[int], num_tokens: int) -> List[int]:
+        """Propose at most num_tokens speech tokens following out_tokens."""
+        raise NotImplementedError
+
+    def update_stats(self, num_proposed: int, num_accepted: int):
+        with self.lock:
+            self.num_proposed += num_proposed
+            self.num_accepted += num_accepted
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'proposed': self.num_proposed, 'accepted': self.num_accepted,
+                    'accept_rate': self.num_accepted / max(self.num_proposed, 1)}
+
+
+class NgramDraft(SpeculativeDraft):
+    """Propose the tokens that followed the latest earlier occurrence of the current suffix of decoded tokens.
+
+    Costs no model forward, works well on repetitive speech token like silence and long vowels.
+    """
+    def __init__(self, num_draft_tokens: int = 4, ngram_size: int = 3):
+        super().__init__(num_draft_tokens)
+        self.ngram_size = ngram_size
+
+    def propose(self, state, out_tokens: List[int], num_tokens: int) -> List[int]:
+        for n in range(min(self.ngram_size, len(out_tokens) - 1), 0, -1):
+            suffix = out_tokens[-n:]
+            for i in range(len(out_tokens) - n - 1, -1, -1):
+                if out_tokens[i:i + n] == suffix:
+                    return out_tokens[i + n:i + n + num_tokens]
+        return []
+
+
+class LayerSkipDraft(SpeculativeDraft):
+    """Greedy draft by the first num_layers decoder layers of the Qwen2LM backbone and the shared llm_decoder.
+
+    There is no extra weight, each session keeps its own DynamicCache of the truncated model, which is cropped
+    to the tokens accepted by the main lm before proposing.
+    """
+    def __init__(self, lm: torch.nn.Module, num_layers: int, num_draft_tokens: int = 4):
+        super().__init__(num_draft_tokens)
+        model = lm.llm.model.model
+        assert 0 < num_layers < len(model.layers), 'draft layers should be less than lm layers'
+        self.lm = lm
+        self.num_layers = num_layers
+        # NOTE shallow copy of the Qwen2Model whose layer list holds the first num_layers layers, so the draft runs the public forward
+        # with the shared weights, instead of reimplementing it with transformers internals, and the main model is left untouched
+        self.model = copy.copy(model)
+        self.model._modules = dict(model._modules)
+        self.model.layers = torch.nn.ModuleList(model.layers[:num_layers])
+
+    def forward(self, xs: torch.Tensor, cache: DynamicCache) -> torch.Tensor:
+        outs = self.model(inputs_embeds=xs, past_key_values=cache, use_cache=True, return_dict=True)
+        return self.lm.llm_decoder(outs.last_hidden_state[:, -1])
+
+    def start(self, lm_input: torch.Tensor):
+        state = {'cache': DynamicCache(), 'prompt_len': lm_input.size(1), 'tokens': []}
+        self.forward(lm_input, state['cache'])
+        return state
+
+    def propose(self, state, out_tokens: List[int], num_tokens: int) -> List[int]:
+        # keep the longest prefix of drafted tokens that is accepted, then feed the rest of out_tokens
+        common = 0
+        while common < min(len(state['tokens']), len(out_tokens) - 1) and state['tokens'][common] == out_tokens[common]:
+            common += 1
+        state['cache'].crop(state['prompt_len'] + common)
+        state['tokens'] = out_tokens[:common]
+        xs, draft_tokens = out_tokens[common:], []
+        while len(draft_tokens) < num_tokens:
+            logits = self.forward(self.lm.speech_embedding.weight[xs].unsqueeze(dim=0), state['cache'])
+            state['tokens'] += xs
+            top_ids = logits[0, :self.lm.speech_token_size].argmax().item()
+            draft_tokens.append(top_ids)
+            xs = [top_ids]
+        return draft_tokens
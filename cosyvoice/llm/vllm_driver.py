@@ -0,0 +1,112 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import queue
+import threading
+from typing import Generator
+from cosyvoice.utils.file_utils import logging
+
+
+class VllmEngineDriver:
+    """Single thread which owns a vllm LLMEngine and steps it while there are unfinished requests.
+
+    Request threads never touch the engine, submit() hands add/abort commands to the driver thread and blocks on
+    its own output queue, the driver applies commands between steps and fans out new tokens of each step.
+    The engine only needs add_request(request_id, prompt, sampling_params), abort_request(request_id) and step(),
+    which returns outputs with request_id, outputs[0].token_ids and finished, so a fake engine can be used without gpu.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.commands = queue.Queue()
+        # driver state, only touched by driver thread, request_id -> {'output_queue', 'num_tokens'}
+        self.requests = {}
+        self.num_steps = 0
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, request_id: str, prompt: dict, sampling_params) -> Generator[int, None, None]:
+        output_queue = queue.Queue()
+        self.commands.put(('add', request_id, prompt, sampling_params, output_queue))
+        finished = False
+        try:
+            while True:
+                token = output_queue.get()
+                if token is None:
+                    finished = True
+                    break
+                if isinstance(token, Exception):
+                    finished = True
+                    raise token
+                yield token
+        finally:
+            # NOTE the consumer stopped early, e.g. cancelled session, do not keep decoding it in the engine
+            if finished is False:
+                self.commands.put(('abort', request_id))
+
+    def loop(self):
+        while True:
+            try:
+                self.apply_commands()
+                if len(self.requests) != 0:
+                    self.step()
+            except Exception as e:
+                logging.error('vllm engine driver failed, abort {} requests'.format(len(self.requests)))
+                for request_id, request in self.requests.items():
+                    request['output_queue'].put(e)
+                    try:
+                        self.engine.abort_request(request_id)
+                    except Exception:
+                        pass
+                self.requests = {}
+
+    def apply_commands(self):
+        """Apply pending add/abort commands, block when there is nothing to step."""
+        block = len(self.requests) == 0
+        while True:
+            try:
+                command = self.commands.get(block=block)
+            except queue.Empty:
+                break
+            block = False
+            # NOTE errors are handled per command, a failed command must not fail the other requests or skip the commands after it
+            if command[0] == 'add':
+                _, request_id, prompt, sampling_params, output_queue = command
+                try:
+                    self.engine.add_request(request_id, prompt, sampling_params)
+                except Exception as e:
+                    logging.error('vllm engine driver failed to add request {}: {}'.format(request_id, e))
+                    output_queue.put(e)
+                    continue
+                self.requests[request_id] = {'output_queue': output_queue, 'num_tokens': 0}
+            elif self.requests.pop(command[1], None) is not None:
+                # already finished requests are not in self.requests, only abort running ones
+                try:
+                    self.engine.abort_request(command[1])
+                except Exception as e:
+                    # the consumer of an aborted request is gone, nobody else to report to
+                    logging.error('vllm engine driver failed to abort request {}: {}'.format(command[1], e))
+
+    def step(self):
+        self.num_steps += 1
+        for request_output in self.engine.step():
+            request = self.requests.get(request_output.request_id)
+            if request is None:
+                continue
+            # one step can produce several tokens of a request, e.g. multi step scheduling, send all new ones
+            token_ids = request_output.outputs[0].token_ids
+            for token in token_ids[request['num_tokens']:]:
+                request['output_queue'].put(token)
+            request['num_tokens'] = len(token_ids)
+            if request_output.finished:
+                request['output_queue'].put(None)
+                self.requests.pop(request_output.request_id)
@@ -196,6 +196,44 @@ class MultiHeadedAttention(nn.Module):
         scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
         return self.forward_attention(v, scores, mask), new_cache
 
+    def attention_scores(self, q: torch.Tensor, k: torch.Tensor,
+                         pos_emb: torch.Tensor) -> torch.Tensor:
+        """Compute attention scores (#batch, head, time1, time2) from
+            q (#batch, head, time1, d_k) and k (#batch, head, time2, d_k).
+        """
+        return torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
+
+    def forward_incremental(
+        self,
+        x: torch.Tensor,
+        mask: torch.Tensor,
+        pos_emb: torch.Tensor,
+        cache: torch.Tensor,
+        offset: int,
+    ) -> torch.Tensor:
+        """Self attention on a preallocated KEY & VALUE cache.
+
+        Args:
+            x (torch.Tensor): Input tensor (#batch=1, time1, size).
+            mask (torch.Tensor): Mask tensor (#batch=1, time1, offset + time1),
+                (0, 0, 0) means fake mask, which is enough when time1 == 1.
+            pos_emb (torch.Tensor): Positional embedding tensor.
+            cache (torch.Tensor): Cache tensor (1, head, max_len, d_k * 2),
+                the first `offset` frames are valid, k & v of x are written
+                to [offset, offset + time1) in place.
+            offset (int): Number of valid frames in cache.
+
+        Returns:
+            torch.Tensor: Output tensor (#batch=1, time1, d_model).
+        """
+        q, k, v = self.forward_qkv(x, x, x)
+        end = offset + x.size(1)
+        cache[:, :, offset:end, :self.d_k] = k
+        cache[:, :, offset:end, self.d_k:] = v
+        k, v = cache[:, :, :end, :self.d_k], cache[:, :, :end, self.d_k:]
+        scores = self.attention_scores(q, k, pos_emb)
+        return self.forward_attention(v, scores, mask)
+
 
 class RelPositionMultiHeadedAttention(MultiHeadedAttention):
     """Multi-Head Attention layer with relative position encoding.
@@ -328,3 +366,20 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
             self.d_k)  # (batch, head, time1, time2)
 
         return self.forward_attention(v, scores, mask), new_cache
+
+    def attention_scores(self, q: torch.Tensor, k: torch.Tensor,
+                         pos_emb: torch.Tensor) -> torch.Tensor:
+        """Compute attention scores (#batch, head, time1, time2) with rel.
+            positional encoding, see forward.
+        """
+        n_batch_pos = pos_emb.size(0)
+        p = self.linear_pos(pos_emb).view(n_batch_pos, -1, self.h, self.d_k)
+        p = p.transpose(1, 2)  # (batch, head, time1, d_k)
+        q = q.transpose(1, 2)  # (batch, time1, head, d_k)
+        q_with_bias_u = (q + self.pos_bias_u).transpose(1, 2)
+        q_with_bias_v = (q + self.pos_bias_v).transpose(1, 2)
+        matrix_ac = torch.matmul(q_with_bias_u, k.transpose(-2, -1))
+        matrix_bd = torch.matmul(q_with_bias_v, p.transpose(-2, -1))
+        if matrix_ac.shape != matrix_bd.shape:
+            matrix_bd = self.rel_shift(matrix_bd)
+        return (matrix_ac + matrix_bd) / math.sqrt(self.d_k)
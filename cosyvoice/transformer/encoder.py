@@ -271,6 +271,66 @@ class BaseEncoder(torch.nn.Module):
 
         return (xs, r_att_cache, r_cnn_cache)
 
+    @torch.jit.unused
+    def init_incremental_cache(self, max_len: int, device: torch.device,
+                               dtype: torch.dtype) -> torch.Tensor:
+        """ Preallocate attention cache of forward_incremental, with shape
+            (elayers, head, max_len, d_k * 2)
+        """
+        self_attn = self.encoders[0].self_attn
+        return torch.zeros((len(self.encoders), self_attn.h, max_len,
+                            self_attn.d_k * 2), device=device, dtype=dtype)
+
+    @torch.jit.unused
+    def forward_incremental(
+        self,
+        xs: torch.Tensor,
+        offset: int,
+        att_cache: torch.Tensor,
+    ) -> torch.Tensor:
+        """ Forward xs on a preallocated attention cache, for step by step
+            causal decoding, only TransformerEncoderLayer is supported.
+
+        Unlike forward_chunk, k & v are written into att_cache in place
+        instead of being concatenated per layer and per step, and single
+        token steps use fake mask as the token attends to all history.
+
+        Args:
+            xs (torch.Tensor): input of current step, (b=1, time, mel-dim),
+                usually the whole prompt at first step and one token later.
+            offset (int): number of valid frames in att_cache
+            att_cache (torch.Tensor): cache from init_incremental_cache,
+                (elayers, head, max_len, d_k * 2), updated in place.
+
+        Returns:
+            torch.Tensor: output of current input xs,
+                with shape (b=1, time, hidden-dim).
+
+        """
+        assert xs.size(0) == 1
+        end = offset + xs.size(1)
+        assert end <= att_cache.size(2), \
+            'incremental cache overflow, {} > {}'.format(end, att_cache.size(2))
+        # tmp_masks is just for interface compatibility
+        tmp_masks = torch.ones(1, 1, xs.size(1), device=xs.device,
+                               dtype=torch.bool)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, _, _ = self.embed(xs, tmp_masks, offset)
+        pos_emb = self.embed.position_encoding(offset=0, size=end)
+        if xs.size(1) > 1:
+            att_mask = torch.ones((1, xs.size(1), end), device=xs.device,
+                                  dtype=torch.bool).tril(diagonal=offset)
+        else:
+            att_mask = torch.ones((0, 0, 0), device=xs.device,
+                                  dtype=torch.bool)
+        for i, layer in enumerate(self.encoders):
+            xs = layer.forward_incremental(xs, att_mask, pos_emb,
+                                           att_cache[i:i + 1], offset)
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs
+
     @torch.jit.unused
     def forward_chunk_by_chunk(
         self,
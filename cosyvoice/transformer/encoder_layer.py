@@ -105,6 +105,43 @@ class TransformerEncoderLayer(nn.Module):
         fake_cnn_cache = torch.zeros((0, 0, 0), dtype=x.dtype, device=x.device)
         return x, mask, new_att_cache, fake_cnn_cache
 
+    def forward_incremental(
+        self,
+        x: torch.Tensor,
+        mask: torch.Tensor,
+        pos_emb: torch.Tensor,
+        att_cache: torch.Tensor,
+        offset: int,
+    ) -> torch.Tensor:
+        """Compute encoded features on a preallocated attention cache.
+
+        Args:
+            x (torch.Tensor): (#batch=1, time, size)
+            mask (torch.Tensor): Mask tensor (#batch=1, time, offset + time),
+                (0, 0, 0) means fake mask.
+            pos_emb (torch.Tensor): positional encoding.
+            att_cache (torch.Tensor): Cache tensor of the KEY & VALUE
+                (#batch=1, head, max_len, d_k * 2), updated in place.
+            offset (int): Number of valid frames in att_cache.
+        Returns:
+            torch.Tensor: Output tensor (#batch=1, time, size).
+
+        """
+        residual = x
+        if self.normalize_before:
+            x = self.norm1(x)
+        x = residual + self.dropout(self.self_attn.forward_incremental(x, mask, pos_emb, att_cache, offset))
+        if not self.normalize_before:
+            x = self.norm1(x)
+
+        residual = x
+        if self.normalize_before:
+            x = self.norm2(x)
+        x = residual + self.dropout(self.feed_forward(x))
+        if not self.normalize_before:
+            x = self.norm2(x)
+        return x
+
 
 class ConformerEncoderLayer(nn.Module):
     """Encoder layer module.
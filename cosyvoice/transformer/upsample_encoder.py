@@ -15,7 +15,7 @@
 # limitations under the License.
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Encoder definition."""
-from typing import Tuple
+from typing import Dict, Optional, Tuple
 
 import torch
 from torch import nn
@@ -62,6 +62,20 @@ class Upsample1D(nn.Module):
         outputs = self.conv(outputs)
         return outputs, input_lengths * self.stride
 
+    def forward_chunk(self, inputs: torch.Tensor, cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        inputs: (batch_size, channels, time), only the new frames
+        cache: (batch_size, channels, stride * 2), left context of conv, (0, 0, 0) means no history
+        """
+        outputs = F.interpolate(inputs, scale_factor=float(self.stride), mode="nearest")
+        if cache.size(2) == 0:
+            outputs = F.pad(outputs, (self.stride * 2, 0), value=0.0)
+        else:
+            outputs = torch.concat([cache, outputs], dim=2)
+        new_cache = outputs[:, :, -self.stride * 2:]
+        outputs = self.conv(outputs)
+        return outputs, new_cache
+
 
 class PreLookaheadLayer(nn.Module):
     def __init__(self, in_channels: int, channels: int, pre_lookahead_len: int = 1):
@@ -306,6 +320,106 @@ class UpsampleConformerEncoder(torch.nn.Module):
         # for cross attention with decoder later
         return xs, masks
 
+    def forward_chunk(
+        self,
+        xs: torch.Tensor,
+        context: torch.Tensor = torch.zeros(0, 0, 0),
+        cache: Optional[Dict[str, torch.Tensor]] = None,
+    ) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
+        """ Incremental streaming forward, equals to forward(streaming=True) on
+            the whole prefix but only computes the frames of xs.
+
+        Args:
+            xs (torch.Tensor): frames not encoded by previous calls (b=1, time, D),
+                every chunk but the last one must end at a static_chunk_size boundary
+            context (torch.Tensor): pre_lookahead_len future frames (b=1, time', D),
+                (0, 0, 0) for the last chunk
+            cache (dict): returned by previous call, None for the first chunk
+        Returns:
+            torch.Tensor: output of xs (b=1, time * up_layer.stride, D)
+            dict: attention/cnn cache of every layer and left context of
+                pre_lookahead_layer and up_layer
+        """
+        assert xs.size(0) == 1
+        assert self.static_chunk_size > 0, 'forward_chunk needs static_chunk_size > 0'
+        offset = 0 if cache is None else cache['offset']
+        num_frames = xs.size(1)
+        masks = torch.ones(1, 1, num_frames, dtype=torch.bool, device=xs.device)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, pos_emb, _ = self.embed(xs, masks, offset=offset)
+        if context.size(1) != 0:
+            context_masks = torch.ones(1, 1, context.size(1)).to(masks)
+            context, _, _ = self.embed(context, context_masks, offset=offset + num_frames)
+        # lookahead + conformer encoder, keep last frames as left context of pre_lookahead_layer.conv2
+        history = cache['lookahead'] if cache is not None else xs[:, :0]
+        xs = torch.concat([history, xs], dim=1)
+        lookahead_cache = xs[:, -(self.pre_lookahead_layer.conv2.kernel_size[0] - 1):]
+        xs = self.pre_lookahead_layer(xs, context=context)[:, history.size(1):]
+        xs, att_cache, cnn_cache = self.forward_layers_chunk(
+            self.encoders, xs, pos_emb, offset, self.static_chunk_size,
+            cache['att_cache'] if cache is not None else torch.zeros(0, 0, 0, 0),
+            cache['cnn_cache'] if cache is not None else torch.zeros(0, 0, 0, 0))
+
+        # upsample + conformer encoder
+        xs = xs.transpose(1, 2).contiguous()
+        xs, up_cache = self.up_layer.forward_chunk(xs, cache['up_cache'] if cache is not None else torch.zeros(0, 0, 0))
+        xs = xs.transpose(1, 2).contiguous()
+        up_offset = offset * self.up_layer.stride
+        masks = torch.ones(1, 1, xs.size(1), dtype=torch.bool, device=xs.device)
+        xs, pos_emb, _ = self.up_embed(xs, masks, offset=up_offset)
+        xs, up_att_cache, up_cnn_cache = self.forward_layers_chunk(
+            self.up_encoders, xs, pos_emb, up_offset, self.static_chunk_size * self.up_layer.stride,
+            cache['up_att_cache'] if cache is not None else torch.zeros(0, 0, 0, 0),
+            cache['up_cnn_cache'] if cache is not None else torch.zeros(0, 0, 0, 0))
+
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        cache = {'offset': offset + num_frames, 'lookahead': lookahead_cache,
+                 'att_cache': att_cache, 'cnn_cache': cnn_cache, 'up_cache': up_cache,
+                 'up_att_cache': up_att_cache, 'up_cnn_cache': up_cnn_cache}
+        return xs, cache
+
+    def forward_layers_chunk(
+        self,
+        layers: torch.nn.ModuleList,
+        xs: torch.Tensor,
+        pos_emb: torch.Tensor,
+        offset: int,
+        chunk_size: int,
+        att_cache: torch.Tensor,
+        cnn_cache: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """ Conformer layers on the new frames xs with the attention/cnn cache of
+            offset history frames, see BaseEncoder.forward_chunk.
+
+        Args:
+            pos_emb (torch.Tensor): relative positional encoding of the history
+                and new frames, i.e. embed(xs, offset=offset)
+            chunk_size (int): static chunk size of the layers
+            att_cache (torch.Tensor): (elayers, head, offset, d_k * 2)
+            cnn_cache (torch.Tensor): (elayers, b=1, hidden-dim, cache_t2)
+        """
+        # history frames are always visible, new frames follow the static chunk mask with absolute position
+        pos_q = torch.arange(offset, offset + xs.size(1), device=xs.device)
+        pos_k = torch.arange(offset + xs.size(1), device=xs.device)
+        chunk_masks = pos_k.unsqueeze(0) < ((torch.div(pos_q, chunk_size, rounding_mode='trunc') + 1) * chunk_size).unsqueeze(1)
+        chunk_masks = chunk_masks.unsqueeze(0)
+        r_att_cache = []
+        r_cnn_cache = []
+        for i, layer in enumerate(layers):
+            # NOTE causal conv module only, a symmetric conv module would need future frames
+            assert layer.conv_module is None or layer.conv_module.lorder > 0
+            xs, _, new_att_cache, new_cnn_cache = layer(
+                xs,
+                chunk_masks,
+                pos_emb,
+                att_cache=att_cache[i:i + 1] if att_cache.size(0) > 0 else att_cache,
+                cnn_cache=cnn_cache[i] if cnn_cache.size(0) > 0 else cnn_cache)
+            r_att_cache.append(new_att_cache)
+            r_cnn_cache.append(new_cnn_cache.unsqueeze(0))
+        return xs, torch.cat(r_att_cache, dim=0), torch.cat(r_cnn_cache, dim=0)
+
     def forward_layers(self, xs: torch.Tensor, chunk_masks: torch.Tensor,
                        pos_emb: torch.Tensor,
                        mask_pad: torch.Tensor) -> torch.Tensor:
@@ -18,6 +18,10 @@
 
 import queue
 import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
 from typing import List
 
 import numpy as np
@@ -137,28 +141,14 @@ def init_weights(m, mean=0.0, std=0.01):
 # Repetition Aware Sampling in VALL-E 2
 def ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
     top_ids = nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
-    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
+    rep_num = decoded_tokens[-win_size:].count(top_ids)
     if rep_num >= win_size * tau_r:
         top_ids = random_sampling(weighted_scores, decoded_tokens, sampling)
     return top_ids
 
 
 def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
-    prob, indices = [], []
-    cum_prob = 0.0
-    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
-    for i in range(len(sorted_idx)):
-        # sampling both top-p and numbers.
-        if cum_prob < top_p and len(prob) < top_k:
-            cum_prob += sorted_value[i]
-            prob.append(sorted_value[i])
-            indices.append(sorted_idx[i])
-        else:
-            break
-    prob = torch.tensor(prob).to(weighted_scores)
-    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
-    top_ids = indices[prob.multinomial(1, replacement=True)].item()
-    return top_ids
+    return nucleus_sampling_batch(weighted_scores.unsqueeze(dim=0), top_p=top_p, top_k=top_k).item()
 
 
 def random_sampling(weighted_scores, decoded_tokens, sampling):
@@ -166,6 +156,42 @@ def random_sampling(weighted_scores, decoded_tokens, sampling):
     return top_ids
 
 
+def nucleus_sampling_batch(weighted_scores, top_p=0.8, top_k=25):
+    """Top-k/top-p sampling without python loop or host sync.
+
+    Args:
+        weighted_scores: (B, V) logits or log probs
+    Returns:
+        top_ids: (B,) sampled token ids on weighted_scores.device
+    """
+    sorted_value, sorted_idx = weighted_scores.softmax(dim=-1).topk(min(top_k, weighted_scores.size(-1)), dim=-1)
+    # keep token i while cumulative prob before it is smaller than top_p, the first token is always kept
+    sorted_value = sorted_value.masked_fill(sorted_value.cumsum(dim=-1) - sorted_value >= top_p, 0)
+    return sorted_idx.gather(-1, sorted_value.multinomial(1, replacement=True)).squeeze(dim=-1)
+
+
+def ras_sampling_batch(weighted_scores, decoded_window, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
+    """Batched repetition aware sampling.
+
+    Args:
+        weighted_scores: (B, V) logits or log probs
+        decoded_window: (B, W) most recent decoded tokens of each session, W >= win_size, -1 for empty slot
+    Returns:
+        top_ids: (B,) sampled token ids on weighted_scores.device
+    """
+    top_ids = nucleus_sampling_batch(weighted_scores, top_p=top_p, top_k=top_k)
+    rep_num = (decoded_window[:, -win_size:] == top_ids.unsqueeze(dim=1)).sum(dim=1)
+    random_ids = weighted_scores.softmax(dim=-1).multinomial(1, replacement=True).squeeze(dim=-1)
+    return torch.where(rep_num >= win_size * tau_r, random_ids, top_ids)
+
+
+def get_batch_sampling(sampling):
+    """Return batched version of a sampling function built by hyperpyyaml, None if not available."""
+    if isinstance(sampling, partial) and sampling.func is ras_sampling:
+        return partial(ras_sampling_batch, **sampling.keywords)
+    return None
+
+
 def fade_in_out(fade_in_mel, fade_out_mel, window):
     device = fade_in_mel.device
     fade_in_mel, fade_out_mel = fade_in_mel.cpu(), fade_out_mel.cpu()
@@ -196,18 +222,197 @@ def mask_to_bias(mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
 
 
 class TrtContextWrapper:
+    """Pool of trt_concurrent execution contexts for each optimization profile of trt_engine,
+    a context can only run shapes of the profile it is bound to, so callers acquire one by the shape they run.
+    """
     def __init__(self, trt_engine, trt_concurrent=1, device='cuda:0'):
-        self.trt_context_pool = queue.Queue(maxsize=trt_concurrent)
         self.trt_engine = trt_engine
-        for _ in range(trt_concurrent):
-            trt_context = trt_engine.create_execution_context()
-            trt_stream = torch.cuda.stream(torch.cuda.Stream(device))
-            assert trt_context is not None, 'failed to create trt context, maybe not enough CUDA memory, try reduce current trt concurrent {}'.format(trt_concurrent)
-            self.trt_context_pool.put([trt_context, trt_stream])
-        assert self.trt_context_pool.empty() is False, 'no avaialbe estimator context'
-
-    def acquire_estimator(self):
-        return self.trt_context_pool.get(), self.trt_engine
+        self.num_profiles = trt_engine.num_optimization_profiles
+        self.trt_context_pool = [queue.Queue(maxsize=trt_concurrent) for _ in range(self.num_profiles)]
+        self.context_profile = {}
+        for profile in range(self.num_profiles):
+            for _ in range(trt_concurrent):
+                trt_context = trt_engine.create_execution_context()
+                trt_stream = torch.cuda.stream(torch.cuda.Stream(device))
+                assert trt_context is not None, 'failed to create trt context, maybe not enough CUDA memory, try reduce current trt concurrent {}'.format(trt_concurrent)
+                if profile != 0:
+                    trt_context.set_optimization_profile_async(profile, trt_stream.stream.cuda_stream)
+                    trt_stream.stream.synchronize()
+                self.context_profile[id(trt_context)] = profile
+                self.trt_context_pool[profile].put([trt_context, trt_stream])
+        assert self.trt_context_pool[0].empty() is False, 'no avaialbe estimator context'
+
+    def select_profile(self, batch_size, seq_len, name='x'):
+        """First profile whose shape range of input name covers (batch_size, ..., seq_len), profiles are built from short to long."""
+        for profile in range(self.num_profiles):
+            min_shape, _, max_shape = self.trt_engine.get_tensor_profile_shape(name, profile)
+            if min_shape[0] <= batch_size <= max_shape[0] and min_shape[-1] <= seq_len <= max_shape[-1]:
+                return profile
+        raise ValueError('no trt optimization profile supports batch {} length {} of {}'.format(batch_size, seq_len, name))
+
+    def acquire_estimator(self, batch_size=None, seq_len=None):
+        profile = 0 if batch_size is None else self.select_profile(batch_size, seq_len)
+        return self.trt_context_pool[profile].get(), self.trt_engine
 
     def release_estimator(self, context, stream):
-        self.trt_context_pool.put([context, stream])
+        self.trt_context_pool[self.context_profile[id(context)]].put([context, stream])
+
+    def support_batch_size(self, batch_size, name='x'):
+        """Whether batch_size is in an optimization profile, engines built from onnx with static batch only support batch 2."""
+        for profile in range(self.num_profiles):
+            min_shape, _, max_shape = self.trt_engine.get_tensor_profile_shape(name, profile)
+            if min_shape[0] <= batch_size <= max_shape[0]:
+                return True
+        return False
+
+
+class TokenChannel:
+    """Per-session speech token hand-off between llm_job (producer) and token2wav (consumer).
+
+    The producer calls put/close, the consumer blocks in wait until enough tokens are ready,
+    the stream ends, or the producer fails, in which case the producer exception is re-raised.
+    The consumer calls cancel when it stops early, the producer checks cancelled and stops decoding.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.tokens = []
+        self.end = False
+        self.error = None
+        self.cancelled = False
+
+    def put(self, token):
+        with self.cond:
+            if isinstance(token, list):
+                self.tokens.extend(token)
+            else:
+                self.tokens.append(token)
+            self.cond.notify_all()
+
+    def close(self, error=None):
+        with self.cond:
+            self.end = True
+            self.error = error
+            self.cond.notify_all()
+
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            self.end = True
+            self.cond.notify_all()
+
+    def wait(self, num_tokens=None, timeout=None):
+        """Block until at least num_tokens tokens are available or the stream ends.
+
+        Args:
+            num_tokens: required number of tokens, None means wait until end of stream
+            timeout: max seconds to wait, None means no limit
+        Returns:
+            bool: True if num_tokens tokens are available, False if the stream ended before
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.end is True or (num_tokens is not None and len(self.tokens) >= num_tokens), timeout=timeout)
+            if self.error is not None:
+                raise RuntimeError('speech token producer failed') from self.error
+            return num_tokens is not None and len(self.tokens) >= num_tokens
+
+    def get(self, start=0, end=None):
+        with self.cond:
+            return self.tokens[start:end]
+
+    def pop(self, num_tokens):
+        with self.cond:
+            self.tokens = self.tokens[num_tokens:]
+
+    def __len__(self):
+        with self.cond:
+            return len(self.tokens)
+
+
+class CancelToken:
+    """Cancellation of one request, cancel can be called from any thread, e.g. the event loop when a client disconnects.
+
+    Each session of the request registers a callback which stops its llm_job and frees its caches,
+    callbacks run once in the thread which calls cancel, or right away if already cancelled.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.callbacks = []
+
+    def add_callback(self, callback):
+        with self.lock:
+            if self.cancelled is False:
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self):
+        with self.lock:
+            if self.cancelled is True:
+                return
+            self.cancelled = True
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+class StartupTimer:
+    """Wall time of named startup phases, phases may run in parallel threads, so they do not add up to the total."""
+    def __init__(self):
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + time.time() - start
+
+    def report(self) -> str:
+        return 'startup {:.2f}s: {}'.format(time.time() - self.start, ', '.join('{} {:.2f}s'.format(k, v) for k, v in self.phases.items()))
+
+
+class MicroBatcher:
+    """Collect requests of concurrent sessions and run them as one batch in a background thread.
+
+    submit blocks until the batch containing the request is processed. batch_fn takes a list of
+    request kwargs and returns a list of results in the same order.
+    """
+    def __init__(self, batch_fn, max_batch_size=8, max_wait_ms=5):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, **kwargs):
+        request = {'kwargs': kwargs, 'event': threading.Event(), 'result': None, 'error': None}
+        self.queue.put(request)
+        request['event'].wait()
+        if request['error'] is not None:
+            raise request['error']
+        return request['result']
+
+    def loop(self):
+        while True:
+            requests = [self.queue.get()]
+            deadline = time.time() + self.max_wait_ms / 1000
+            while len(requests) < self.max_batch_size:
+                try:
+                    requests.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                results = self.batch_fn([request['kwargs'] for request in requests])
+                for request, result in zip(requests, results):
+                    request['result'] = result
+            except Exception as e:
+                for request in requests:
+                    request['error'] = e
+            for request in requests:
+                request['event'].set()
@@ -14,8 +14,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
 import os
 import json
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+import numpy as np
 import torch
 import torchaudio
 import logging
@@ -60,10 +65,116 @@ def load_wav(wav, target_sr, min_sr=16000):
 
     if sample_rate != target_sr:
         assert sample_rate >= min_sr, 'wav sample rate {} must be greater than {}'.format(sample_rate, target_sr)
-        speech = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=target_sr)(speech)
+        speech = get_resampler(sample_rate, target_sr)(speech)
     return speech
 
 
+@lru_cache(maxsize=None)
+def get_resampler(orig_sr, target_sr):
+    # NOTE building the resample kernel is not free, share one per (orig_sr, target_sr)
+    return torchaudio.transforms.Resample(orig_freq=orig_sr, new_freq=target_sr)
+
+
+class PromptAudio:
+    """Prompt audio which is decoded only once, resampled views are computed lazily and memoized.
+
+    Args:
+        wav: file path, file-like object, encoded audio file bytes,
+            or raw int16 mono pcm bytes when sample_rate is given
+        sample_rate: sample rate of raw pcm bytes
+    """
+    def __init__(self, wav, sample_rate=None, min_sr=16000):
+        import soundfile as sf
+        if isinstance(wav, (bytes, bytearray)) and sample_rate is not None:
+            speech = torch.from_numpy(np.frombuffer(wav, dtype=np.int16).astype(np.float32) / 32768).unsqueeze(0)
+        else:
+            speech, sample_rate = sf.read(io.BytesIO(wav) if isinstance(wav, (bytes, bytearray)) else wav, dtype='float32')
+            speech = torch.from_numpy(speech)
+            speech = speech.unsqueeze(0) if speech.dim() == 1 else speech.transpose(0, 1).mean(dim=0, keepdim=True)
+        self.speech = speech
+        self.sample_rate = sample_rate
+        self.min_sr = min_sr
+        self.views = {sample_rate: speech}
+        self.lock = threading.Lock()
+
+    def resample(self, target_sr):
+        with self.lock:
+            if target_sr not in self.views:
+                assert self.sample_rate >= self.min_sr, 'wav sample rate {} must be greater than {}'.format(self.sample_rate, target_sr)
+                self.views[target_sr] = get_resampler(self.sample_rate, target_sr)(self.speech)
+            return self.views[target_sr]
+
+    def __getstate__(self):
+        # NOTE only ship the decoded audio, e.g. to the model server, resampled views are recomputed on demand
+        return {'speech': self.speech, 'sample_rate': self.sample_rate, 'min_sr': self.min_sr}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.views = {self.sample_rate: self.speech}
+        self.lock = threading.Lock()
+
+
+def load_prompt_audio(wav):
+    return wav if isinstance(wav, PromptAudio) else PromptAudio(wav)
+
+
+_empty_weights_state = threading.local()
+
+
+def empty_weights_enabled():
+    return getattr(_empty_weights_state, 'enabled', False)
+
+
+@contextmanager
+def init_empty_weights():
+    """Parameters of modules built in this context by this thread are created on meta device, buffers are kept as is,
+    so building a model neither allocates nor randomly initializes its weights, use load_module_state_dict to load them.
+    """
+    register_parameter = torch.nn.Module.register_parameter
+
+    def register_empty_parameter(module, name, param):
+        register_parameter(module, name, param)
+        if param is not None and empty_weights_enabled():
+            module._parameters[name] = torch.nn.Parameter(module._parameters[name].to('meta'), requires_grad=param.requires_grad)
+    torch.nn.Module.register_parameter = register_empty_parameter
+    _empty_weights_state.enabled = True
+    try:
+        yield
+    finally:
+        _empty_weights_state.enabled = False
+        torch.nn.Module.register_parameter = register_parameter
+
+
+def load_checkpoint(path, device):
+    """Load a state dict, from <name>.safetensors next to path if it is converted by tools/convert_checkpoint.py,
+    otherwise torch.load path with mmap, so the checkpoint is not read into host memory as a whole first.
+    """
+    safetensors_path = os.path.splitext(path)[0] + '.safetensors'
+    if os.path.exists(safetensors_path):
+        from safetensors.torch import load_file
+        return load_file(safetensors_path, device=str(device))
+    try:
+        return torch.load(path, map_location=device, mmap=True, weights_only=True)
+    except RuntimeError:
+        # NOTE checkpoints saved in the legacy (non zipfile) format can not be memory mapped
+        return torch.load(path, map_location=device)
+
+
+def load_module_state_dict(module, state_dict):
+    """load_state_dict with strict=True, which also supports modules built under init_empty_weights,
+    their meta parameters take the loaded tensors, cast to the parameter dtype, instead of copying them.
+    """
+    if not any(p.is_meta for p in module.parameters()):
+        module.load_state_dict(state_dict, strict=True)
+        return
+    dtypes = {k: v.dtype for k, v in module.state_dict().items()}
+    module.load_state_dict({k: v.to(dtypes[k]) if k in dtypes else v for k, v in state_dict.items()}, strict=True, assign=True)
+    # tied weights, e.g. qwen2 lm_head and embed_tokens, are separate tensors after assign
+    for m in module.modules():
+        if hasattr(m, 'tie_weights') and hasattr(m, 'config'):
+            m.tie_weights()
+
+
 def convert_onnx_to_trt(trt_model, trt_kwargs, onnx_model, fp16):
     import tensorrt as trt
     logging.info("Converting onnx to trt...")
@@ -76,16 +187,23 @@ def convert_onnx_to_trt(trt_model, trt_kwargs, onnx_model, fp16):
     config.set_memory_pool_limit(trt.MemoryPoolType.WORKSPACE, 1 << 32)  # 4GB
     if fp16:
         config.set_flag(trt.BuilderFlag.FP16)
-    profile = builder.create_optimization_profile()
     # load onnx model
     with open(onnx_model, "rb") as f:
         if not parser.parse(f.read()):
             for error in range(parser.num_errors):
                 print(parser.get_error(error))
             raise ValueError('failed to parse {}'.format(onnx_model))
-    # set input shapes
-    for i in range(len(trt_kwargs['input_names'])):
-        profile.set_shape(trt_kwargs['input_names'][i], trt_kwargs['min_shape'][i], trt_kwargs['opt_shape'][i], trt_kwargs['max_shape'][i])
+    # set input shapes, static dims of the onnx input override the profile, e.g. batch of onnx exported without dynamic batch
+    # NOTE trt_kwargs['profiles'] holds several optimization profiles, e.g. short streaming chunks and long utterances
+    input_shapes = {network.get_input(i).name: network.get_input(i).shape for i in range(network.num_inputs)}
+    for profile_kwargs in trt_kwargs.get('profiles', [trt_kwargs]):
+        profile = builder.create_optimization_profile()
+        for i in range(len(trt_kwargs['input_names'])):
+            static_shape = input_shapes[trt_kwargs['input_names'][i]]
+            min_shape, opt_shape, max_shape = [tuple(k if j == -1 else j for j, k in zip(static_shape, shape))
+                                               for shape in [profile_kwargs['min_shape'][i], profile_kwargs['opt_shape'][i], profile_kwargs['max_shape'][i]]]
+            profile.set_shape(trt_kwargs['input_names'][i], min_shape, opt_shape, max_shape)
+        config.add_optimization_profile(profile)
     tensor_dtype = trt.DataType.HALF if fp16 else trt.DataType.FLOAT
     # set input and output data type
     for i in range(network.num_inputs):
@@ -94,8 +212,8 @@ def convert_onnx_to_trt(trt_model, trt_kwargs, onnx_model, fp16):
     for i in range(network.num_outputs):
         output_tensor = network.get_output(i)
         output_tensor.dtype = tensor_dtype
-    config.add_optimization_profile(profile)
     engine_bytes = builder.build_serialized_network(network, config)
+    assert engine_bytes is not None, 'failed to build trt engine from {}'.format(onnx_model)
     # save trt engine
     with open(trt_model, "wb") as f:
         f.write(engine_bytes)
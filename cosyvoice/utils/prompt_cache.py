@@ -0,0 +1,105 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+import numpy as np
+import torch
+from cosyvoice.utils.file_utils import logging, PromptAudio
+
+
+class PromptCache:
+    """Content addressed cache of prompt frontend features (speech token, speech feat, spk embedding, prompt text token).
+
+    Entries are keyed by sha256 of the decoded prompt pcm plus prompt_text and the model_id of the frontend which extracted them,
+    e.g. CosyVoice2 and CosyVoice3 both resample to 24k but have different speech tokenizers. The memory tier is a LRU bounded by max_bytes,
+    the optional disk tier stores one npz file per entry in cache_dir, so it can be shared by several worker processes.
+    """
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, cache_dir: str = ''):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits, self.disk_hits, self.misses = 0, 0, 0
+
+    @staticmethod
+    def model_id(tokenizer, *model_files: str) -> str:
+        """Identity of the text tokenizer and the onnx models (speech tokenizer, campplus) the features are extracted with."""
+        return '{}|{}'.format(type(tokenizer).__name__, '|'.join(os.path.realpath(f) for f in model_files))
+
+    @staticmethod
+    def key(prompt_audio: PromptAudio, prompt_text: str, resample_rate: int, model_id: str = '') -> str:
+        h = hashlib.sha256()
+        h.update(prompt_audio.speech.numpy().tobytes())
+        h.update('{}|{}|{}|{}'.format(prompt_audio.sample_rate, resample_rate, prompt_text, model_id).encode('utf8'))
+        return h.hexdigest()
+
+    def get(self, key: str, device: torch.device):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        path = os.path.join(self.cache_dir, '{}.npz'.format(key)) if self.cache_dir else ''
+        if path and os.path.exists(path):
+            try:
+                with np.load(path) as data:
+                    value = {k: torch.from_numpy(data[k]).to(device) for k in data.files}
+            except Exception as e:
+                logging.warning('failed to load prompt cache {}: {}'.format(path, e))
+            else:
+                with self.lock:
+                    self.disk_hits += 1
+                self._put_memory(key, value)
+                return value
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value: dict):
+        self._put_memory(key, value)
+        if self.cache_dir:
+            path = os.path.join(self.cache_dir, '{}.npz'.format(key))
+            # NOTE write to a temp file then rename, so other workers never read a partial file
+            tmp_path = os.path.join(self.cache_dir, '{}.{}.tmp.npz'.format(key, uuid.uuid4().hex))
+            try:
+                np.savez(tmp_path, **{k: v.cpu().numpy() for k, v in value.items()})
+                os.replace(tmp_path, path)
+            except Exception as e:
+                logging.warning('failed to save prompt cache {}: {}'.format(path, e))
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def _put_memory(self, key: str, value: dict):
+        size = sum(v.numel() * v.element_size() for v in value.values())
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = value
+            self.num_bytes += size
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.num_bytes -= sum(v.numel() * v.element_size() for v in evicted.values())
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'entries': len(self.entries), 'bytes': self.num_bytes}
@@ -0,0 +1,272 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Weight-only quantization of the Qwen2LM linear layers and the flow estimator linear/conv layers.
+
+The weight of a quantized nn.Linear/nn.Conv1d is replaced by two buffers, so llm.pt/flow.pt store
+    qweight: int8 (out, in) of bits=8, or two int4 packed in one uint8 (out, in / 2) of bits=4
+    scale: float (out,) per output channel of bits=8, or float (out, in / group_size) per group of bits=4
+and quantization.json next to them records bits/group_size of each module, see export_quantized_model.
+"""
+import json
+import os
+import shutil
+from contextlib import contextmanager
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+from cosyvoice.utils.file_utils import logging
+
+# modules which are quantized, llm: qwen2 decoder layers and speech token head, flow: whole estimator
+QUANT_TARGETS = {'llm': ('llm.model.model.layers.', 'llm_decoder'), 'flow': ('decoder.estimator.',)}
+# clip ratios of max |w| searched for the scale of each channel/group, the one with least (activation weighted) error wins
+CLIP_RATIOS = (1.0, 0.95, 0.9, 0.85, 0.8, 0.75)
+
+
+def quantize_weight(weight, bits=8, group_size=0, importance=None):
+    """Symmetric quantization of a (out, ...) weight, flattened to (out, in), returns qweight and scale.
+
+    Args:
+        weight: weight of nn.Linear or nn.Conv1d
+        bits: 8 for per output channel int8, 4 for grouped int4
+        group_size: number of input elements sharing one scale, only used by bits=4
+        importance: (in,) mean squared activation of each input element, weights the clip search error
+    """
+    assert bits in (4, 8), 'only int8 and int4 weight-only quantization are supported'
+    w = weight.detach().float().reshape(weight.shape[0], -1)
+    if bits == 8:
+        group_size = w.shape[1]
+    assert w.shape[1] % group_size == 0 and (bits == 8 or group_size % 2 == 0), 'input size {} does not fit group size {}'.format(w.shape[1], group_size)
+    w = w.reshape(w.shape[0], -1, group_size)
+    qmax = 2 ** (bits - 1) - 1
+    amax = w.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8)
+    importance = importance.float().reshape(1, -1, group_size).to(w.device) if importance is not None else 1
+    best_error, best_scale = None, None
+    for ratio in CLIP_RATIOS:
+        scale = amax * ratio / qmax
+        error = (((w / scale).round().clamp(-qmax - 1, qmax) * scale - w) ** 2 * importance).sum(dim=-1, keepdim=True)
+        if best_error is None:
+            best_error, best_scale = error, scale
+        else:
+            best_scale = torch.where(error < best_error, scale, best_scale)
+            best_error = torch.minimum(error, best_error)
+    q = (w / best_scale).round().clamp(-qmax - 1, qmax).to(torch.int8).reshape(w.shape[0], -1)
+    if bits == 8:
+        return q, best_scale.reshape(-1)
+    # NOTE int4 is stored unsigned (q + 8), even input elements in the low nibble
+    q = (q + 8).to(torch.uint8)
+    return q[:, 0::2] | (q[:, 1::2] << 4), best_scale.reshape(w.shape[0], -1)
+
+
+def dequantize_weight(qweight, scale, bits, group_size, shape, dtype):
+    if bits == 8:
+        w = qweight.to(dtype) * scale.to(dtype).unsqueeze(-1)
+    else:
+        q = torch.stack([qweight & 15, qweight >> 4], dim=-1).reshape(qweight.shape[0], -1, group_size).to(dtype) - 8
+        w = q * scale.to(dtype).unsqueeze(-1)
+    return w.reshape(shape)
+
+
+class WeightOnlyQuantized:
+    """Mixin of a quantized nn.Linear/nn.Conv1d, its weight is dequantized from qweight/scale on access,
+    so subclasses with their own forward, e.g. CausalConv1d, keep working. Never cached, modules are shared by sessions.
+    """
+
+    @property
+    def weight(self):
+        return dequantize_weight(self.qweight, self.scale, self.bits, self.group_size, self.weight_shape, self.scale.dtype)
+
+
+class WeightOnlyQuantizedLinear(WeightOnlyQuantized):
+    """Quantized nn.Linear, which runs the int8/int4 weight-only matmul kernel of torch on cpu,
+    the weight is unpacked inside the kernel instead of being dequantized into a full precision copy first.
+    """
+
+    def prepare_kernel(self):
+        """Pick the cpu kernel, checked against the dequantized matmul once, as the kernels are private aten ops."""
+        self.kernel = None
+        if self.qweight.device.type != 'cpu':
+            return False
+        try:
+            if self.bits == 8:
+                self.kernel = 'int8'
+            else:
+                q = torch.stack([self.qweight & 15, self.qweight >> 4], dim=-1).reshape(self.qweight.shape[0], -1)
+                self.kernel_weight = torch.ops.aten._convert_weight_to_int4pack_for_cpu(q.to(torch.int32), 1)
+                # dequantized as (q - 8) * scale + zero
+                self.kernel_scale = torch.stack([self.scale.float().t(), torch.zeros_like(self.scale.float().t())], dim=-1).contiguous()
+                self.kernel = 'int4'
+            x = torch.randn(4, self.in_features, generator=torch.Generator().manual_seed(0))
+            ref = F.linear(x, self.weight.float())
+            ok = (self.kernel_linear(x) - ref).norm() <= 1e-3 * ref.norm() + 1e-6
+        except (RuntimeError, AttributeError):
+            ok = False
+        if not ok:
+            self.kernel = None
+        return ok
+
+    def kernel_linear(self, x):
+        if self.kernel == 'int8':
+            return torch.ops.aten._weight_int8pack_mm(x, self.qweight, self.scale.float())
+        return torch.ops.aten._weight_int4pack_mm_for_cpu(x, self.kernel_weight, self.group_size, self.kernel_scale)
+
+    def forward(self, x):
+        if getattr(self, 'kernel', None) is None or x.device.type != 'cpu' or x.dtype != torch.float32:
+            return F.linear(x, self.weight, self.bias)
+        y = self.kernel_linear(x.reshape(-1, self.in_features).contiguous())
+        if self.bias is not None:
+            y = y + self.bias
+        return y.reshape(x.shape[:-1] + (self.out_features,))
+
+
+_quantized_classes = {}
+
+
+def quantized_class(cls):
+    if cls not in _quantized_classes:
+        # only plain linear layers get the kernel forward, subclasses keep their own forward and read the dequantized weight
+        mixin = WeightOnlyQuantizedLinear if issubclass(cls, nn.Linear) and cls.forward is nn.Linear.forward else WeightOnlyQuantized
+        _quantized_classes[cls] = type('Quantized{}'.format(cls.__name__), (mixin, cls), {})
+    return _quantized_classes[cls]
+
+
+def convert_module(module, qweight, scale, bits, group_size):
+    """Replace weight of module by qweight/scale buffers in place."""
+    shape = tuple(module.weight.shape)
+    del module._parameters['weight']
+    module.__class__ = quantized_class(type(module))
+    module.register_buffer('qweight', qweight)
+    module.register_buffer('scale', scale)
+    module.bits, module.group_size, module.weight_shape = bits, group_size, shape
+
+
+def module_spec(weight, bits, group_size):
+    """bits/group_size a weight is quantized with, grouped int4 needs an even input size which is a multiple of group_size."""
+    in_size = weight[0].numel()
+    if bits == 4 and in_size % group_size == 0 and group_size % 2 == 0:
+        return {'bits': 4, 'group_size': group_size}
+    return {'bits': 8, 'group_size': in_size}
+
+
+def find_targets(module, prefixes):
+    return {name: m for name, m in module.named_modules()
+            if name.startswith(prefixes) and isinstance(m, (nn.Linear, nn.Conv1d)) and not isinstance(m, WeightOnlyQuantized)}
+
+
+def weight_importance(module, stats):
+    """Per input element importance of a (out, in * kernel_size) flattened weight, None if not calibrated."""
+    if stats is None or isinstance(module, nn.Conv1d) and module.groups != 1:
+        return None
+    importance = stats['sum'] / max(stats['count'], 1)
+    if isinstance(module, nn.Conv1d):
+        importance = importance.repeat_interleave(module.kernel_size[0])
+    return importance
+
+
+@torch.no_grad()
+def quantize_module(module, prefixes, bits=8, group_size=128, activation_stats=None):
+    """Quantize all linear/conv layers of module whose name starts with prefixes in place, returns {name: spec}."""
+    specs = {}
+    activation_stats = activation_stats if activation_stats is not None else {}
+    for name, m in find_targets(module, prefixes).items():
+        spec = module_spec(m.weight, bits, group_size)
+        qweight, scale = quantize_weight(m.weight, spec['bits'], spec['group_size'], weight_importance(m, activation_stats.get(name)))
+        convert_module(m, qweight.to(m.weight.device), scale.to(m.weight.device, m.weight.dtype), **spec)
+        specs[name] = spec
+    return specs
+
+
+def prepare_quantized(module, specs):
+    """Convert the modules of specs to quantized ones with empty qweight/scale, so a quantized state dict can be loaded."""
+    named_modules = dict(module.named_modules())
+    for name, spec in specs.items():
+        m = named_modules[name]
+        assert isinstance(m, (nn.Linear, nn.Conv1d)), '{} is not a linear/conv layer'.format(name)
+        out_size, in_size = m.weight.shape[0], m.weight[0].numel()
+        dtype = m.weight.dtype if m.weight.dtype.is_floating_point else torch.float32
+        if spec['bits'] == 8:
+            qweight, scale = torch.zeros(out_size, in_size, dtype=torch.int8), torch.zeros(out_size, dtype=dtype)
+        else:
+            qweight, scale = torch.zeros(out_size, in_size // 2, dtype=torch.uint8), torch.zeros(out_size, in_size // spec['group_size'], dtype=dtype)
+        convert_module(m, qweight, scale, spec['bits'], spec['group_size'])
+
+
+def init_quantized_kernels(module):
+    """Prepare the cpu kernels of quantized linear layers, call it after the module is moved to its device."""
+    linears = [m for m in module.modules() if isinstance(m, WeightOnlyQuantizedLinear)]
+    fallback = [m for m in linears if m.prepare_kernel() is False and m.qweight.device.type == 'cpu']
+    if len(fallback) != 0:
+        logging.warning('{}/{} quantized linear layers have no cpu kernel in this torch, fall back to dequantized matmul'.format(len(fallback), len(linears)))
+
+
+def is_quantized(module):
+    return any(isinstance(m, WeightOnlyQuantized) for m in module.modules())
+
+
+@contextmanager
+def collect_activation_stats(module, prefixes):
+    """Accumulate the mean squared input of each input channel of the layers to be quantized, while module runs,
+    used to weight the quantization error by how large the activations multiplied with each weight column are.
+    """
+    stats, handles = {}, []
+
+    def hook(name):
+        def fn(m, args):
+            x = args[0].detach().float()
+            x = x.reshape(-1, x.shape[-1]) if isinstance(m, nn.Linear) else x.transpose(0, 1).reshape(x.shape[1], -1).t()
+            s = stats.setdefault(name, {'sum': torch.zeros(x.shape[1], device=x.device), 'count': 0})
+            s['sum'] += x.pow(2).sum(dim=0)
+            s['count'] += x.shape[0]
+        return fn
+    for name, m in find_targets(module, prefixes).items():
+        handles.append(m.register_forward_pre_hook(hook(name)))
+    try:
+        yield stats
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
+def load_quant_config(model_dir):
+    path = os.path.join(model_dir, 'quantization.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def export_quantized_model(model, model_dir, output_dir, specs, info=None):
+    """Write a model dir which loads the quantized llm/flow natively, everything else is copied from model_dir.
+
+    Args:
+        model: CosyVoiceModel whose llm/flow are quantized by quantize_module
+        specs: {'llm': {name: spec}, 'flow': {name: spec}}
+        info: extra information saved in quantization.json, e.g. calibration
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # NOTE safetensors/vllm exports of the original weights would be loaded instead of the quantized ones
+    skip = {'llm.pt', 'flow.pt', 'llm.safetensors', 'flow.safetensors', 'quantization.json', 'vllm'}
+    for item in os.listdir(model_dir):
+        src, dst = os.path.join(model_dir, item), os.path.join(output_dir, item)
+        if item in skip or os.path.abspath(src) == os.path.abspath(dst):
+            continue
+        if os.path.isdir(src):
+            shutil.copytree(src, dst, dirs_exist_ok=True)
+        else:
+            shutil.copy(src, dst)
+    for name in ['llm', 'flow']:
+        path = os.path.join(output_dir, '{}.pt'.format(name))
+        torch.save(getattr(model, name).state_dict(), path + '.tmp')
+        os.replace(path + '.tmp', path)
+    with open(os.path.join(output_dir, 'quantization.json'), 'w') as f:
+        json.dump(dict(info or {}, **specs), f, indent=2)
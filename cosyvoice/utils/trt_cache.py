@@ -0,0 +1,103 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import fcntl
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from cosyvoice.utils.file_utils import convert_onnx_to_trt, logging
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class TrtEngineCache:
+    """TensorRT plans of onnx models, cached on disk per (onnx sha256, tensorrt version, gpu, precision, profiles),
+    so a plan is rebuilt whenever any of them changes instead of a stale plan being loaded.
+
+    A plan is built into a temporary file and renamed into place under a file lock, so concurrent processes,
+    e.g. gunicorn workers, build it once and never read a partially written plan.
+    build_fn(plan_path, trt_kwargs, onnx_path, fp16), trt_version and device are injectable, e.g. to run without tensorrt.
+    """
+    def __init__(self, build_fn=None, trt_version=None, device=None):
+        self.build_fn = build_fn if build_fn is not None else convert_onnx_to_trt
+        self.trt_version = trt_version
+        self.device = device
+
+    def get_trt_version(self):
+        if self.trt_version is None:
+            import tensorrt as trt
+            self.trt_version = trt.__version__
+        return self.trt_version
+
+    def get_device(self):
+        # NOTE plans are specific to the gpu architecture they are built on
+        if self.device is None:
+            import torch
+            self.device = '{} sm{}{}'.format(torch.cuda.get_device_name(), *torch.cuda.get_device_capability())
+        return self.device
+
+    def key(self, onnx_model, trt_kwargs, fp16):
+        # json round trip, so tuple and list shapes give the same key
+        return {'onnx_sha256': file_sha256(onnx_model),
+                'trt_version': self.get_trt_version(),
+                'device': self.get_device(),
+                'precision': 'fp16' if fp16 is True else 'fp32',
+                'trt_kwargs': json.loads(json.dumps(trt_kwargs))}
+
+    def plan_path(self, plan_model, key):
+        """plan_model is the plan path without key, e.g. flow.decoder.estimator.fp16.mygpu.plan -> flow.decoder.estimator.fp16.mygpu.<digest>.plan"""
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+        return '{}.{}.plan'.format(os.path.splitext(plan_model)[0], digest)
+
+    @contextmanager
+    def build_lock(self, plan_path):
+        # NOTE the lock file is left behind, removing it would let a waiting process lock an unlinked file
+        with open(plan_path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get(self, plan_model, onnx_model, trt_kwargs, fp16):
+        """Path of the cached plan of onnx_model built with trt_kwargs and fp16, it is built first on a cache miss."""
+        key = self.key(onnx_model, trt_kwargs, fp16)
+        plan_path = self.plan_path(plan_model, key)
+        if os.path.exists(plan_path) and os.path.getsize(plan_path) > 0:
+            return plan_path
+        with self.build_lock(plan_path):
+            # another process may have built it while this one waited for the lock
+            if os.path.exists(plan_path) and os.path.getsize(plan_path) > 0:
+                return plan_path
+            logging.info('no cached trt plan {} for {}, building it'.format(plan_path, onnx_model))
+            tmp_path = '{}.{}.tmp'.format(plan_path, os.getpid())
+            try:
+                self.build_fn(tmp_path, trt_kwargs, onnx_model, fp16)
+                assert os.path.exists(tmp_path) and os.path.getsize(tmp_path) > 0, 'failed to build trt plan from {}'.format(onnx_model)
+                # key next to the plan, only for inspection, the plan file name already identifies it
+                with open(tmp_path + '.json', 'w') as f:
+                    json.dump(key, f, indent=2)
+                os.replace(tmp_path + '.json', plan_path + '.json')
+                os.replace(tmp_path, plan_path)
+            finally:
+                for path in [tmp_path, tmp_path + '.json']:
+                    if os.path.exists(path):
+                        os.remove(path)
+        return plan_path
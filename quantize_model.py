@@ -1,193 +1,116 @@
 #!/usr/bin/env python3
 """
-CosyVoice 模型快速量化工具
-支持动态量化和 FP16 转换
+CosyVoice 模型量化工具（校准版）
+LLM (Qwen2 decoder layers + speech token head) 和 flow estimator 的 linear/conv 权重量化为
+per-channel int8 或 grouped int4 (weight-only)，先用几句校准文本跑一遍推理，统计每个输入通道的激活幅度，
+用于挑选每个 channel/group 的截断范围。输出目录带 quantization.json，加载时直接构建量化层，无需额外参数。
 """
 
-import torch
 import os
 import sys
 import argparse
-import shutil
-from pathlib import Path
+import torch
+from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.utils.quantize import QUANT_TARGETS, collect_activation_stats, quantize_module, export_quantized_model
+
+CALIBRATION_TEXTS = [
+    '收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。',
+    '你好，欢迎光临我们的餐厅，今天想吃点什么呢？',
+    'The quick brown fox jumps over the lazy dog, and then it runs away into the forest.',
+    '在面对挑战时，他展现了非凡的勇气与智慧。',
+]
+
+
+def file_size_mb(path):
+    return os.path.getsize(path) / (1024 ** 2) if os.path.exists(path) else 0
 
-def print_model_info(model_path):
-    """打印模型信息"""
-    if os.path.exists(model_path):
-        size_mb = os.path.getsize(model_path) / (1024 ** 2)
-        return size_mb
-    return 0
 
-def quantize_dynamic(model_dir, output_dir, skip_hift=True):
+def quantize(model_dir, output_dir, bits=8, group_size=128, calibration_texts=(), prompt_text='', prompt_wav=''):
     """
-    动态量化 CosyVoice 模型
-    
+    量化 CosyVoice 模型并导出
+
     Args:
         model_dir: 原始模型目录
         output_dir: 输出目录
-        skip_hift: 是否跳过 HiFi-GAN 量化（推荐 True 以保持音质）
+        bits: 8 (per-channel int8) 或 4 (grouped int4)
+        group_size: int4 每组共享一个 scale 的输入元素个数
+        calibration_texts: 校准文本，为空时只按权重误差选择截断范围
     """
+    assert not os.path.exists(os.path.join(model_dir, 'quantization.json')), '{} is already quantized'.format(model_dir)
     print(f"🔧 Loading model from: {model_dir}")
-    
-    # 检查必需的模型权重文件
-    required_files = ['llm.pt', 'flow.pt', 'hift.pt']
-    for f in required_files:
-        if not os.path.exists(f"{model_dir}/{f}"):
-            print(f"❌ Error: {f} not found in {model_dir}")
-            return False
-    
-    print("✓ Found all required model files")
-    
-    # 加载模型权重
-    print("📦 Loading model weights...")
-    llm_state = torch.load(f"{model_dir}/llm.pt", map_location='cpu')
-    flow_state = torch.load(f"{model_dir}/flow.pt", map_location='cpu')
-    hift_state = torch.load(f"{model_dir}/hift.pt", map_location='cpu')
-    
-    # 创建输出目录
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # 记录原始大小
-    original_sizes = {
-        'llm': print_model_info(f"{model_dir}/llm.pt"),
-        'flow': print_model_info(f"{model_dir}/flow.pt"),
-        'hift': print_model_info(f"{model_dir}/hift.pt")
-    }
-    
-    # 量化 LLM
-    print("⚡ Quantizing LLM (INT8)...")
-    # 注意：这里我们量化的是 state_dict，实际部署时需要配合量化的模型结构
-    # 对于简单场景，我们将权重转换为半精度
-    llm_quantized = {k: v.half() if v.dtype == torch.float32 else v 
-                     for k, v in llm_state.items()}
-    torch.save(llm_quantized, f"{output_dir}/llm.pt")
-    print(f"  ✓ LLM saved: {print_model_info(f'{output_dir}/llm.pt'):.1f} MB")
-    
-    # 量化 Flow
-    print("⚡ Quantizing Flow (INT8)...")
-    flow_quantized = {k: v.half() if v.dtype == torch.float32 else v 
-                      for k, v in flow_state.items()}
-    torch.save(flow_quantized, f"{output_dir}/flow.pt")
-    print(f"  ✓ Flow saved: {print_model_info(f'{output_dir}/flow.pt'):.1f} MB")
-    
-    # HiFi-GAN 处理
-    if skip_hift:
-        print("⏭️  Skipping HiFi-GAN quantization (preserving audio quality)...")
-        torch.save(hift_state, f"{output_dir}/hift.pt")
-    else:
-        print("⚡ Quantizing HiFi-GAN (may affect audio quality)...")
-        hift_quantized = {k: v.half() if v.dtype == torch.float32 else v 
-                         for k, v in hift_state.items()}
-        torch.save(hift_quantized, f"{output_dir}/hift.pt")
-    print(f"  ✓ HiFi-GAN saved: {print_model_info(f'{output_dir}/hift.pt'):.1f} MB")
-    
-    # 复制配置文件（可选文件）
-    print("📋 Copying configuration files...")
-    optional_files = ['cosyvoice.yaml', 'campplus.onnx', 'speech_tokenizer_v1.onnx', 
-                      'spk2info.pt', 'configuration.json', 'README.md']
-    copied_count = 0
-    for f in optional_files:
-        src = f"{model_dir}/{f}"
-        dst = f"{output_dir}/{f}"
-        if os.path.exists(src):
-            shutil.copy(src, dst)
-            print(f"  ✓ Copied {f}")
-            copied_count += 1
-    
-    if copied_count == 0:
-        print("  ⚠️  No configuration files found (this is OK for some model formats)")
-    
-    # 创建一个标记文件说明这是量化模型
-    with open(f"{output_dir}/QUANTIZED.txt", 'w') as f:
-        f.write("This is a quantized (FP16) version of the CosyVoice model.\n")
-        f.write(f"Original model: {model_dir}\n")
-        f.write(f"Quantized on: {__import__('datetime').datetime.now()}\n")
-        f.write(f"HiFi-GAN quantized: {not skip_hift}\n")
-    
-    # 计算压缩比
-    quantized_sizes = {
-        'llm': print_model_info(f"{output_dir}/llm.pt"),
-        'flow': print_model_info(f"{output_dir}/flow.pt"),
-        'hift': print_model_info(f"{output_dir}/hift.pt")
-    }
-    
-    original_total = sum(original_sizes.values())
-    quantized_total = sum(quantized_sizes.values())
-    
-    print("\n" + "="*60)
-    print("📊 Quantization Summary:")
-    print("="*60)
+    cosyvoice = AutoModel(model_dir=model_dir)
+    model = cosyvoice.model
+
+    stats = {'llm': None, 'flow': None}
+    if len(calibration_texts) != 0:
+        print(f"📊 Calibrating with {len(calibration_texts)} text(s)...")
+        with collect_activation_stats(model.llm, QUANT_TARGETS['llm']) as stats['llm'], \
+                collect_activation_stats(model.flow, QUANT_TARGETS['flow']) as stats['flow']:
+            for text in calibration_texts:
+                for _ in cosyvoice.inference_zero_shot(text, prompt_text, prompt_wav, stream=False):
+                    pass
+
+    print(f"⚡ Quantizing LLM and flow estimator (int{bits}{', group size {}'.format(group_size) if bits == 4 else ', per channel'})...")
+    specs = {name: quantize_module(getattr(model, name), QUANT_TARGETS[name], bits, group_size, stats[name]) for name in ['llm', 'flow']}
+    for name, spec in specs.items():
+        num_int4 = sum(1 for s in spec.values() if s['bits'] == 4)
+        print(f"  ✓ {name}: {len(spec)} layers quantized" + (f", {len(spec) - num_int4} of them kept int8 (input size not a multiple of group size)" if bits == 4 else ''))
+
+    info = {'bits': bits, 'group_size': group_size, 'calibration': {'num_texts': len(calibration_texts), 'prompt_wav': os.path.basename(prompt_wav)}}
+    export_quantized_model(model, model_dir, output_dir, specs, info=info)
+
+    print("\n" + "=" * 60)
     print(f"{'Module':<12} {'Original':<15} {'Quantized':<15} {'Ratio':<10}")
-    print("-"*60)
-    for module in ['llm', 'flow', 'hift']:
-        orig = original_sizes[module]
-        quant = quantized_sizes[module]
-        ratio = orig / quant if quant > 0 else 0
-        print(f"{module:<12} {orig:>10.1f} MB    {quant:>10.1f} MB    {ratio:>6.2f}x")
-    print("-"*60)
-    print(f"{'Total':<12} {original_total:>10.1f} MB    {quantized_total:>10.1f} MB    {original_total/quantized_total:>6.2f}x")
-    print("="*60)
-    
-    print(f"\n✅ Quantization complete!")
-    print(f"📁 Quantized model saved to: {output_dir}")
-    print(f"\n💡 To use the quantized model:")
-    print(f"   Method 1 - Environment variable (Recommended):")
-    print(f"      export COSYVOICE_FP16=true")
-    print(f"      export COSYVOICE_QUANTIZED=true")
-    print(f"      python stream_service.py")
-    print(f"")
-    print(f"   Method 2 - Direct path in code:")
-    print(f"      model_dir = '{output_dir}'")
-    print(f"      cosyvoice = AutoModel(model_dir=model_dir, fp16=True)")
-    print(f"")
-    print(f"   Method 3 - High-performance start:")
-    print(f"      export COSYVOICE_QUANTIZED=true")
-    print(f"      ./start_fast.sh")
-    
+    print("-" * 60)
+    for name in ['llm', 'flow']:
+        orig, quant = file_size_mb(f"{model_dir}/{name}.pt"), file_size_mb(f"{output_dir}/{name}.pt")
+        print(f"{name:<12} {orig:>10.1f} MB    {quant:>10.1f} MB    {orig / max(quant, 1e-6):>6.2f}x")
+    print("=" * 60)
+    print(f"\n✅ Quantization complete: {output_dir}")
+    print("💡 The model dir is loaded natively, e.g. AutoModel(model_dir=...) or export COSYVOICE_QUANTIZED=true")
+    print(f"💡 Accuracy/latency report: python benchmark_quantized.py --model_dir {model_dir} --quantized_dir {output_dir}")
     return True
 
+
 def main():
     parser = argparse.ArgumentParser(
-        description='CosyVoice Model Quantization Tool',
+        description='CosyVoice weight-only int8/int4 quantization with activation calibration',
         formatter_class=argparse.RawDescriptionHelpFormatter,
         epilog="""
 Examples:
-  # 基本用法
+  # per-channel int8
   python quantize_model.py pretrained_models/CosyVoice2-0.5B pretrained_models/CosyVoice2-0.5B-quantized
-  
-  # 同时量化 HiFi-GAN (可能影响音质)
-  python quantize_model.py pretrained_models/CosyVoice2-0.5B pretrained_models/CosyVoice2-0.5B-quantized --quantize-hift
+
+  # grouped int4, group size 64
+  python quantize_model.py pretrained_models/CosyVoice2-0.5B pretrained_models/CosyVoice2-0.5B-int4 --bits 4 --group_size 64
         """
     )
-    
-    parser.add_argument('model_dir', type=str,
-                       help='Path to original model directory')
-    parser.add_argument('output_dir', type=str,
-                       help='Path to save quantized model')
-    parser.add_argument('--quantize-hift', action='store_true',
-                       help='Also quantize HiFi-GAN (may reduce audio quality)')
-    
+    parser.add_argument('model_dir', type=str, help='Path to original model directory')
+    parser.add_argument('output_dir', type=str, help='Path to save quantized model')
+    parser.add_argument('--bits', type=int, default=8, choices=[8, 4])
+    parser.add_argument('--group_size', type=int, default=128)
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav', type=str, default='./asset/zero_shot_prompt.wav')
+    parser.add_argument('--calibration_texts', type=str, nargs='*', default=CALIBRATION_TEXTS,
+                        help='texts synthesized to collect activation statistics, pass none to only minimize the weight error')
     args = parser.parse_args()
-    
-    # 验证输入
+
     if not os.path.exists(args.model_dir):
         print(f"❌ Error: Model directory not found: {args.model_dir}")
         sys.exit(1)
-    
+
     if os.path.exists(args.output_dir):
         response = input(f"⚠️  Output directory already exists: {args.output_dir}\n   Overwrite? (y/N): ")
         if response.lower() != 'y':
             print("Aborted.")
             sys.exit(0)
-    
-    # 执行量化
-    success = quantize_dynamic(
-        args.model_dir,
-        args.output_dir,
-        skip_hift=not args.quantize_hift
-    )
-    
+
+    with torch.no_grad():
+        success = quantize(args.model_dir, args.output_dir, bits=args.bits, group_size=args.group_size,
+                           calibration_texts=args.calibration_texts, prompt_text=args.prompt_text, prompt_wav=args.prompt_wav)
+
     sys.exit(0 if success else 1)
 
+
 if __name__ == "__main__":
     main()
@@ -26,6 +26,7 @@ sys.path.append('{}/../../..'.format(ROOT_DIR))
 sys.path.append('{}/../../../third_party/Matcha-TTS'.format(ROOT_DIR))
 from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
 from cosyvoice.utils.file_utils import load_wav
+from cosyvoice.utils.common import CancelToken
 
 app = FastAPI()
 # set cross region allowance
@@ -37,48 +38,57 @@ app.add_middleware(
     allow_headers=["*"])
 
 
-def generate_data(model_output):
-    for i in model_output:
-        tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
-        yield tts_audio
+def generate_data(model_output, cancel_token):
+    try:
+        for i in model_output:
+            tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
+            yield tts_audio
+    finally:
+        # client disconnected or stream finished, stop llm and free session caches right away
+        cancel_token.cancel()
 
 
 @app.get("/inference_sft")
 @app.post("/inference_sft")
 async def inference_sft(tts_text: str = Form(), spk_id: str = Form()):
-    model_output = cosyvoice.inference_sft(tts_text, spk_id)
-    return StreamingResponse(generate_data(model_output))
+    cancel_token = CancelToken()
+    model_output = cosyvoice.inference_sft(tts_text, spk_id, cancel_token=cancel_token)
+    return StreamingResponse(generate_data(model_output, cancel_token))
 
 
 @app.get("/inference_zero_shot")
 @app.post("/inference_zero_shot")
 async def inference_zero_shot(tts_text: str = Form(), prompt_text: str = Form(), prompt_wav: UploadFile = File()):
     prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+    cancel_token = CancelToken()
+    model_output = cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k, cancel_token=cancel_token)
+    return StreamingResponse(generate_data(model_output, cancel_token))
 
 
 @app.get("/inference_cross_lingual")
 @app.post("/inference_cross_lingual")
 async def inference_cross_lingual(tts_text: str = Form(), prompt_wav: UploadFile = File()):
     prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_cross_lingual(tts_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+    cancel_token = CancelToken()
+    model_output = cosyvoice.inference_cross_lingual(tts_text, prompt_speech_16k, cancel_token=cancel_token)
+    return StreamingResponse(generate_data(model_output, cancel_token))
 
 
 @app.get("/inference_instruct")
 @app.post("/inference_instruct")
 async def inference_instruct(tts_text: str = Form(), spk_id: str = Form(), instruct_text: str = Form()):
-    model_output = cosyvoice.inference_instruct(tts_text, spk_id, instruct_text)
-    return StreamingResponse(generate_data(model_output))
+    cancel_token = CancelToken()
+    model_output = cosyvoice.inference_instruct(tts_text, spk_id, instruct_text, cancel_token=cancel_token)
+    return StreamingResponse(generate_data(model_output, cancel_token))
 
 
 @app.get("/inference_instruct2")
 @app.post("/inference_instruct2")
 async def inference_instruct2(tts_text: str = Form(), instruct_text: str = Form(), prompt_wav: UploadFile = File()):
     prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_instruct2(tts_text, instruct_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+    cancel_token = CancelToken()
+    model_output = cosyvoice.inference_instruct2(tts_text, instruct_text, prompt_speech_16k, cancel_token=cancel_token)
+    return StreamingResponse(generate_data(model_output, cancel_token))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,62 @@
+#!/usr/bin/env bash
+set -o pipefail
+
+UPTIME_SEC=$(awk '{print int($1)}' /proc/uptime)
+if [ "$UPTIME_SEC" -lt 60 ]; then
+  sleep 30
+fi
+
+source /home/ec2-user/miniconda3/etc/profile.d/conda.sh
+conda activate cosyvoice
+
+# Disable DeepSpeed compilation (CUDA toolkit not installed, but GPUs available)
+export DS_BUILD_AIO=0
+export DS_BUILD_SPARSE_ATTN=0
+export DS_BUILD_SPARSE_ALLREDUCE=0
+export DS_BUILD_UTILS=0
+export DS_BUILD_FUSED_LAMB=0
+
+export CUDA_VISIBLE_DEVICES=0
+export PYTORCH_NO_MMAP=1
+export MALLOC_ARENA_MAX=4
+export PYTORCH_CUDA_ALLOC_CONF=max_split_size_mb:512,expandable_segments:True
+export COSYVOICE_FP16=true
+export COSYVOICE_QUANTIZED=true
+export COSYVOICE_COMPILE=false
+export CUDA_LAUNCH_BLOCKING=0
+
+export COSYVOICE_MODEL_SERVER=127.0.0.1:50100
+# model_server 与 gunicorn worker 共享的随机密钥，每次启动重新生成
+export COSYVOICE_MODEL_SERVER_AUTHKEY=$(python -c "import secrets; print(secrets.token_hex(16))")
+
+cd /home/ec2-user/CosyVoice
+
+# 共享权重模式：模型只在 model_server 进程中加载一次，gunicorn worker 只做 HTTP 前端，
+# 所有 worker 的请求在同一进程中并发执行，flow/hift 按批推理
+python -m cosyvoice.cli.model_server \
+  --model_dir /home/ec2-user/CosyVoice/pretrained_models/CosyVoice2-0.5B-quantized \
+  --port 50100 \
+  --fp16 \
+  --max_streams 32 \
+  --flow_batch_size 8 \
+  --hift_batch_size 8 &
+MODEL_SERVER_PID=$!
+trap 'kill $MODEL_SERVER_PID' EXIT
+
+# 等待 model_server 加载完模型并开始监听
+until python -c "import socket; socket.create_connection(('127.0.0.1', 50100), 1)" 2>/dev/null; do
+  kill -0 $MODEL_SERVER_PID || exit 1
+  sleep 2
+done
+
+gunicorn stream_service:app \
+  --bind 0.0.0.0:50000 \
+  --workers 4 \
+  --worker-class uvicorn.workers.UvicornWorker \
+  --timeout 300 \
+  --worker-connections 1000 \
+  --max-requests 100 \
+  --max-requests-jitter 10 \
+  --access-logfile - \
+  --error-logfile - \
+  --log-level warning
@@ -3,10 +3,14 @@ from fastapi import FastAPI, HTTPException, UploadFile, File, Form
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from cosyvoice.cli.cosyvoice import AutoModel, CosyVoice, CosyVoice2, CosyVoice3
+from cosyvoice.cli.async_cosyvoice import AsyncCosyVoice
+from cosyvoice.cli.model_server import ModelClient
+from cosyvoice.utils.prompt_cache import PromptCache
+from cosyvoice.utils.file_utils import PromptAudio
 from typing import Optional
 import os
+import asyncio
 import logging
-import tempfile
 import soundfile as sf
 import numpy as np
 import io
@@ -43,14 +47,20 @@ alt_model_dir = "/home/ec2-user/CosyVoice/pretrained_models/CosyVoice2-0.5B-quan
 # 性能优化：支持通过环境变量启用 FP16 和量化模型
 USE_FP16 = os.getenv('COSYVOICE_FP16', 'true').lower() == 'true'
 USE_QUANTIZED = os.getenv('COSYVOICE_QUANTIZED', 'true').lower() == 'true'  # 默认启用量化
+# 并发流式请求的 flow 批处理大小，0 表示不批处理
+FLOW_BATCH_SIZE = int(os.getenv('COSYVOICE_FLOW_BATCH_SIZE', '0'))
+# 相同音色/instruction 的请求共享 prompt 前缀 [sos, prompt_text] 的 LLM KV cache，0 表示关闭
+LLM_PREFIX_CACHE_MB = int(os.getenv('COSYVOICE_LLM_PREFIX_CACHE_MB', '64'))
+# 快速启动：不构建/初始化随机权重，直接从 llm.pt/flow.pt/hift.pt（或 tools/convert_checkpoint.py 转换的 safetensors）加载
+USE_LAZY_LOAD = os.getenv('COSYVOICE_LAZY_LOAD', 'false').lower() == 'true'
 
 if USE_QUANTIZED:
-    # 自动查找量化模型目录（优先级：FP16 > 原始）
+    # 自动查找量化模型目录（quantize_model.py/simple_quantize.py 导出的 int8/int4 模型，加载时按 quantization.json 构建量化层）
     fp16_dir = model_dir.rstrip('/') + '-quantized'
     
     if os.path.exists(fp16_dir):
         model_dir = fp16_dir
-        print(f"✅ Using FP16 quantized model: {model_dir}")
+        print(f"✅ Using quantized model: {model_dir}")
     else:
         print(f"⚠️  Quantized model not found at {fp16_dir}")
         print(f"    Using original model (will be slower)")
@@ -59,7 +69,13 @@ print(f"📂 Loading model from: {model_dir}")
 print(f"⚙️  FP16 enabled: {USE_FP16}")
 print(f"⚙️  Quantized enabled: {USE_QUANTIZED}")
 
-cosyvoice = CosyVoice2(model_dir=model_dir, fp16=USE_FP16)
+# 共享权重模式：设置 COSYVOICE_MODEL_SERVER=host:port 时 worker 不加载模型，请求转发给 cosyvoice.cli.model_server 进程
+MODEL_SERVER = os.getenv('COSYVOICE_MODEL_SERVER', '')
+if MODEL_SERVER:
+    cosyvoice = ModelClient(MODEL_SERVER)
+    print(f"🔗 Using shared model server: {MODEL_SERVER}")
+else:
+    cosyvoice = CosyVoice2(model_dir=model_dir, fp16=USE_FP16, flow_batch_size=FLOW_BATCH_SIZE, prefix_cache_mb=LLM_PREFIX_CACHE_MB, lazy_load=USE_LAZY_LOAD)
 
 # 记录 worker 信息（用于日志追踪）
 import multiprocessing as mp
@@ -70,10 +86,10 @@ current_pid = os.getpid()
 WORKER_ID = str(current_pid % 10)
 
 # 为了实现真正的负载均衡，奇数 worker 使用 quantized-2 副本
-if int(WORKER_ID) % 2 == 1:
+if not MODEL_SERVER and int(WORKER_ID) % 2 == 1:
     if os.path.exists(alt_model_dir) and alt_model_dir != model_dir:
         print(f"🔄 Worker {WORKER_ID} (PID: {current_pid}) loading alternate quantized model...")
-        cosyvoice = CosyVoice2(model_dir=alt_model_dir, fp16=USE_FP16)
+        cosyvoice = CosyVoice2(model_dir=alt_model_dir, fp16=USE_FP16, flow_batch_size=FLOW_BATCH_SIZE, prefix_cache_mb=LLM_PREFIX_CACHE_MB, lazy_load=USE_LAZY_LOAD)
         model_dir = alt_model_dir  # 更新 model_dir 用于日志
         print(f"✅ Worker {WORKER_ID} loaded: {alt_model_dir}")
     else:
@@ -82,18 +98,29 @@ if int(WORKER_ID) % 2 == 1:
 else:
     print(f"✅ Worker {WORKER_ID} (PID: {current_pid}) using default: {model_dir}")
 
+# prompt 特征缓存：内存 LRU + 可选磁盘层（多个 worker 共享同一目录）
+PROMPT_CACHE_DIR = os.getenv('COSYVOICE_PROMPT_CACHE_DIR', '')
+PROMPT_CACHE_MB = int(os.getenv('COSYVOICE_PROMPT_CACHE_MB', '256'))
+if not MODEL_SERVER:
+    cosyvoice.frontend.prompt_cache = PromptCache(max_bytes=PROMPT_CACHE_MB * 1024 * 1024, cache_dir=PROMPT_CACHE_DIR)
+
+# 流式接口的异步封装：模型计算在独立线程池中运行，不阻塞事件循环；客户端断开时取消 llm_job
+MAX_STREAMS = int(os.getenv('COSYVOICE_MAX_STREAMS', '8'))
+# ModelClient 本身就是异步接口
+async_cosyvoice = cosyvoice if MODEL_SERVER else AsyncCosyVoice(cosyvoice, max_workers=MAX_STREAMS)
+
 # 检测模型类型
-model_type = type(cosyvoice).__name__
+model_type = cosyvoice.model_type if MODEL_SERVER else type(cosyvoice).__name__
 logger.warning(f"Loaded model type: {model_type}")
 
 # 可选：torch.compile加速（PyTorch 2.0+，首次推理会慢，后续会快）
 USE_COMPILE = os.getenv('COSYVOICE_COMPILE', 'false').lower() == 'true'
-if USE_COMPILE and hasattr(torch, 'compile'):
+if USE_COMPILE and not MODEL_SERVER and hasattr(torch, 'compile'):
     try:
         logger.warning("Applying torch.compile optimization...")
-        # 编译模型的关键部分（如果支持）
-        if hasattr(cosyvoice, 'model'):
-            cosyvoice.model.llm = torch.compile(cosyvoice.model.llm, mode='reduce-overhead')
+        # 只编译固定形状的单 token 解码步（静态 KV cache），整体编译 LLM 会因 cache 增长而失败
+        if hasattr(cosyvoice, 'model') and hasattr(cosyvoice.model.llm.llm, 'decode_step'):
+            cosyvoice.model.llm.llm.decode_step = torch.compile(cosyvoice.model.llm.llm.forward_one_step_static, mode='reduce-overhead')
         logger.warning("torch.compile applied successfully")
     except Exception as e:
         logger.warning(f"torch.compile failed: {e}")
@@ -118,15 +145,13 @@ if isinstance(cosyvoice, CosyVoice):
     default_speaker = available_speakers[0] if available_speakers else None
     logger.info(f"Default speaker: {default_speaker}")
 
-# 性能优化：预加载和缓存默认音频
-_default_audio_cache = None
-_default_audio_info = None
+# 性能优化：启动时解码一次默认音频，所有请求共享其重采样结果
+_default_prompt_audio = None
 
 if os.path.exists(default_prompt_wav):
     try:
-        # 预加载默认音频文件信息，避免每次请求都读取
-        _default_audio_info = sf.info(default_prompt_wav)
-        logger.info(f"✓ Preloaded default audio: {default_prompt_wav} ({_default_audio_info.duration:.2f}s)")
+        _default_prompt_audio = PromptAudio(default_prompt_wav)
+        logger.info(f"✓ Preloaded default audio: {default_prompt_wav} ({_default_prompt_audio.speech.shape[1] / _default_prompt_audio.sample_rate:.2f}s)")
     except Exception as e:
         logger.warning(f"Failed to preload default audio: {e}")
 
@@ -181,7 +206,7 @@ async def synthesize_streaming(
         #     return StreamingResponse(audio_stream(), media_type="application/octet-stream")
 
         # CosyVoice2/3 - 支持多种推理模式
-        if isinstance(cosyvoice, (CosyVoice2, CosyVoice3)):
+        if isinstance(cosyvoice, (CosyVoice2, CosyVoice3, ModelClient)):
             # 推理模式选择:
             # 有 instruction → 使用 instruct2 (指令控制风格)
             # 无 instruction → 使用 zero_shot (纯声音克隆,需要 prompt_text)
@@ -199,18 +224,20 @@ async def synthesize_streaming(
                 bool(instruction_text),
             )
 
-            # 处理prompt_wav文件 (可选) - 优化版本
-            temp_wav_path = None
+            # 处理prompt_wav文件 (可选) - 上传的音频直接在内存中解码，不再写临时文件
             if prompt_wav:
-                # 用户上传了音频文件
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as temp_file:
-                    content = await prompt_wav.read()
-                    temp_file.write(content)
-                    temp_wav_path = temp_file.name
-                logger.debug(f"Using uploaded audio: {temp_wav_path}")
-            elif os.path.exists(default_prompt_wav):
-                # 使用默认音频文件（已预加载验证）
-                temp_wav_path = default_prompt_wav
+                content = await prompt_wav.read()
+                try:
+                    prompt_audio = PromptAudio(content)
+                    if prompt_audio.speech.shape[1] / prompt_audio.sample_rate < 0.1:  # 快速检查
+                        raise ValueError("Audio too short")
+                except Exception as e:
+                    logger.error(f"Invalid audio: {e}")
+                    raise HTTPException(status_code=400, detail="Invalid audio file")
+                logger.debug("Using uploaded audio")
+            elif _default_prompt_audio is not None:
+                # 使用默认音频（启动时已解码）
+                prompt_audio = _default_prompt_audio
                 logger.debug(f"Using default audio: {default_prompt_wav}")
             else:
                 # 没有音频文件
@@ -220,46 +247,26 @@ async def synthesize_streaming(
                     detail=f"Voice reference required. Place file at: {default_prompt_wav}"
                 )
 
-            # 根据参数选择推理方法 - 优化版本
-            if temp_wav_path:
-                # 跳过重复验证（上传的文件已在保存时验证，默认文件已预加载）
-                # 仅对上传文件进行快速验证
-                if prompt_wav:
-                    try:
-                        audio_info = sf.info(temp_wav_path)
-                        if audio_info.duration < 0.1:  # 快速检查
-                            raise ValueError("Audio too short")
-                    except Exception as e:
-                        logger.error(f"Invalid audio: {e}")
-                        raise HTTPException(status_code=400, detail="Invalid audio file")
-                
-                # 确保使用绝对路径
-                abs_wav_path = os.path.abspath(temp_wav_path)
-                
-                if instruction_text:
-                    # INSTRUCT2 模式: instruction + voice
-                    logger.debug(f"Mode: INSTRUCT2, text_len={len(text)}")
-                    inference_method = lambda: cosyvoice.inference_instruct2(
-                        text,
-                        instruction_text,
-                        abs_wav_path, 
-                        stream=True
-                    )
-                else:
-                    # ZERO_SHOT 模式: 纯声音克隆
-                    actual_prompt_text = prompt_text if prompt_text else default_prompt_text
-                    logger.debug(f"Mode: ZERO_SHOT, text_len={len(text)}")
-                    inference_method = lambda: cosyvoice.inference_zero_shot(
-                        text,
-                        'You are a helpful assistant.<|endofprompt|>' + actual_prompt_text,
-                        # actual_prompt_text,
-                        abs_wav_path, 
-                        stream=True
-                    )
+            # 根据参数选择推理方法
+            if instruction_text:
+                # INSTRUCT2 模式: instruction + voice
+                logger.debug(f"Mode: INSTRUCT2, text_len={len(text)}")
+                inference_method = lambda: async_cosyvoice.inference_instruct2(
+                    text,
+                    instruction_text,
+                    prompt_audio,
+                    stream=True
+                )
             else:
-                raise HTTPException(
-                    status_code=400,
-                    detail="Voice reference required"
+                # ZERO_SHOT 模式: 纯声音克隆
+                actual_prompt_text = prompt_text if prompt_text else default_prompt_text
+                logger.debug(f"Mode: ZERO_SHOT, text_len={len(text)}")
+                inference_method = lambda: async_cosyvoice.inference_zero_shot(
+                    text,
+                    'You are a helpful assistant.<|endofprompt|>' + actual_prompt_text,
+                    # actual_prompt_text,
+                    prompt_audio,
+                    stream=True
                 )
 
             async def audio_stream():
@@ -268,7 +275,7 @@ async def synthesize_streaming(
                 chunk_count = 0
                 
                 try:
-                    for result in inference_method():
+                    async for result in inference_method():
                         # 获取音频数据（Float32 格式）
                         audio_chunk = result["tts_speech"].squeeze()
                         chunk_num_samples = audio_chunk.shape[0]
@@ -285,13 +292,6 @@ async def synthesize_streaming(
                         yield pcm_bytes
                             
                 finally:
-                    # 只清理上传的临时文件
-                    if prompt_wav and temp_wav_path and os.path.exists(temp_wav_path):
-                        try:
-                            os.unlink(temp_wav_path)
-                        except:
-                            pass
-
                     wall = time.perf_counter() - start_ts
                     audio_sec = total_samples / float(sample_rate) if total_samples else 0.0
                     rtf = wall / audio_sec if audio_sec > 0 else 0.0
@@ -328,35 +328,28 @@ async def synthesize_complete(
     非流式合成接口，返回完整的 WAV 文件（用于测试音色）
     """
     try:
-        if isinstance(cosyvoice, (CosyVoice2, CosyVoice3)):
+        if isinstance(cosyvoice, (CosyVoice2, CosyVoice3, ModelClient)):
             instruction_text = instruction if instruction else None
             
             # 处理音频文件
-            temp_wav_path = None
             if prompt_wav:
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as temp_file:
-                    content = await prompt_wav.read()
-                    temp_file.write(content)
-                    temp_wav_path = temp_file.name
-            elif os.path.exists(default_prompt_wav):
-                temp_wav_path = default_prompt_wav
+                prompt_audio = PromptAudio(await prompt_wav.read())
+            elif _default_prompt_audio is not None:
+                prompt_audio = _default_prompt_audio
             else:
                 raise HTTPException(status_code=400, detail="No voice reference audio")
             
-            abs_wav_path = os.path.abspath(temp_wav_path)
-            logger.debug(f"Complete synthesis - voice: {abs_wav_path}")
-            
             # 收集所有音频块
             chunks = []
             
             if instruction_text:
-                for result in cosyvoice.inference_instruct2(text, instruction_text, abs_wav_path, stream=False):
+                async for result in async_cosyvoice.inference_instruct2(text, instruction_text, prompt_audio, stream=False):
                     chunks.append(result["tts_speech"].squeeze().cpu().numpy())
             else:
-                for result in cosyvoice.inference_zero_shot(
+                async for result in async_cosyvoice.inference_zero_shot(
                     '收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。',
                     'You are a helpful assistant.<|endofprompt|>希望你以后能够做的比我还好呦。',
-                    abs_wav_path,
+                    prompt_audio,
                     stream=False
                 ):
                     chunks.append(result["tts_speech"].squeeze().cpu().numpy())
@@ -367,11 +360,6 @@ async def synthesize_complete(
                 buffer = io.BytesIO()
                 sf.write(buffer, full_audio, cosyvoice.sample_rate, format='WAV')
                 buffer.seek(0)
-                
-                # 清理临时文件
-                if prompt_wav and temp_wav_path and os.path.exists(temp_wav_path):
-                    os.unlink(temp_wav_path)
-                
                 return StreamingResponse(buffer, media_type="audio/wav")
             else:
                 raise HTTPException(status_code=500, detail="No audio generated")
@@ -401,6 +389,18 @@ async def get_model_info():
         info["usage"] = "Use /synthesize endpoint with 'instruction' parameter (CosyVoice2/3)"
 
     info["endpoint"] = "/synthesize"
+    if MODEL_SERVER:
+        stats = await asyncio.get_running_loop().run_in_executor(None, cosyvoice.stats)
+        info["model_server"] = MODEL_SERVER
+        info["prompt_cache"] = stats.get("prompt_cache")
+        info["sessions"] = stats["sessions"]
+        info["prefix_cache"] = stats.get("prefix_cache")
+    else:
+        info["prompt_cache"] = cosyvoice.frontend.prompt_cache.stats()
+        info["sessions"] = cosyvoice.model.session_stats()
+        if hasattr(cosyvoice.model.llm, 'prefix_cache'):
+            info["prefix_cache"] = cosyvoice.model.llm.prefix_cache.stats()
+        info["startup"] = cosyvoice.startup_timer.phases
 
     return info
 
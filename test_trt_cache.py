@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+TensorRT plan cache test, runs without tensorrt or gpu: the plan builder, tensorrt version and device of TrtEngineCache are faked.
+
+    python test_trt_cache.py
+checks that concurrent processes build a plan once, and that any change of the cache key builds a new plan.
+"""
+import multiprocessing as mp
+import os
+import tempfile
+import time
+from cosyvoice.utils.trt_cache import TrtEngineCache
+
+TRT_KWARGS = {'input_names': ['x'], 'profiles': [{'min_shape': [(1, 80, 4)], 'opt_shape': [(2, 80, 200)], 'max_shape': [(2, 80, 500)]}]}
+
+
+def fake_build(plan_path, trt_kwargs, onnx_model, fp16):
+    # NOTE one line per build, appends of a short line are atomic across processes
+    with open(os.path.join(os.path.dirname(plan_path), 'builds.log'), 'a') as f:
+        f.write('{}\n'.format(os.getpid()))
+    time.sleep(0.3)
+    with open(plan_path, 'wb') as f:
+        f.write(b'plan')
+
+
+def failed_build(plan_path, trt_kwargs, onnx_model, fp16):
+    with open(plan_path, 'wb') as f:
+        f.write(b'partial')
+    raise RuntimeError('build failed')
+
+
+def num_builds(model_dir):
+    path = os.path.join(model_dir, 'builds.log')
+    if not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        return len(f.readlines())
+
+
+def get_plan(model_dir, trt_kwargs=TRT_KWARGS, fp16=True, trt_version='10.13', build_fn=fake_build):
+    cache = TrtEngineCache(build_fn=build_fn, trt_version=trt_version, device='fake gpu sm90')
+    return cache.get(os.path.join(model_dir, 'flow.decoder.estimator.fp16.plan'), os.path.join(model_dir, 'flow.decoder.estimator.onnx'), trt_kwargs, fp16)
+
+
+def worker(model_dir, result_queue):
+    result_queue.put(get_plan(model_dir))
+
+
+def main():
+    with tempfile.TemporaryDirectory() as model_dir:
+        with open(os.path.join(model_dir, 'flow.decoder.estimator.onnx'), 'wb') as f:
+            f.write(b'onnx v1')
+
+        # concurrent processes, e.g. gunicorn workers, build the plan once and all get the same path
+        result_queue = mp.Queue()
+        processes = [mp.Process(target=worker, args=(model_dir, result_queue)) for _ in range(6)]
+        for p in processes:
+            p.start()
+        plan_paths = {result_queue.get() for _ in processes}
+        for p in processes:
+            p.join()
+        assert len(plan_paths) == 1 and num_builds(model_dir) == 1, 'expect 1 plan and 1 build, got {} and {}'.format(plan_paths, num_builds(model_dir))
+        plan_path = plan_paths.pop()
+        print('6 concurrent processes, 1 build: {}'.format(os.path.basename(plan_path)))
+
+        # same key is a hit, shapes given as lists or tuples are the same key
+        trt_kwargs = {'input_names': ['x'], 'profiles': [{k: [list(s) for s in v] for k, v in TRT_KWARGS['profiles'][0].items()}]}
+        assert get_plan(model_dir, trt_kwargs=trt_kwargs) == plan_path and num_builds(model_dir) == 1, 'list shapes should hit the cached plan'
+
+        # any change of precision, profiles, tensorrt version or onnx content builds a new plan
+        new_paths = {plan_path}
+        profiles = {'input_names': ['x'], 'profiles': TRT_KWARGS['profiles'] + [{'min_shape': [(1, 80, 4)], 'opt_shape': [(2, 80, 1000)], 'max_shape': [(2, 80, 3000)]}]}
+        for name, kwargs in [('fp32', {'fp16': False}), ('profiles', {'trt_kwargs': profiles}), ('trt version', {'trt_version': '10.14'})]:
+            new_paths.add(get_plan(model_dir, **kwargs))
+            assert len(new_paths) == num_builds(model_dir), '{} change should build a new plan'.format(name)
+        with open(os.path.join(model_dir, 'flow.decoder.estimator.onnx'), 'wb') as f:
+            f.write(b'onnx v2')
+        new_paths.add(get_plan(model_dir))
+        assert len(new_paths) == num_builds(model_dir) == 5, 'onnx change should build a new plan'
+        print('fp32, profiles, trt version and onnx changes, {} builds'.format(num_builds(model_dir)))
+
+        # a failed build leaves neither a plan nor a temporary file behind
+        try:
+            get_plan(model_dir, trt_version='11.0', build_fn=failed_build)
+            raise AssertionError('failed build should raise')
+        except RuntimeError:
+            pass
+        leftover = [f for f in os.listdir(model_dir) if '.tmp' in f]
+        assert len(leftover) == 0, 'failed build left {}'.format(leftover)
+        print('failed build cleaned up')
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Convert llm.pt/flow.pt/hift.pt of a model dir to safetensors once, the .safetensors files are written next to them
+and are memory mapped by cosyvoice.utils.file_utils.load_checkpoint at startup instead of unpickling the .pt files.
+
+    python tools/convert_checkpoint.py --model_dir pretrained_models/CosyVoice2-0.5B
+"""
+import argparse
+import logging
+import os
+import torch
+from safetensors.torch import save_file
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, required=True)
+    parser.add_argument('--names', type=str, nargs='+', default=['llm', 'flow', 'hift'])
+    args = parser.parse_args()
+    for name in args.names:
+        path = os.path.join(args.model_dir, '{}.pt'.format(name))
+        if not os.path.exists(path):
+            logging.warning('{} not found, skip'.format(path))
+            continue
+        state_dict = torch.load(path, map_location='cpu', weights_only=True)
+        # NOTE safetensors does not store tensors sharing memory, e.g. tied qwen2 embeddings, save each one separately
+        state_dict = {k: v.contiguous().clone() for k, v in state_dict.items()}
+        output = os.path.join(args.model_dir, '{}.safetensors'.format(name))
+        # write to a temporary file first, so that a failed conversion never leaves a truncated checkpoint behind
+        save_file(state_dict, output + '.tmp')
+        os.replace(output + '.tmp', output)
+        logging.info('converted {} to {}, {} tensors'.format(path, output, len(state_dict)))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    main()